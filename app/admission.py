@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from http.cookies import SimpleCookie
+
+from starlette.responses import JSONResponse
+
+from app import metrics
+
+# -------------------------------------------------------------------
+# Admission control for expensive routes
+#
+# Sign-up/login (PBKDF2, seeding), the FDC importer and the big diet
+# reads run in the same anyio threadpool and DB pool as page renders.
+# Each of those route classes gets a concurrency limit and a short
+# queue, checked in the event loop before the request takes a thread:
+#   - at most `limit` requests of a class are served at once, and at most
+#     `per_user` of them for one user (auth cookie, else client IP)
+#   - the rest wait, served round-robin across users, for up to
+#     ADMISSION_MAX_WAIT_SECS
+#   - a full queue or a wait that runs out is answered 503 + Retry-After
+# Everything else (pages, static, small API calls) is never queued, and
+# keeps the threadpool tokens these limits leave free.
+# Limits are per worker process.
+# -------------------------------------------------------------------
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "1").lower() not in ("0", "false", "no")
+ADMISSION_MAX_WAIT_SECS = float(os.getenv("ADMISSION_MAX_WAIT_SECS", "2"))
+ADMISSION_RETRY_AFTER_SECS = float(os.getenv("ADMISSION_RETRY_AFTER_SECS", "2"))
+
+# name: (default limit, per_user, queue), each overridable with ADMISSION_<NAME>_LIMIT / _PER_USER / _QUEUE
+CLASS_DEFAULTS = {
+    "auth": (8, 4, 32),
+    "fdc_import": (8, 2, 16),
+    "heavy_read": (16, 8, 64),
+}
+
+# (method, path pattern, class), first match wins
+ROUTES = (
+    ("POST", re.compile(r"^/api/(register|login)$"), "auth"),
+    ("POST", re.compile(r"^/api/foods/create_update_food_from_fdcid/[^/]+$"), "fdc_import"),
+    ("GET", re.compile(r"^/api/diets/[^/]+/(nutrition|bundle|export)$"), "heavy_read"),
+    ("GET", re.compile(r"^/api/(diet_comparison|intake/summary)$"), "heavy_read"),
+    ("GET", re.compile(r"^/api/foods/[^/]+/similar$"), "heavy_read"),
+)
+
+
+class Shed(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RouteClass:
+    ''' Slots of one route class. Only touched from the event loop, so no lock '''
+
+    def __init__(self, name: str, limit: int, per_user: int, queue: int):
+        self.name = name
+        self.limit = limit
+        self.per_user = per_user
+        self.queue = queue
+        self.active = 0
+        self.active_by_key = {}
+        self.waiting = OrderedDict()  # key -> deque of futures, in round-robin order
+        self.queued = 0
+
+    def _report(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.active, route_class=self.name)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self.queued, route_class=self.name)
+
+    def _take(self, key: str):
+        self.active += 1
+        self.active_by_key[key] = self.active_by_key.get(key, 0) + 1
+
+    async def acquire(self, key: str):
+        # While a slot is free every waiter is at its per_user cap, so taking it isn't queue jumping
+        if self.active < self.limit and self.active_by_key.get(key, 0) < self.per_user and key not in self.waiting:
+            self._take(key)
+            self._report()
+            return
+        mine = self.waiting.get(key)
+        if self.queued >= self.queue or (mine is not None and len(mine) >= max(1, self.queue // 2)):
+            raise Shed("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(key, deque()).append(future)
+        self.queued += 1
+        self._report()
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, ADMISSION_MAX_WAIT_SECS)
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                self.release(key)  # granted just as we gave up
+            else:
+                self._forget(key, future)
+            if isinstance(exc, asyncio.TimeoutError):
+                raise Shed("timeout")
+            raise
+        finally:
+            metrics.ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started, route_class=self.name)
+
+    def _forget(self, key: str, future):
+        waiters = self.waiting.get(key)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self.waiting[key]
+        self._report()
+
+    def release(self, key: str):
+        self.active -= 1
+        left = self.active_by_key.get(key, 1) - 1
+        if left:
+            self.active_by_key[key] = left
+        else:
+            self.active_by_key.pop(key, None)
+        self._dispatch()
+        self._report()
+
+    def _dispatch(self):
+        ''' Hand free slots to waiters, one per user in turn '''
+        while self.active < self.limit and self.waiting:
+            for key, waiters in self.waiting.items():
+                if self.active_by_key.get(key, 0) < self.per_user:
+                    break
+            else:
+                return  # everyone waiting is at their per_user cap
+            future = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                self.waiting.move_to_end(key)
+            else:
+                del self.waiting[key]
+            if not future.done():
+                self._take(key)
+                future.set_result(None)
+
+
+def _classes() -> dict:
+    classes = {}
+    for name, (limit, per_user, queue) in CLASS_DEFAULTS.items():
+        prefix = f"ADMISSION_{name.upper()}_"
+        classes[name] = RouteClass(
+            name,
+            int(os.getenv(prefix + "LIMIT", str(limit))),
+            int(os.getenv(prefix + "PER_USER", str(per_user))),
+            int(os.getenv(prefix + "QUEUE", str(queue))),
+        )
+    return classes
+
+
+def route_class(method: str, path: str) -> str | None:
+    for route_method, pattern, name in ROUTES:
+        if method == route_method and pattern.match(path):
+            return name
+    return None
+
+
+def client_key(scope) -> str:
+    ''' The user (auth cookie) or, before login, the client IP '''
+    for name, value in scope.get("headers", ()):
+        if name == b"cookie":
+            morsel = SimpleCookie(value.decode("latin-1")).get("auth_token")
+            if morsel is not None and morsel.value:
+                return "user:" + hashlib.sha1(morsel.value.encode()).hexdigest()[:16]
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.classes = _classes()
+
+    async def __call__(self, scope, receive, send):
+        name = route_class(scope.get("method", ""), scope.get("path", "")) if scope["type"] == "http" else None
+        if name is None or not ADMISSION_CONTROL:
+            await self.app(scope, receive, send)
+            return
+
+        slots = self.classes[name]
+        key = client_key(scope)
+        try:
+            await slots.acquire(key)
+        except Shed as exc:
+            metrics.ADMISSION_SHED.inc(route_class=name, reason=exc.reason)
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server busy, try again shortly"},
+                headers={"Retry-After": str(math.ceil(ADMISSION_RETRY_AFTER_SECS))},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            slots.release(key)
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+try:
+    import brotli  # optional: `uv add brotli` to also serve .br
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Fingerprinted static assets
+#
+# Every file in app/static gets a content-hashed URL
+# (adminlte.css -> /static/adminlte.3f9c1e0a7b2d.css) exposed to the
+# templates as static_url(). Hashed URLs never change content, so they are
+# sent with a one year immutable Cache-Control and browsers don't ask again.
+# Text assets are gzip/brotli compressed once, in the background at startup.
+# Plain (unhashed) URLs still work, with revalidation.
+# -------------------------------------------------------------------
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS_BYTES = 1024
+
+mimetypes.add_type("application/json", ".map")
+mimetypes.add_type("application/javascript", ".js")
+
+
+class Asset:
+    __slots__ = ("path", "file_path", "digest", "fingerprinted", "media_type", "size", "variants")
+
+    def __init__(self, path: str, file_path: str, digest: str):
+        self.path = path
+        self.file_path = file_path
+        self.digest = digest
+        base, ext = os.path.splitext(path)
+        self.fingerprinted = f"{base}.{digest}{ext}"
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.size = os.path.getsize(file_path)
+        self.variants = {}  # encoding -> bytes, filled by compress()
+
+    @property
+    def compressible(self) -> bool:
+        return self.size >= MIN_COMPRESS_BYTES and self.media_type.startswith(COMPRESSIBLE_TYPES)
+
+    def compress(self):
+        with open(self.file_path, "rb") as handle:
+            raw = handle.read()
+        gz = gzip.compress(raw, compresslevel=9, mtime=0)
+        if len(gz) < len(raw):
+            self.variants["gzip"] = gz
+        if brotli is not None:
+            br = brotli.compress(raw, quality=11)
+            if len(br) < len(raw):
+                self.variants["br"] = br
+
+
+class AssetManifest:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets = {}
+        self.by_fingerprint = {}
+        for root, _dirs, files in os.walk(directory):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                path = os.path.relpath(file_path, directory).replace(os.sep, "/")
+                with open(file_path, "rb") as handle:
+                    digest = hashlib.sha256(handle.read()).hexdigest()[:12]
+                asset = Asset(path, file_path, digest)
+                self.assets[path] = asset
+                self.by_fingerprint[asset.fingerprinted] = asset
+
+    def url(self, path: str) -> str:
+        asset = self.assets.get(path)
+        return "/static/" + (asset.fingerprinted if asset else path)
+
+    def compress_all(self):
+        for asset in self.assets.values():
+            if asset.compressible:
+                asset.compress()
+        logger.info(
+            "static assets: %d compressed (%s)",
+            sum(1 for a in self.assets.values() if a.variants), "gzip+br" if brotli else "gzip",
+        )
+
+    def compress_in_background(self):
+        threading.Thread(target=self.compress_all, name="static-compress", daemon=True).start()
+
+
+def _pick_encoding(asset: Asset, accept_encoding: str):
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in asset.variants:
+            return encoding
+    return None
+
+
+class StaticAssets:
+    ''' Drop-in for StaticFiles(directory=...) serving AssetManifest entries '''
+
+    def __init__(self, manifest: AssetManifest):
+        self.manifest = manifest
+
+    async def __call__(self, scope, receive, send):
+        response = self.get_response(scope)
+        await response(scope, receive, send)
+
+    def get_response(self, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405)
+        path, root_path = scope["path"], scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        path = path.lstrip("/")
+
+        asset = self.manifest.by_fingerprint.get(path)
+        cache_control = IMMUTABLE_CACHE_CONTROL
+        if asset is None:
+            asset = self.manifest.assets.get(path)
+            cache_control = REVALIDATE_CACHE_CONTROL
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        headers = Headers(scope=scope)
+        encoding = _pick_encoding(asset, headers.get("accept-encoding", ""))
+        etag = f'"{asset.digest}{"-" + encoding if encoding else ""}"'
+        response_headers = {"Cache-Control": cache_control, "ETag": etag}
+        if asset.compressible:
+            response_headers["Vary"] = "Accept-Encoding"
+
+        if etag in headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=response_headers)
+
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+            body = asset.variants[encoding]
+            if scope["method"] == "HEAD":
+                response_headers["Content-Length"] = str(len(body))
+                body = b""
+            return Response(body, media_type=asset.media_type, headers=response_headers)
+
+        return FileResponse(asset.file_path, media_type=asset.media_type, headers=response_headers)
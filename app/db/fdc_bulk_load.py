@@ -0,0 +1,350 @@
+''' Offline loader for the USDA FoodData Central CSV download
+
+    Streams food.csv, nutrient.csv and food_nutrient.csv from the downloaded
+    .zip (or the extracted folder) into the food_catalog table. Nothing is
+    fetched from the network.
+
+    python -m app.db.fdc_bulk_load ~/Downloads/FoodData_Central_csv_2024-10-31.zip
+
+    Each batch is committed together with its checkpoint in fdc_load_state,
+    so an interrupted load picks up where it stopped when run again.
+'''
+import argparse
+import csv
+import io
+import logging
+import os
+import time
+import zipfile
+from contextlib import contextmanager
+from threading import Lock
+
+from sqlalchemy import bindparam, delete, inspect, text, update
+from sqlalchemy import table as sa_table, column as sa_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.db.models import Base, FoodCatalog, FdcLoadState
+from app.db.session import SessionLocal, engine
+from app.fdc import is_unwanted_nutrient, fdc_nutrient_column_name
+from app import derived_nutrients
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000  # foods per commit
+PROGRESS_EVERY_SECS = 5.0
+
+# nutrient.csv has upper case unit codes, the FDC API (and so our column names) use these
+FDC_CSV_UNIT_NAMES = {
+    "G": "g",
+    "MG": "mg",
+    "UG": "µg",
+    "KCAL": "kcal",
+    "KJ": "kJ",
+    "IU": "IU",
+    "MG_ATE": "mg_ATE",
+    "MG_GAE": "mg_GAE",
+    "SP_GR": "sp gr",
+    "UMOL_TE": "umol TE",
+    "PH": "pH",
+}
+
+# Energy and most nutrients in food_nutrient.csv are per 100 g
+CATALOG_SERVING_SIZE = 100
+CATALOG_UNIT = "grams"
+
+_load_lock = Lock()
+
+
+class LoadAlreadyRunning(RuntimeError):
+    pass
+
+
+# -------------------------------------------------------------------
+# Archive access (zip or folder), streamed
+# -------------------------------------------------------------------
+
+class FdcArchive:
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        self.is_zip = zipfile.is_zipfile(self.path)
+        # Checkpoints are keyed by the download name, e.g. FoodData_Central_csv_2024-10-31
+        self.source = os.path.splitext(os.path.basename(os.path.normpath(self.path)))[0][:255]
+
+    def _find_member(self, names, filename: str):
+        for name in names:
+            if os.path.basename(name) == filename:
+                return name
+        raise FileNotFoundError(f"{filename} not found in {self.path}")
+
+    @contextmanager
+    def open(self, filename: str):
+        ''' Yields (text reader, binary stream, total bytes). binary.tell() drives progress '''
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as zf:
+                member = self._find_member(zf.namelist(), filename)
+                total = zf.getinfo(member).file_size
+                with zf.open(member) as raw:
+                    yield io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""), raw, total
+        else:
+            names = []
+            for root, _dirs, files in os.walk(self.path):
+                names.extend(os.path.join(root, f) for f in files)
+            member = self._find_member(sorted(names), filename)
+            with open(member, "rb") as raw:
+                yield io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""), raw, os.path.getsize(member)
+
+
+class _Progress:
+    def __init__(self, phase: str, raw, total_bytes: int, rows_done: int):
+        self.phase = phase
+        self.raw = raw
+        self.total_bytes = total_bytes or 1
+        self.rows = rows_done
+        self.started = time.monotonic()
+        self.started_rows = rows_done
+        self.last_report = self.started
+
+    def advance(self, rows: int, force: bool = False):
+        self.rows += rows
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_EVERY_SECS:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-6)
+        pct = min(100.0, 100.0 * self.raw.tell() / self.total_bytes)
+        logger.info(
+            "fdc_bulk_load %s: %d rows (%.1f%%), %.0f rows/s",
+            self.phase, self.rows, pct, (self.rows - self.started_rows) / elapsed,
+        )
+
+
+# -------------------------------------------------------------------
+# Checkpointed phases
+# -------------------------------------------------------------------
+
+def _get_state(db, source: str, phase: str) -> FdcLoadState:
+    state = db.get(FdcLoadState, (source, phase))
+    if state is None:
+        state = FdcLoadState(source=source, phase=phase, rows_done=0, finished=False)
+        db.add(state)
+        db.commit()
+    return state
+
+
+def _run_phase(archive: FdcArchive, phase: str, filename: str, groups_of, flush, batch_size: int):
+    ''' groups_of(csv rows) yields (item, row_count). flush(conn, items) writes one batch.
+        rows_done only ever lands on a group boundary, so resuming never splits a food.
+    '''
+    with SessionLocal() as db:
+        state = _get_state(db, archive.source, phase)
+        if state.finished:
+            logger.info("fdc_bulk_load %s: already finished for %s, skipping", phase, archive.source)
+            return
+        skip = state.rows_done
+
+        with archive.open(filename) as (reader, raw, total_bytes):
+            rows = csv.DictReader(reader)
+            if skip:
+                logger.info("fdc_bulk_load %s: resuming after %d rows", phase, skip)
+                for _ in range(skip):
+                    next(rows, None)
+            progress = _Progress(phase, raw, total_bytes, skip)
+
+            batch, batch_rows = [], 0
+            for item, row_count in groups_of(rows):
+                batch.append(item)
+                batch_rows += row_count
+                if len(batch) >= batch_size:
+                    flush(db.connection(), batch)
+                    state.rows_done += batch_rows
+                    db.commit()
+                    progress.advance(batch_rows)
+                    batch, batch_rows = [], 0
+
+            if batch:
+                flush(db.connection(), batch)
+                state.rows_done += batch_rows
+            state.finished = True
+            db.commit()
+            progress.advance(batch_rows, force=True)
+
+
+def _food_groups(rows):
+    for row in rows:
+        yield {
+            "fdc_id": int(row["fdc_id"]),
+            "data_type": (row.get("data_type") or "")[:32] or None,
+            "Name": (row.get("description") or "").strip()[:255] or f"FDC {row['fdc_id']}",
+            "Serving Size": CATALOG_SERVING_SIZE,
+            "Unit": CATALOG_UNIT,
+        }, 1
+
+
+def _flush_foods(conn, items):
+    # both dialects spell the upsert the same way
+    insert = sqlite_insert if conn.dialect.name == "sqlite" else pg_insert
+    stmt = insert(FoodCatalog.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["fdc_id"],
+        set_={"Name": stmt.excluded["Name"], "data_type": stmt.excluded["data_type"]},
+    )
+    conn.execute(stmt, items)
+
+
+def _nutrient_groups_of(nutrient_columns: dict):
+    ''' Pivot food_nutrient.csv rows into one {column: amount} per food.
+        The file is ordered by fdc_id, so only the current food is ever held in memory.
+        If a food does show up again later its values are merged by the UPDATE anyway.
+    '''
+    def groups_of(rows):
+        current_id, amounts, count = None, {}, 0
+        for row in rows:
+            fdc_id = int(row["fdc_id"])
+            if fdc_id != current_id:
+                if current_id is not None:
+                    yield (current_id, amounts), count
+                current_id, amounts, count = fdc_id, {}, 0
+            count += 1
+            col = nutrient_columns.get(int(row["nutrient_id"]))
+            amount = row.get("amount")
+            if col is None or amount in (None, ""):
+                continue
+            amounts[col] = float(amount)
+        if current_id is not None:
+            yield (current_id, amounts), count
+    return groups_of
+
+
+def _nutrient_update_stmt(columns: tuple, cache: dict):
+    stmt = cache.get(columns)
+    if stmt is None:
+        # Lightweight table clause: columns added by --add-missing-columns aren't on the model
+        table = sa_table("food_catalog", sa_column("fdc_id"), *[sa_column(col) for col in columns])
+        stmt = (
+            update(table)
+            .where(table.c.fdc_id == bindparam("b_fdc_id"))
+            .values({table.c[col]: bindparam(f"b_{i}") for i, col in enumerate(columns)})
+        )
+        cache[columns] = stmt
+    return stmt
+
+
+def _flush_nutrients_with(cache: dict):
+    def flush(conn, items):
+        # executemany needs the same column set per statement, so group foods by it
+        by_columns = {}
+        for fdc_id, amounts in items:
+            if amounts:
+                by_columns.setdefault(tuple(sorted(amounts)), []).append((fdc_id, amounts))
+        for columns, foods in by_columns.items():
+            params = []
+            for fdc_id, amounts in foods:
+                p = {f"b_{i}": amounts[col] for i, col in enumerate(columns)}
+                p["b_fdc_id"] = fdc_id
+                params.append(p)
+            conn.execute(_nutrient_update_stmt(columns, cache), params)
+    return flush
+
+
+def _nutrient_columns(archive: FdcArchive, add_missing_columns: bool) -> dict:
+    ''' FDC nutrient id -> food_catalog column, named like the API importer names them '''
+    existing = {col["name"] for col in inspect(engine).get_columns("food_catalog")}
+    columns, skipped = {}, set()
+    with archive.open("nutrient.csv") as (reader, _raw, _total):
+        for row in csv.DictReader(reader):
+            name = (row.get("name") or "").strip()
+            if not name or is_unwanted_nutrient(name):
+                continue
+            unit = FDC_CSV_UNIT_NAMES.get(row["unit_name"], row["unit_name"])
+            col = fdc_nutrient_column_name(name, unit)
+            if col not in existing:
+                if not add_missing_columns:
+                    skipped.add(col)
+                    continue
+                safe_col = col.replace('"', '""')
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE food_catalog ADD "{safe_col}" NUMERIC(10, 3) NOT NULL DEFAULT 0.000'))
+                existing.add(col)
+                logger.info("fdc_bulk_load: added food_catalog column %s", col)
+            columns[int(row["id"])] = col
+
+    if skipped:
+        logger.info("fdc_bulk_load: %d nutrients have no food_catalog column and are skipped", len(skipped))
+    return columns
+
+
+def _finalize(archive: FdcArchive):
+    with SessionLocal() as db:
+        state = _get_state(db, archive.source, "derived")
+        if state.finished:
+            return
+        derived_nutrients.apply(db, FoodCatalog.__table__)
+        state.finished = True
+        db.commit()
+
+
+# -------------------------------------------------------------------
+# Entry points
+# -------------------------------------------------------------------
+
+def load_archive(path: str, batch_size: int = BATCH_SIZE, add_missing_columns: bool = False, restart: bool = False) -> dict:
+    if not _load_lock.acquire(blocking=False):
+        raise LoadAlreadyRunning("An FDC bulk load is already running")
+    try:
+        archive = FdcArchive(path)
+        started = time.monotonic()
+        Base.metadata.create_all(bind=engine, tables=[FoodCatalog.__table__, FdcLoadState.__table__])
+
+        if restart:
+            with SessionLocal() as db:
+                db.execute(delete(FdcLoadState).where(FdcLoadState.source == archive.source))
+                db.commit()
+
+        logger.info("fdc_bulk_load: loading %s (source %s)", archive.path, archive.source)
+        nutrient_columns = _nutrient_columns(archive, add_missing_columns)
+        _run_phase(archive, "food", "food.csv", _food_groups, _flush_foods, batch_size)
+        _run_phase(
+            archive, "food_nutrient", "food_nutrient.csv",
+            _nutrient_groups_of(nutrient_columns), _flush_nutrients_with({}), batch_size,
+        )
+        _finalize(archive)
+        logger.info("fdc_bulk_load: finished %s in %.1fs", archive.source, time.monotonic() - started)
+        return load_status(archive.source)
+    finally:
+        _load_lock.release()
+
+
+def load_status(source: str | None = None) -> dict:
+    with SessionLocal() as db:
+        query = db.query(FdcLoadState)
+        if source is not None:
+            query = query.filter(FdcLoadState.source == source)
+        states = query.order_by(FdcLoadState.source, FdcLoadState.updated_at).all()
+        result = {}
+        for state in states:
+            result.setdefault(state.source, {})[state.phase] = {
+                "rows_done": state.rows_done,
+                "finished": state.finished,
+                "updated_at": state.updated_at.isoformat() if state.updated_at else None,
+            }
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a USDA FoodData Central CSV download into food_catalog")
+    parser.add_argument("path", help="FoodData_Central_csv_*.zip or its extracted folder")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="foods per commit")
+    parser.add_argument("--add-missing-columns", action="store_true",
+                        help="ALTER TABLE food_catalog for nutrients it has no column for, like the API importer does")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and load from the start")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    load_archive(args.path, batch_size=args.batch_size, add_missing_columns=args.add_missing_columns, restart=args.restart)
+
+
+if __name__ == "__main__":
+    main()
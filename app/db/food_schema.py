@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import select as select_module
+import threading
+
+from fastapi.encoders import decimal_encoder
+from sqlalchemy import Float, Integer, Numeric, inspect, select, text
+from sqlalchemy import table as sa_table, column as sa_column
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from app.db.session import engine, settings
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Live column registry of the foods table
+#
+# The FDC importer adds nutrient columns with ALTER TABLE, so the Food
+# model is only the starting point. The columns are reflected once and
+# cached in a FoodSchema, which also carries the precompiled pieces the
+# request path needs (select, row serializer, scaled nutrient list).
+# After DDL the worker that ran it refreshes right away and tells the
+# other workers with NOTIFY on CHANNEL (Postgres only).
+# -------------------------------------------------------------------
+
+CHANNEL = "evaldiet_food_schema"
+NOT_SCALED = ("user_id", "fdc_id", "Serving Size")
+
+
+def _encoder(col_type):
+    if isinstance(col_type, Numeric) and not isinstance(col_type, Float):
+        return decimal_encoder
+    return None
+
+
+class FoodSchema:
+    ''' Immutable snapshot of the foods columns, in table order '''
+
+    def __init__(self, columns: list, version: int):
+        self.version = version
+        self.names = tuple(name for name, _ in columns)
+        self.types = dict(columns)
+        self.layout = hashlib.sha1("|".join(self.names).encode("utf-8")).hexdigest()[:16]
+        self.table = sa_table("foods", *[sa_column(name, col_type) for name, col_type in columns])
+        # nutrients (and Price) that scale with quantity, as in diets_nutrition
+        self.scaled = tuple(
+            name for name, col_type in columns
+            if name not in NOT_SCALED and isinstance(col_type, (Numeric, Integer))
+        )
+        # user_id is never sent to the client
+        self.output_names = tuple(name for name in self.names if name != "user_id")
+        self._output_columns = [self.table.c[name] for name in self.output_names]
+        encoders = (_encoder(self.types[name]) for name in self.output_names)
+        self._encoders = [(i, enc) for i, enc in enumerate(encoders) if enc is not None]
+
+    def select(self):
+        ''' SELECT of every output column, e.g. schema.select().where(schema.table.c.user_id == 1) '''
+        return select(*self._output_columns)
+
+    def to_values(self, row) -> tuple:
+        ''' JSON-ready values of a select() row, in output_names order '''
+        if not self._encoders:
+            return tuple(row)
+        values = list(row)
+        for i, enc in self._encoders:
+            if values[i] is not None:
+                values[i] = enc(values[i])
+        return tuple(values)
+
+    def to_dict(self, row) -> dict:
+        ''' Same JSON-ready dict model_to_dict + strip_user_id gave for a Food, plus runtime columns '''
+        return dict(zip(self.output_names, self.to_values(row)))
+
+    def to_dicts(self, rows) -> list:
+        return [self.to_dict(row) for row in rows]
+
+
+_lock = threading.Lock()
+_current: FoodSchema | None = None
+
+
+def refresh(bind=None) -> FoodSchema:
+    global _current
+    columns = [(col["name"], col["type"]) for col in inspect(bind or engine).get_columns("foods")]
+    with _lock:
+        previous = _current
+        if previous is not None and previous.names == tuple(name for name, _ in columns):
+            return previous
+        _current = FoodSchema(columns, (previous.version + 1) if previous else 1)
+    if previous is not None:
+        logger.info("food schema: %d -> %d columns", len(previous.names), len(_current.names))
+    return _current
+
+
+def current() -> FoodSchema:
+    return _current or refresh()
+
+
+def announce_change(db: Session):
+    ''' Call in the transaction that ran DDL on foods. Other workers refresh when it commits '''
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("SELECT pg_notify(:channel, 'foods')"), {"channel": CHANNEL})
+
+
+# -------------------------------------------------------------------
+# LISTEN thread
+# -------------------------------------------------------------------
+
+class NotifyListener:
+    ''' LISTEN on `channel` in a thread, reconnecting with backoff. Subclasses handle the payloads '''
+    POLL_SECS = 5.0
+    channel = CHANNEL
+    name = "food-schema-listen"
+
+    def __init__(self, url):
+        self.url = make_url(url)
+        self.dialect = engine.dialect
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def on_connect(self):
+        ''' After (re)connecting: catch up on anything missed while not listening '''
+
+    def on_notify(self, payloads: list):
+        pass
+
+    def _connect(self):
+        cargs, cparams = self.dialect.create_connect_args(self.url)
+        conn = self.dialect.connect(*cargs, **cparams)
+        conn.autocommit = True
+        conn.cursor().execute("LISTEN " + self.channel)
+        return conn
+
+    def _wait(self, conn) -> list:
+        ''' Payloads of the notifications that arrived within POLL_SECS '''
+        if self.dialect.driver == "psycopg":
+            return [notify.payload for notify in conn.notifies(timeout=self.POLL_SECS, stop_after=1)]
+        # psycopg2
+        if select_module.select([conn], [], [], self.POLL_SECS)[0]:
+            conn.poll()
+            payloads = [notify.payload for notify in conn.notifies]
+            conn.notifies.clear()
+            return payloads
+        return []
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                self.on_connect()
+                backoff = 1.0
+                while not self._stop.is_set():
+                    payloads = self._wait(conn)
+                    if payloads:
+                        self.on_notify(payloads)
+            except Exception as exc:
+                logger.warning("%s: %s (retrying in %.0fs)", self.name, exc, backoff)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+class SchemaListener(NotifyListener):
+    def on_connect(self):
+        refresh()
+
+    def on_notify(self, payloads: list):
+        refresh()
+
+
+def listen_url() -> str | None:
+    ''' Where to LISTEN, or None when LISTEN can't work (not Postgres, pooler without DB_LISTEN_URL) '''
+    if engine.dialect.name != "postgresql":
+        return None
+    if settings.DB_PGBOUNCER_MODE and not settings.DB_LISTEN_URL:
+        logger.warning("LISTEN off: DB_PGBOUNCER_MODE needs DB_LISTEN_URL")
+        return None
+    return settings.DB_LISTEN_URL or settings.DATABASE_URL
+
+
+_listener: SchemaListener | None = None
+
+
+def start_listener():
+    ''' Postgres only. Behind a transaction-mode pooler LISTEN needs DB_LISTEN_URL (a direct connection) '''
+    global _listener
+    if not settings.FOOD_SCHEMA_LISTEN or _listener is not None:
+        return
+    url = listen_url()
+    if url is None:
+        return
+    _listener = SchemaListener(url)
+    _listener.start()
+
+
+def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
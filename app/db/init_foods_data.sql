@@ -1,4 +1,4 @@
-INSERT INTO "public"."foods" ("user_id",
+INSERT INTO "foods" ("user_id",
                               "fdc_id",
                               "Name",
                               "Serving Size",
@@ -1,12 +1,15 @@
-from datetime import datetime
+from datetime import date, datetime
 import json
 from typing import Optional
 
 from sqlalchemy import (
     String,
     Integer,
+    BigInteger,
+    Boolean,
     Float,
     Numeric,
+    Date,
     DateTime,
     Text,
     ForeignKey,
@@ -15,6 +18,10 @@ from sqlalchemy import (
     text,
     func,
     Index,
+    Table,
+    Column,
+    LargeBinary,
+    JSON,
 )
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
@@ -22,8 +29,16 @@ from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 # -------------------------------------------------------------------
 # Base
+#
+# Postgres is the main target; the schema also creates on SQLite
+# (embedded mode, see app/db/session.py). JSONB falls back to JSON there
+# and Postgres-only indexes are skipped.
 # -------------------------------------------------------------------
 
+# JSONB on Postgres, JSON (text) elsewhere
+PortableJSON = JSON().with_variant(JSONB(), "postgresql")
+
+
 class Base(DeclarativeBase):
     pass
 
@@ -95,17 +110,22 @@ class User(Base):
     last_login: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
 
     settings: Mapped[dict] = mapped_column(
-        JSONB,
+        PortableJSON,
         nullable=False,
-        server_default=text("'" + DEFAULT_SETTINGS_JSON.replace("'", "''") + "'::jsonb"),
+        # plain string literal: Postgres casts it to jsonb, SQLite stores it as is
+        server_default=text("'" + DEFAULT_SETTINGS_JSON.replace("'", "''") + "'"),
     )
+    # Bumped whenever settings, RDA or UL change, so cached copies (app/user_settings.py) can tell they're stale
+    settings_version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text("0"))
+    # Bumped on every foods write, for the cached ranking indexes (app/food_ranking.py)
+    foods_version: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text("0"))
 
     foods: Mapped[list["Food"]] = relationship(
         back_populates="user", cascade="all, delete-orphan"
     )
 
     __table_args__ = (
-        Index("ix_users_settings_gin", "settings", postgresql_using="gin"),
+        Index("ix_users_settings_gin", "settings", postgresql_using="gin").ddl_if(dialect="postgresql"),
     )
 
 
@@ -250,6 +270,50 @@ class Food(Base):
 
     __mapper_args__ = {"primary_key": [user_id, fdc_id]}
 
+# -------------------------------------------------------------------
+# Custom food ids (app/food_ids.py): the next unused fdc_id below 1000
+# per user, so create_food doesn't need max(fdc_id)
+# -------------------------------------------------------------------
+
+class FoodIdCounter(Base):
+    __tablename__ = "food_id_counters"
+
+    user_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    next_id: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# -------------------------------------------------------------------
+# FDC Catalog (shared, not per user. Filled by app/db/fdc_bulk_load.py)
+# Same nutrient columns as foods, keyed by fdc_id only
+# -------------------------------------------------------------------
+
+class FoodCatalog(Base):
+    __table__ = Table(
+        "food_catalog",
+        Base.metadata,
+        Column("fdc_id", Integer, primary_key=True),
+        Column("data_type", String(32)),
+        *[col._copy() for col in Food.__table__.columns if col.name not in ("user_id", "fdc_id")],
+        Index("ix_food_catalog_name", "Name"),
+    )
+
+
+class FdcLoadState(Base):
+    __tablename__ = "fdc_load_state"
+
+    source: Mapped[str] = mapped_column(String(255), primary_key=True)
+    phase: Mapped[str] = mapped_column(String(32), primary_key=True)
+    rows_done: Mapped[int] = mapped_column(BigInteger, nullable=False, server_default=text("0"))
+    finished: Mapped[bool] = mapped_column(Boolean, nullable=False, server_default=text("false"))
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+
 # -------------------------------------------------------------------
 # Diets
 # -------------------------------------------------------------------
@@ -279,6 +343,106 @@ class Diet(Base):
     __mapper_args__ = {"primary_key": [user_id, diet_name, fdc_id, quantity, sort_order]}
 
 
+# -------------------------------------------------------------------
+# Diet totals (maintained by app/diet_totals.py)
+# One row per diet: summed scaled nutrients packed as float64s, in the
+# column order identified by `layout`
+# -------------------------------------------------------------------
+
+class DietTotal(Base):
+    __tablename__ = "diet_totals"
+
+    user_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    diet_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    layout: Mapped[str] = mapped_column(String(16), nullable=False)
+    items: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text("0"))
+    totals: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+
+# -------------------------------------------------------------------
+# Diet changes (app/diet_changes.py): per diet, numbered edits for
+# clients catching up with GET /api/diets/{name}/changes?since=version
+# -------------------------------------------------------------------
+
+class DietChange(Base):
+    __tablename__ = "diet_changes"
+
+    user_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    diet_name: Mapped[str] = mapped_column(String(255), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    op: Mapped[str] = mapped_column(String(16), nullable=False)
+    payload: Mapped[dict] = mapped_column(PortableJSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+
+# -------------------------------------------------------------------
+# Intake log (app/intake_log.py): what a user actually ate, per day.
+# Each entry keeps the nutrients it had when logged, so later food edits
+# don't rewrite history. On Postgres the table is range partitioned by
+# month of eaten_on; partitions are created on first use.
+# -------------------------------------------------------------------
+
+class IntakeEntry(Base):
+    __tablename__ = "intake_log"
+
+    user_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    eaten_on: Mapped[date] = mapped_column(Date, primary_key=True)
+    entry_no: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    fdc_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    name: Mapped[str] = mapped_column(String(255), nullable=False)
+    quantity: Mapped[float] = mapped_column(Numeric(10, 2), nullable=False)
+    nutrients: Mapped[dict] = mapped_column(PortableJSON, nullable=False)  # {column: scaled amount}, zeros left out
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    __table_args__ = (
+        {"postgresql_partition_by": "RANGE (eaten_on)"},
+    )
+
+
+# -------------------------------------------------------------------
+# Intake rollups: summed intake_log nutrients per day, ISO week and
+# month (period_start is the day, the Monday or the 1st), packed like
+# diet_totals. days = logged days in the period.
+# -------------------------------------------------------------------
+
+class IntakeRollup(Base):
+    __tablename__ = "intake_rollups"
+
+    user_id: Mapped[int] = mapped_column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    period: Mapped[str] = mapped_column(String(8), primary_key=True)  # day, week, month
+    period_start: Mapped[date] = mapped_column(Date, primary_key=True)
+    layout: Mapped[str] = mapped_column(String(16), nullable=False)
+    items: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text("0"))
+    days: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text("0"))
+    totals: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now()
+    )
+
+
 # -------------------------------------------------------------------
 # RDA
 # -------------------------------------------------------------------
@@ -0,0 +1,177 @@
+import logging
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from app.db.session import settings
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Per-request SQL stats
+#
+# QueryStatsMiddleware puts a RequestQueryStats in a ContextVar. Sync
+# handlers run in the anyio threadpool with a copy of the context, so
+# the engine event hooks below see the same object and add to it.
+# -------------------------------------------------------------------
+
+_current_stats: ContextVar["RequestQueryStats | None"] = ContextVar("sql_request_stats", default=None)
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+class RequestQueryStats:
+    __slots__ = ("statements", "seconds", "rows", "by_statement")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.by_statement = {}
+
+    def add(self, statement: str, seconds: float, rows: int):
+        self.statements += 1
+        self.seconds += seconds
+        self.rows += max(rows, 0)
+        self.by_statement[statement] = self.by_statement.get(statement, 0) + 1
+
+    def repeated(self, threshold: int) -> list:
+        return [(stmt, count) for stmt, count in self.by_statement.items() if count > threshold]
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.seconds * 1000:.1f};desc="{self.statements} queries, {self.rows} rows"'
+
+
+def current_stats() -> "RequestQueryStats | None":
+    return _current_stats.get()
+
+
+SLOW_QUERIES = metrics.Counter("evaldiet_db_slow_queries_total", "Statements slower than SQL_SLOW_QUERY_MS")
+N_PLUS_ONE = metrics.Counter("evaldiet_db_repeated_statement_requests_total", "Requests flagged as N+1", ("route",))
+
+
+# -------------------------------------------------------------------
+# Engine hooks
+# -------------------------------------------------------------------
+
+def _explain(cursor, statement: str, parameters, dialect_name: str) -> str:
+    ''' Plan for a slow statement, on the same connection and transaction.
+        A failed EXPLAIN would abort the Postgres transaction, hence the savepoint.
+    '''
+    postgres = dialect_name == "postgresql"
+    prefix = "EXPLAIN " if postgres else "EXPLAIN QUERY PLAN "
+    explain_cursor = cursor.connection.cursor()
+    try:
+        if postgres:
+            explain_cursor.execute("SAVEPOINT sql_explain")
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(" ".join(str(col) for col in row) for row in explain_cursor.fetchall())
+        except Exception as exc:
+            if postgres:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT sql_explain")
+            return f"(EXPLAIN failed: {exc})"
+        if postgres:
+            explain_cursor.execute("RELEASE SAVEPOINT sql_explain")
+        return plan
+    finally:
+        explain_cursor.close()
+
+
+def instrument_engine(engine):
+    slow_secs = settings.SQL_SLOW_QUERY_MS / 1000.0
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append((context, time.perf_counter()))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()[1]
+
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.add(statement, elapsed, getattr(cursor, "rowcount", 0) or 0)
+
+        if slow_secs <= 0 or elapsed < slow_secs:
+            return
+        SLOW_QUERIES.inc()
+        plan = None
+        if settings.SQL_EXPLAIN_SLOW_QUERIES and not executemany and statement.lstrip()[:6].upper().startswith(EXPLAINABLE):
+            try:
+                plan = _explain(cursor, statement, parameters, conn.dialect.name)
+            except Exception as exc:
+                plan = f"(EXPLAIN failed: {exc})"
+        logger.warning(
+            "slow query %.1f ms: %s\n%s",
+            elapsed * 1000, statement, plan or "",
+            extra={"db_ms": round(elapsed * 1000, 1), "statement": statement, "plan": plan},
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute: drop its start time,
+        # or the list grows on a pooled connection for as long as it lives.
+        # Only if it's this statement's: errors on connect, or while fetching rows, pushed nothing
+        conn = context.connection
+        started = conn.info.get("query_started") if conn is not None else None
+        if started and started[-1][0] is context.execution_context:
+            started.pop()
+
+
+# -------------------------------------------------------------------
+# ASGI middleware: Server-Timing header + one structured log line per request
+# -------------------------------------------------------------------
+
+class QueryStatsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestQueryStats()
+        token = _current_stats.set(stats)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and stats.statements:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", stats.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_stats.reset(token)
+            if stats.statements:
+                self._log(scope, stats)
+
+    def _log(self, scope, stats: RequestQueryStats):
+        route = getattr(scope.get("route"), "path", None) or scope.get("path", "")
+        logger.info(
+            "sql %s %s statements=%d db_ms=%.1f rows=%d",
+            scope.get("method", ""), route, stats.statements, stats.seconds * 1000, stats.rows,
+            extra={
+                "route": route,
+                "db_statements": stats.statements,
+                "db_ms": round(stats.seconds * 1000, 1),
+                "db_rows": stats.rows,
+            },
+        )
+        threshold = settings.SQL_N_PLUS_ONE_THRESHOLD
+        if threshold <= 0:
+            return
+        repeated = stats.repeated(threshold)
+        if repeated:
+            N_PLUS_ONE.inc(route=route)
+        for statement, count in repeated:
+            logger.warning(
+                "possible N+1 on %s: statement ran %d times in one request: %s",
+                route, count, statement,
+                extra={"route": route, "repeat_count": count, "statement": statement},
+            )
@@ -0,0 +1,56 @@
+import math
+import time
+
+from app.db.session import settings, read_engine, engine
+
+# -------------------------------------------------------------------
+# Read-your-writes for the read replica
+#
+# A successful write sets a short-lived cookie. While it is present that
+# browser's reads go to the primary, so the replica's replication lag is
+# never visible to the user who just made the change. A cookie (not
+# process memory) so it holds across uvicorn workers and LB targets.
+# -------------------------------------------------------------------
+
+STICKY_COOKIE = "db_primary_until"
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def replica_enabled() -> bool:
+    return read_engine is not engine
+
+
+def prefers_primary(request) -> bool:
+    if not replica_enabled():
+        return True
+    until = request.cookies.get(STICKY_COOKIE)
+    if not until:
+        return False
+    try:
+        return float(until) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") in READ_METHODS or not replica_enabled():
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                window = settings.DATABASE_READ_STICKY_SECS
+                cookie = (
+                    f"{STICKY_COOKIE}={time.time() + window:.3f}; "
+                    f"Max-Age={math.ceil(window)}; Path=/; HttpOnly; SameSite=Lax"
+                )
+                headers = list(message.get("headers", []))
+                headers.append((b"set-cookie", cookie.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -1,15 +1,65 @@
-from sqlalchemy import create_engine
+import logging
+import time
+from threading import Lock
+from typing import Literal
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from pydantic_settings import BaseSettings, SettingsError, SettingsConfigDict
 
+from app.metrics import DB_POOL_CHECKOUT_SECONDS, DB_POOL_CONNECTIONS, register_collector
+
 
 # -------------------------------------------------------------------
 # Settings (inlined config)
 # -------------------------------------------------------------------
 
 class Settings(BaseSettings):
+    # postgresql://... or, for a single-node install, sqlite:///evaldiet.db (embedded, WAL mode)
     DATABASE_URL: str
 
+    # Optional read replica for GET endpoints. After a user writes, their reads
+    # stay on the primary for DATABASE_READ_STICKY_SECS (replication lag)
+    DATABASE_READ_URL: str | None = None
+    DATABASE_READ_STICKY_SECS: float = 5.0
+
+    # Per-request SQL instrumentation (app/db/query_stats.py)
+    SQL_SLOW_QUERY_MS: float = 200.0  # 0 disables the slow query log
+    SQL_EXPLAIN_SLOW_QUERIES: bool = True
+    SQL_N_PLUS_ONE_THRESHOLD: int = 20  # same statement more than this many times in one request
+
+    # Connections opened in lifespan before the first request (app/startup.py)
+    DB_POOL_WARM_CONNECTIONS: int = 1
+
+    # Connection pool
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30.0  # seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # seconds, -1 to never recycle
+    # always: SQLAlchemy pre-ping on every checkout
+    # idle: "SELECT 1" only when the connection sat idle longer than DB_POOL_PRE_PING_IDLE_SECS
+    # off: no liveness check
+    DB_POOL_PRE_PING: Literal["always", "idle", "off"] = "always"
+    DB_POOL_PRE_PING_IDLE_SECS: float = 30.0
+    # Transaction-mode poolers (PgBouncer, Supabase on port 6543) can't keep
+    # server-side prepared statements across transactions. Turns them off for psycopg3.
+    DB_PGBOUNCER_MODE: bool = False
+
+    # Workers LISTEN for foods schema changes (app/db/food_schema.py) and diet edits
+    # (app/diet_events.py). LISTEN needs a session, so behind a transaction-mode
+    # pooler point DB_LISTEN_URL at Postgres directly
+    FOOD_SCHEMA_LISTEN: bool = True
+    DIET_EVENTS_LISTEN: bool = True
+    DB_LISTEN_URL: str | None = None
+
+    # SQLite (embedded mode) only
+    SQLITE_BUSY_TIMEOUT: float = 5.0  # seconds a writer waits for the write lock
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL"] = "NORMAL"  # NORMAL is durable per checkpoint in WAL mode
+    SQLITE_CACHE_MB: int = 64  # page cache per connection
+
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 
@@ -22,13 +72,165 @@ except SettingsError as exc:
 # Engine + Session
 # -------------------------------------------------------------------
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    pool_pre_ping=True,
-)
+class TimedQueuePool(QueuePool):
+    ''' QueuePool that records how long each checkout waited for a connection.
+        engine_name is set per engine by create_app_engine (subclass), so pool.recreate() keeps it
+    '''
+    engine_name = "primary"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            _count(self.engine_name, "timeouts")
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started, engine=self.engine_name)
+
+
+_pool_stats_lock = Lock()
+_pool_stats = {}
+
+
+def _count(name: str, key: str, amount: int = 1):
+    with _pool_stats_lock:
+        _pool_stats[name][key] += amount
+
+
+def is_sqlite(url) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def _engine_kwargs(url: str, name: str) -> dict:
+    kwargs = {
+        "poolclass": type(f"TimedQueuePool_{name}", (TimedQueuePool,), {"engine_name": name}),
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING == "always",
+    }
+    if settings.DB_PGBOUNCER_MODE and make_url(url).get_driver_name() == "psycopg":
+        kwargs["connect_args"] = {"prepare_threshold": None}
+    if is_sqlite(url):
+        # Pooled connections move between the threadpool's threads
+        kwargs["connect_args"] = {"check_same_thread": False, "timeout": settings.SQLITE_BUSY_TIMEOUT}
+        kwargs["pool_pre_ping"] = False  # a local file can't drop the connection
+    return kwargs
+
+
+def _install_sqlite_pragmas(engine):
+    ''' WAL lets readers run while one writer commits; foreign keys are off by default in SQLite '''
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_MB * 1024}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        finally:
+            cursor.close()
+
+
+def _install_pool_events(engine, name: str):
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out = engine.pool.checkedout() if isinstance(engine.pool, QueuePool) else 0
+        with _pool_stats_lock:
+            stats = _pool_stats[name]
+            stats["checkouts"] += 1
+            stats["peak_checked_out"] = max(stats["peak_checked_out"], checked_out)
+
+        if settings.DB_POOL_PRE_PING != "idle":
+            return
+        last_used = connection_record.info.get("checked_in_at")
+        if last_used is None or time.monotonic() - last_used < settings.DB_POOL_PRE_PING_IDLE_SECS:
+            return
+        _count(name, "pings")
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        except Exception as exc:
+            _count(name, "ping_failures")
+            # The pool drops this connection and retries with a fresh one
+            raise DisconnectionError() from exc
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        connection_record.info["checked_in_at"] = time.monotonic()
+
+
+def create_app_engine(url: str, name: str = "primary"):
+    with _pool_stats_lock:
+        _pool_stats[name] = {"checkouts": 0, "peak_checked_out": 0, "timeouts": 0, "pings": 0, "ping_failures": 0}
+    engine = create_engine(url, **_engine_kwargs(url, name))
+    engine.engine_name = name
+    _install_pool_events(engine, name)
+    if is_sqlite(url):
+        _install_sqlite_pragmas(engine)
+    return engine
+
+
+def pool_stats(engine) -> dict:
+    stats = {}
+    pool = engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+        )
+    with _pool_stats_lock:
+        stats.update(_pool_stats.get(engine.engine_name, {}))
+    return stats
+
+
+def log_pool_stats(engine):
+    logging.getLogger(__name__).info(
+        "DB pool stats (%s): %s",
+        engine.engine_name, ", ".join(f"{key}={value}" for key, value in pool_stats(engine).items()),
+    )
+
+
+engine = create_app_engine(settings.DATABASE_URL)
+
+# Optional read replica. Without DATABASE_READ_URL reads use the primary.
+# Embedded SQLite has no replicas: its WAL readers already don't block the writer.
+if settings.DATABASE_READ_URL and not is_sqlite(settings.DATABASE_URL):
+    read_engine = create_app_engine(settings.DATABASE_READ_URL, name="read")
+else:
+    read_engine = engine
+
+engines = [engine] if read_engine is engine else [engine, read_engine]
+
+
+@register_collector
+def collect_pool_stats():
+    for eng in engines:
+        pool = eng.pool
+        if isinstance(pool, QueuePool):
+            DB_POOL_CONNECTIONS.set(pool.size(), engine=eng.engine_name, state="size")
+            DB_POOL_CONNECTIONS.set(pool.checkedout(), engine=eng.engine_name, state="checked_out")
+            DB_POOL_CONNECTIONS.set(pool.checkedin(), engine=eng.engine_name, state="idle")
+            DB_POOL_CONNECTIONS.set(max(pool.overflow(), 0), engine=eng.engine_name, state="overflow")
 
 SessionLocal = sessionmaker(
     autocommit=False,
     autoflush=False,
     bind=engine,
 )
+
+ReadSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=read_engine,
+)
@@ -1,6 +1,6 @@
 import os
 import logging
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, BackgroundTasks
 from sqlalchemy import inspect
 from pydantic import BaseModel
 from sqlalchemy import text
@@ -12,6 +12,11 @@ import app.db.models  # REQUIRED so models are registered
 class DbOpsPassPayload(BaseModel):
     db_ops_pass: str | None = None
 
+class FdcBulkLoadPayload(DbOpsPassPayload):
+    path: str
+    restart: bool = False
+    add_missing_columns: bool = False
+
 def verify_db_ops_pass(provided_pass: str | None):
     expected = os.getenv("DB_OPS_PASS")
     if not expected:
@@ -49,4 +54,34 @@ def create_db_tables(payload: DbOpsPassPayload):
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
-    return {"status": "ok", "message": "Database Tables created with SQLAlchemy models"}
\ No newline at end of file
+    return {"status": "ok", "message": "Database Tables created with SQLAlchemy models"}
+
+@router.post("/api/admin/fdc_bulk_load")
+def fdc_bulk_load_start(payload: FdcBulkLoadPayload, background_tasks: BackgroundTasks):
+    verify_db_ops_pass(payload.db_ops_pass)
+    if not os.path.exists(payload.path):
+        raise HTTPException(status_code=400, detail=f"{payload.path} not found on server")
+
+    from app.db import fdc_bulk_load  # admin only, kept off the startup path
+
+    def run():
+        try:
+            fdc_bulk_load.load_archive(
+                payload.path,
+                add_missing_columns=payload.add_missing_columns,
+                restart=payload.restart,
+            )
+        except Exception:
+            logging.getLogger(__name__).exception("fdc_bulk_load failed")
+
+    background_tasks.add_task(run)
+    return {"status": "started", "source": fdc_bulk_load.FdcArchive(payload.path).source}
+
+@router.post("/api/admin/fdc_bulk_load/status")
+def fdc_bulk_load_status(payload: DbOpsPassPayload):
+    verify_db_ops_pass(payload.db_ops_pass)
+    from app.db import fdc_bulk_load
+    try:
+        return fdc_bulk_load.load_status()
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
@@ -0,0 +1,84 @@
+from decimal import Decimal
+from typing import Callable, NamedTuple
+
+from sqlalchemy import Table, case, cast, literal, update
+from sqlalchemy.orm import Session
+
+# -------------------------------------------------------------------
+# Derived nutrients
+#
+# Columns computed from other columns of the same row. Evaluated as part
+# of the UPDATE that changes their inputs (with_derived), or in bulk for
+# given rows (apply). Rules read stored values, so one rule's output is
+# not another rule's input.
+# -------------------------------------------------------------------
+
+
+class DerivedNutrient(NamedTuple):
+    column: str
+    inputs: tuple
+    formula: Callable  # SQL expressions of the inputs -> SQL expression
+    fill_only: bool = False  # a value written directly (e.g. by FDC) wins over the formula
+
+
+DERIVED_NUTRIENTS = (
+    DerivedNutrient(
+        "Vitamin K, total µg",
+        ("Vitamin K (phylloquinone) µg", "Vitamin K (Menaquinone-4) µg", "Vitamin K (Menaquinone-7) µg"),
+        lambda phylloquinone, mk4, mk7: phylloquinone + mk4 + mk7,
+    ),
+    DerivedNutrient(
+        "Energy kJ",
+        ("Energy kcal",),
+        lambda kcal: kcal * Decimal("4.184"),
+        fill_only=True,
+    ),
+    DerivedNutrient(
+        "Folate, DFE µg",
+        ("Folate, food µg", "Folic acid µg"),
+        lambda food_folate, folic_acid: food_folate + folic_acid * Decimal("1.7"),
+        fill_only=True,
+    ),
+)
+
+
+def _rules_for(table: Table, changed: set | None):
+    for rule in DERIVED_NUTRIENTS:
+        if rule.column not in table.c or any(name not in table.c for name in rule.inputs):
+            continue
+        if changed is not None:
+            if not changed.intersection(rule.inputs):
+                continue
+            if rule.fill_only and rule.column in changed:
+                continue
+        yield rule
+
+
+def with_derived(table: Table, values: dict) -> dict:
+    ''' {column name: value} for an UPDATE, plus the derived columns it affects.
+        Inputs written by the same statement are used as bound values, the others are read from the row.
+    '''
+    result = dict(values)
+    for rule in _rules_for(table, set(values)):
+        args = [
+            cast(literal(values[name]), table.c[name].type) if name in values else table.c[name]
+            for name in rule.inputs
+        ]
+        result[rule.column] = rule.formula(*args)
+    return result
+
+
+def apply(db: Session, table: Table, *where, changed: set | None = None) -> int:
+    ''' Recompute derived columns of the rows matching `where` from their stored values.
+        changed: columns that were just written (only rules using them run);
+        None for a bulk pass, where fill_only rules only fill zeros.
+    '''
+    values = {}
+    for rule in _rules_for(table, changed):
+        expr = rule.formula(*[table.c[name] for name in rule.inputs])
+        if rule.fill_only and changed is None:
+            expr = case((table.c[rule.column] == 0, expr), else_=table.c[rule.column])
+        values[table.c[rule.column]] = expr
+    if not values:
+        return 0
+    return db.execute(update(table).where(*where).values(values)).rowcount
@@ -0,0 +1,96 @@
+import json
+import os
+
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.orm import Session
+
+from app.db.models import DietChange
+
+# -------------------------------------------------------------------
+# Diet change log
+#
+# Every diet edit gets the next version number of its diet and a small
+# payload: the removed item key ("old"), the new scaled row ("row") and the
+# totals that changed. Clients holding version N ask for changes since N
+# instead of refetching the diet. Ops:
+#   create / update / delete   apply "old" and "row"
+#   food                       a food of the diet was edited: "row" is
+#                              the food (unscaled), "totals" the new totals
+#   reset                      many rows changed (rename, delete all,
+#                              respace, food id change): refetch the diet
+# Only the last DIET_CHANGES_KEEP versions per diet are kept.
+# Versions are handed out under a per-diet lock (_lock_versions()), so
+# edits of the same diet that don't lock the same rows (a move and a
+# create, a background respace) can't both take version N + 1.
+# Every change is announced on commit (NOTIFY on CHANNEL, Postgres), so
+# open event streams (app/diet_events.py) push it right away.
+# -------------------------------------------------------------------
+
+DIET_CHANGES_KEEP = int(os.getenv("DIET_CHANGES_KEEP", "200"))
+CHANNEL = "evaldiet_diet_changes"
+
+
+def latest_version(db: Session, user_id: int, diet_name: str) -> int:
+    return db.execute(
+        select(func.max(DietChange.version))
+        .where(DietChange.user_id == user_id, DietChange.diet_name == diet_name)
+    ).scalar() or 0
+
+
+def _lock_versions(db: Session, user_id: int, diet_name: str):
+    ''' Until commit, no other transaction records a change of this diet '''
+    # SQLite has a single writer: the edit's own writes already hold the database lock
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(:user_id, hashtext(:diet_name))"),
+            {"user_id": user_id, "diet_name": diet_name},
+        )
+
+
+def record(db: Session, user_id: int, diet_name: str, op: str, old: dict | None = None, row: dict | None = None, totals: dict | None = None) -> dict:
+    ''' Call in the transaction of the edit, after its writes. Returns the change as served by since() '''
+    _lock_versions(db, user_id, diet_name)
+    version = latest_version(db, user_id, diet_name) + 1
+    payload = {"old": old, "row": row, "totals": totals or {}}
+    db.add(DietChange(user_id=user_id, diet_name=diet_name, version=version, op=op, payload=payload))
+    if version > DIET_CHANGES_KEEP:
+        db.execute(
+            delete(DietChange).where(
+                DietChange.user_id == user_id,
+                DietChange.diet_name == diet_name,
+                DietChange.version <= version - DIET_CHANGES_KEEP,
+            )
+        )
+    announce(db, user_id, diet_name)
+    return {"version": version, "op": op, **payload}
+
+
+def announce(db: Session, user_id: int, diet_name: str):
+    ''' Wake the diet's event streams when this transaction commits: every worker's (NOTIFY), and this one's '''
+    db.info.setdefault("diet_changes", set()).add((user_id, diet_name))
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": CHANNEL, "payload": json.dumps([user_id, diet_name])},
+        )
+
+
+def since(db: Session, user_id: int, diet_name: str, version: int) -> dict:
+    ''' Changes after `version`. reset=True means the client has to refetch the whole diet '''
+    rows = db.execute(
+        select(DietChange)
+        .where(DietChange.user_id == user_id, DietChange.diet_name == diet_name, DietChange.version > version)
+        .order_by(DietChange.version.asc())
+    ).scalars().all()
+    latest = rows[-1].version if rows else latest_version(db, user_id, diet_name)
+    reset = (
+        version > latest
+        or (bool(rows) and rows[0].version != version + 1)  # older versions were pruned
+        or any(row.op == "reset" for row in rows)
+    )
+    return {
+        "diet_name": diet_name,
+        "version": latest,
+        "reset": reset,
+        "changes": [] if reset else [{"version": row.version, "op": row.op, **row.payload} for row in rows],
+    }
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import os
+import threading
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+from app import metrics, diet_changes
+from app.db import food_schema
+from app.db.session import SessionLocal, settings
+
+# -------------------------------------------------------------------
+# Live diet updates (Server-Sent Events)
+#
+# GET /api/diets/{name}/events keeps a stream open per (user, diet) and
+# pushes the diet's changes (app/diet_changes.py) as they commit, each
+# as one event with its version as the event id:
+#   event: change   data: a change, as in GET /api/diets/{name}/changes
+#   event: reset    data: {"version": N}, refetch the diet
+# An edit wakes the streams of its diet: on Postgres every worker LISTENs
+# on diet_changes.CHANNEL and the edit's transaction NOTIFYs it; without
+# the listener (SQLite, one worker) the commit wakes this worker's
+# streams directly. A woken stream reads the changes since the last one
+# it sent, so a missed or doubled wake-up never loses or repeats one.
+# EventSource reconnects with Last-Event-ID and resumes from there.
+# -------------------------------------------------------------------
+
+DIET_EVENTS_MAX_STREAMS = int(os.getenv("DIET_EVENTS_MAX_STREAMS", "1000"))  # per worker
+DIET_EVENTS_PING_SECS = float(os.getenv("DIET_EVENTS_PING_SECS", "15"))
+DIET_EVENTS_RETRY_MS = int(os.getenv("DIET_EVENTS_RETRY_MS", "3000"))
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+class Hub:
+    ''' This worker's open streams by (user_id, diet_name). Woken from any thread '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = {}  # (user_id, diet_name) -> {asyncio.Event: its loop}
+        self._count = 0
+
+    def full(self) -> bool:
+        return self._count >= DIET_EVENTS_MAX_STREAMS
+
+    def subscribe(self, user_id: int, diet_name: str) -> asyncio.Event:
+        wake = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._streams.setdefault((user_id, diet_name), {})[wake] = loop
+            self._count += 1
+            metrics.DIET_EVENT_STREAMS.set(self._count)
+        return wake
+
+    def unsubscribe(self, user_id: int, diet_name: str, wake: asyncio.Event):
+        key = (user_id, diet_name)
+        with self._lock:
+            streams = self._streams.get(key)
+            if streams is None or streams.pop(wake, None) is None:
+                return
+            if not streams:
+                del self._streams[key]
+            self._count -= 1
+            metrics.DIET_EVENT_STREAMS.set(self._count)
+
+    def wake(self, user_id: int, diet_name: str):
+        with self._lock:
+            streams = list(self._streams.get((user_id, diet_name), {}).items())
+        self._set(streams)
+
+    def wake_all(self):
+        with self._lock:
+            streams = [item for streams in self._streams.values() for item in streams.items()]
+        self._set(streams)
+
+    @staticmethod
+    def _set(streams: list):
+        for wake, loop in streams:
+            try:
+                loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:
+                pass  # loop closed, the stream is going away
+
+
+hub = Hub()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session):
+    woken = session.info.pop("diet_changes", ())
+    if _listener is None:
+        for user_id, diet_name in woken:
+            hub.wake(user_id, diet_name)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("diet_changes", None)
+
+
+def _since(user_id: int, diet_name: str, version: int) -> dict:
+    # the primary: a replica may not have the change that woke us yet
+    with SessionLocal() as db:
+        return diet_changes.since(db, user_id, diet_name, version)
+
+
+def _event(name: str, version: int, data: dict) -> str:
+    return f"event: {name}\nid: {version}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Stream:
+    ''' One client's stream. Create it in the endpoint (raises TooManyStreams), then serve events() '''
+
+    def __init__(self, user_id: int, diet_name: str, version: int):
+        if hub.full():
+            raise TooManyStreams()
+        self.user_id = user_id
+        self.diet_name = diet_name
+        self.version = version
+        self._wake = None
+
+    async def _pending(self) -> list:
+        self._wake.clear()  # before reading: a commit during the read wakes us again
+        since = await run_in_threadpool(_since, self.user_id, self.diet_name, self.version)
+        self.version = since["version"]
+        if since["reset"]:
+            return [_event("reset", self.version, {"version": self.version})]
+        return [_event("change", change["version"], change) for change in since["changes"]]
+
+    async def events(self):
+        # subscribed here, not in __init__: a body that is never iterated never unsubscribes
+        self._wake = hub.subscribe(self.user_id, self.diet_name)
+        try:
+            yield f"retry: {DIET_EVENTS_RETRY_MS}\n\n"
+            while True:
+                for chunk in await self._pending():
+                    yield chunk
+                while not self._wake.is_set():
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), DIET_EVENTS_PING_SECS)
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"  # keeps proxies from closing an idle stream
+        finally:
+            hub.unsubscribe(self.user_id, self.diet_name, self._wake)
+
+
+# -------------------------------------------------------------------
+# LISTEN thread (Postgres)
+# -------------------------------------------------------------------
+
+class DietChangesListener(food_schema.NotifyListener):
+    channel = diet_changes.CHANNEL
+    name = "diet-changes-listen"
+
+    def on_connect(self):
+        hub.wake_all()  # edits made while not listening
+
+    def on_notify(self, payloads: list):
+        for payload in set(payloads):
+            try:
+                user_id, diet_name = json.loads(payload)
+            except ValueError:
+                continue
+            hub.wake(user_id, diet_name)
+
+
+_listener: DietChangesListener | None = None
+
+
+def start_listener():
+    global _listener
+    if not settings.DIET_EVENTS_LISTEN or _listener is not None:
+        return
+    url = food_schema.listen_url()
+    if url is None:
+        return
+    _listener = DietChangesListener(url)
+    _listener.start()
+
+
+def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,119 @@
+import json
+
+from sqlalchemy.orm import Session
+
+from app.db import food_schema
+
+# -------------------------------------------------------------------
+# Diet items scaled to their quantity (diets_nutrition rows)
+#
+# A food used to become a dict of its ~130 columns, copied twice more
+# for every diet item (the food with scaled values, then merged into the
+# item). Here a food is one tuple of values in FoodSchema.output_names
+# order (FoodRecords), and a scaled item is one tuple laid out by names
+# shared by all rows (ScaledItems). Dicts or JSON are made only at the
+# response, one row at a time.
+# -------------------------------------------------------------------
+
+
+def _json_array(names: tuple, rows) -> bytes:
+    ''' JSON array of one object per row, as FastAPI sends a list of dicts; one dict exists at a time '''
+    dumps = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode
+    return ("[" + ",".join(dumps(dict(zip(names, row))) for row in rows) + "]").encode("utf-8")
+
+
+class FoodRecords:
+    ''' Foods as value tuples in schema.output_names order, by fdc_id '''
+    __slots__ = ("schema", "by_id")
+
+    def __init__(self, schema: food_schema.FoodSchema, rows):
+        self.schema = schema
+        self.by_id = {}
+        fdc_id_at = schema.output_names.index("fdc_id")
+        for row in rows:
+            values = schema.to_values(row)
+            self.by_id[values[fdc_id_at]] = values
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def json(self) -> bytes:
+        ''' The foods as a JSON array of objects, as schema.to_dicts() would be sent '''
+        return _json_array(self.schema.output_names, self.by_id.values())
+
+
+def load_foods(db: Session, user_id: int, fdc_ids=None) -> FoodRecords:
+    ''' The user's foods, or only `fdc_ids` of them '''
+    schema = food_schema.current()
+    query = schema.select().where(schema.table.c.user_id == user_id).order_by(schema.table.c.fdc_id.asc())
+    if fdc_ids is not None:
+        query = query.where(schema.table.c.fdc_id.in_(set(fdc_ids)))
+    return FoodRecords(schema, db.execute(query))  # rows converted as they are fetched
+
+
+class ScaledItems:
+    ''' Rows of (diet item fields, then food fields but Serving Size), all laid out by `names` '''
+    __slots__ = ("names", "rows")
+
+    def __init__(self, names: tuple, rows: list):
+        self.names = names
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self):
+        ''' Each row as a dict, made as it is asked for '''
+        names = self.names
+        for row in self.rows:
+            yield dict(zip(names, row))
+
+    def dicts(self) -> list:
+        return list(self)
+
+    def json(self) -> bytes:
+        return _json_array(self.names, self.rows)
+
+
+def _layout(schema: food_schema.FoodSchema, item_names: tuple) -> tuple:
+    ''' (row names, where each comes from: ("item", name) or ("food", position), food positions to scale) '''
+    food_at = {name: i for i, name in enumerate(schema.output_names)}
+    names = list(item_names)
+    sources = [("food", food_at[name]) if name in food_at else ("item", name) for name in item_names]
+    for name in schema.output_names:
+        if name != "Serving Size" and name not in item_names:
+            names.append(name)
+            sources.append(("food", food_at[name]))
+    scaled = {food_at[name] for name in schema.scaled if name in food_at}
+    return tuple(names), sources, scaled
+
+
+def scale(diet_items: list, foods: FoodRecords) -> ScaledItems:
+    ''' Diet items (dicts) merged with their food, nutrients scaled from Serving Size to the item quantity '''
+    schema = foods.schema
+    item_names = tuple(diet_items[0]) if diet_items else ()
+    names, sources, scaled = _layout(schema, item_names)
+    serving_at = schema.output_names.index("Serving Size")
+
+    rows = []
+    for diet_entry in diet_items:
+        food = foods.by_id.get(diet_entry.get("fdc_id"))
+        if not food:
+            continue
+        try:
+            serving_size = float(food[serving_at])
+        except (TypeError, ValueError):
+            serving_size = 0.0
+        quantity = float(diet_entry.get("quantity", 0))
+
+        row = []
+        for source, at in sources:
+            if source == "item":
+                row.append(diet_entry.get(at))
+                continue
+            value = food[at]
+            if at in scaled and isinstance(value, (int, float)):
+                value = round((float(value) / serving_size) * quantity, 2) if serving_size > 0 else 0.00
+            row.append(value)
+        rows.append(tuple(row))
+    return ScaledItems(names, rows)
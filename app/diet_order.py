@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.orm import Session
+
+from app.db.models import Diet
+from app.db.session import SessionLocal
+from app import diet_changes
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Sparse diet item ordering
+#
+# diets.sort_order is part of the row key, so renumbering items 1..n
+# after a drag rewrote every row between the old and the new position.
+# Keys are spaced DIET_SORT_GAP apart instead, and a moved item takes a
+# key between its new neighbours (move()): one row update, whatever the
+# size of the diet.
+# Moving into the same spot again and again halves the room there; once
+# a gap drops below DIET_SORT_MIN_GAP the diet is respaced to
+# GAP, 2*GAP, ... in a background thread (schedule_respace()). A move
+# that finds no room at all respaces the diet itself, in its transaction.
+# Respacing records a "reset" diet change, so open clients refetch.
+# New accounts start spaced out (space_user()): the seed files number
+# items 1..n. The page adds items GAP past the last key (sort_gap in
+# the bundle).
+# -------------------------------------------------------------------
+
+SORT_GAP = int(os.getenv("DIET_SORT_GAP", "1024"))
+SORT_MIN_GAP = int(os.getenv("DIET_SORT_MIN_GAP", "16"))
+
+
+def new_key(before: int | None, after: int | None) -> int | None:
+    ''' A key strictly between two neighbours (None: no neighbour on that side), or None when there is no room '''
+    if after is None:
+        return SORT_GAP if before is None else before + SORT_GAP
+    low = 0 if before is None else before
+    if after - low < 2:
+        return None
+    return (low + after) // 2
+
+
+def _items(db: Session, user_id: int, diet_name: str) -> list:
+    ''' (fdc_id, quantity, sort_order, color) of every item in display order, rows locked until commit '''
+    return db.execute(
+        select(Diet.fdc_id, Diet.quantity, Diet.sort_order, Diet.color)
+        .where(Diet.user_id == user_id, Diet.diet_name == diet_name)
+        .order_by(Diet.sort_order.asc())
+        .with_for_update()
+    ).all()
+
+
+def _same(row, fdc_id: int, quantity, sort_order: int) -> bool:
+    return row[0] == fdc_id and float(row[1]) == float(quantity) and row[2] == sort_order
+
+
+def _write_keys(db: Session, user_id: int, diet_name: str, rows: list):
+    ''' Set the keys of `rows` (all items of the diet, in order) to GAP, 2*GAP, ... '''
+    diets = Diet.__table__
+    in_diet = (diets.c.user_id == user_id, diets.c.diet_name == diet_name)
+    # Shift every key above both the old and the new ones first, so no
+    # step of the rewrite collides with a key still in place
+    top = max(max(row[2] for row in rows), len(rows) * SORT_GAP)
+    shift = top - min(row[2] for row in rows) + 1
+    db.execute(update(diets).where(*in_diet).values(sort_order=diets.c.sort_order + shift))
+    db.execute(
+        update(diets)
+        .where(
+            *in_diet,
+            diets.c.fdc_id == bindparam("b_fdc_id"),
+            diets.c.quantity == bindparam("b_quantity"),
+            diets.c.sort_order == bindparam("b_old"),
+        )
+        .values(sort_order=bindparam("b_new")),
+        [
+            {"b_fdc_id": row[0], "b_quantity": row[1], "b_old": row[2] + shift, "b_new": (i + 1) * SORT_GAP}
+            for i, row in enumerate(rows)
+        ],
+    )
+
+
+def move(db: Session, user_id: int, diet_name: str, fdc_id: int, quantity: float, sort_order: int, to_index: int) -> dict | None:
+    ''' Put an item at position `to_index` (0 = first). Call in the edit's transaction; None if the item is gone
+
+    Returns the item's new key, its color, whether the whole diet had to be
+    respaced, and whether the diet should be respaced soon (crowded).
+    '''
+    rows = _items(db, user_id, diet_name)
+    at = next((i for i, row in enumerate(rows) if _same(row, fdc_id, quantity, sort_order)), None)
+    if at is None:
+        return None
+    item = rows.pop(at)
+    to_index = max(0, min(to_index, len(rows)))
+    prev = rows[to_index - 1][2] if to_index > 0 else None
+    following = rows[to_index][2] if to_index < len(rows) else None
+    if to_index == at:
+        return {"sort_order": item[2], "color": item[3], "respaced": False, "crowded": False}
+
+    key = new_key(prev, following)
+    if key is None:
+        rows.insert(to_index, item)
+        _write_keys(db, user_id, diet_name, rows)
+        return {"sort_order": (to_index + 1) * SORT_GAP, "color": item[3], "respaced": True, "crowded": False}
+
+    db.execute(
+        update(Diet)
+        .where(
+            Diet.user_id == user_id,
+            Diet.diet_name == diet_name,
+            Diet.fdc_id == item[0],
+            Diet.quantity == item[1],
+            Diet.sort_order == item[2],
+        )
+        .values(sort_order=key)
+    )
+    gaps = [key - (0 if prev is None else prev)] + ([following - key] if following is not None else [])
+    return {"sort_order": key, "color": item[3], "respaced": False, "crowded": min(gaps) < SORT_MIN_GAP}
+
+
+def _spaced(rows: list) -> bool:
+    return all(row[2] == (i + 1) * SORT_GAP for i, row in enumerate(rows))
+
+
+def respace(db: Session, user_id: int, diet_name: str) -> bool:
+    ''' Spread one diet's keys GAP apart again (keeping the order). False if they already are '''
+    rows = _items(db, user_id, diet_name)
+    if _spaced(rows):
+        return False
+    _write_keys(db, user_id, diet_name, rows)
+    diet_changes.record(db, user_id, diet_name, "reset")
+    return True
+
+
+def space_user(db: Session, user_id: int):
+    ''' Spread the keys of every diet of a new account GAP apart. Records no changes: nobody has the diets open yet '''
+    diet_names = db.execute(select(Diet.diet_name).where(Diet.user_id == user_id).distinct()).scalars().all()
+    for diet_name in diet_names:
+        rows = _items(db, user_id, diet_name)
+        if not _spaced(rows):
+            _write_keys(db, user_id, diet_name, rows)
+
+
+_pending = set()  # (user_id, diet_name) queued or being respaced
+_pending_lock = threading.Lock()
+
+
+def _respace_in_background(user_id: int, diet_name: str):
+    try:
+        with SessionLocal() as db:
+            if respace(db, user_id, diet_name):
+                db.commit()
+    except Exception:
+        logger.exception("respacing diet %r of user %d failed", diet_name, user_id)
+    finally:
+        with _pending_lock:
+            _pending.discard((user_id, diet_name))
+
+
+def schedule_respace(user_id: int, diet_name: str):
+    ''' Respace a diet soon, off the request. Call after the move is committed '''
+    key = (user_id, diet_name)
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    threading.Thread(target=_respace_in_background, args=key, name="diet-respace", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # One-off: space out every diet's keys (e.g. diets created with 1, 2, 3, ...)
+    logging.basicConfig(level=logging.INFO)
+    with SessionLocal() as db:
+        diets = db.execute(select(Diet.user_id, Diet.diet_name).distinct()).all()
+        respaced = 0
+        for user_id, diet_name in diets:
+            respaced += respace(db, user_id, diet_name)
+            db.commit()
+    logger.info("respaced %d of %d diets", respaced, len(diets))
@@ -0,0 +1,360 @@
+import hashlib
+import logging
+import sys
+from array import array
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.db import food_schema
+from app.db.models import Diet, DietTotal
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Materialized diet totals
+#
+# diet_totals keeps, per (user, diet), the sum of every item's scaled
+# nutrients (value / Serving Size * quantity, the same numbers
+# diets_nutrition returns per item) as a packed float64 vector.
+# Diet and food edits add/subtract only the changed items' vectors in the
+# same transaction, so reading totals is a primary key lookup.
+#
+# The vector follows the live foods columns (app/db/food_schema.py). Rows
+# written with another column set are rebuilt when next touched.
+#
+# Backfill existing diets with `python -m app.diet_totals`.
+# -------------------------------------------------------------------
+
+
+class Layout:
+    def __init__(self, schema: food_schema.FoodSchema):
+        self.schema_version = schema.version
+        self.columns = schema.scaled
+        self.key = hashlib.sha1((sys.byteorder + "|" + "|".join(self.columns)).encode("utf-8")).hexdigest()[:16]
+        self.foods = schema.table
+        self.values = [schema.table.c[name] for name in self.columns]
+
+
+_layout: Layout | None = None
+
+
+def current_layout() -> Layout:
+    global _layout
+    schema = food_schema.current()
+    layout = _layout
+    if layout is None or layout.schema_version != schema.version:
+        layout = _layout = Layout(schema)
+    return layout
+
+
+def _zeros(size: int) -> array:
+    return array("d", bytes(8 * size))
+
+
+def pack(values: array) -> bytes:
+    return values.tobytes()
+
+
+def unpack(blob: bytes) -> array:
+    values = array("d")
+    values.frombytes(blob)
+    return values
+
+
+def _per_unit(serving_size, values) -> array:
+    try:
+        serving_size = float(serving_size)
+    except (TypeError, ValueError):
+        serving_size = 0.0
+    if serving_size <= 0:
+        return _zeros(len(values))
+    return array("d", (float(value or 0) / serving_size for value in values))
+
+
+def per_unit_vectors(db: Session, user_id: int, fdc_ids, lock: bool = False) -> dict:
+    ''' {fdc_id: nutrients for a quantity of 1}. lock=True: the food rows stay locked until commit,
+        take `before` for food_changed() this way so a concurrent edit can't change it meanwhile
+    '''
+    fdc_ids = set(fdc_ids)
+    if not fdc_ids:
+        return {}
+    layout = current_layout()
+    foods = layout.foods
+    query = (
+        select(foods.c.fdc_id, foods.c["Serving Size"], *layout.values)
+        .where(foods.c.user_id == user_id, foods.c.fdc_id.in_(fdc_ids))
+    )
+    if lock:
+        query = query.with_for_update()
+    rows = db.execute(query).all()
+    return {row[0]: _per_unit(row[1], row[2:]) for row in rows}
+
+
+def _locked_row(db: Session, user_id: int, diet_name: str) -> DietTotal | None:
+    return db.execute(
+        select(DietTotal)
+        .where(DietTotal.user_id == user_id, DietTotal.diet_name == diet_name)
+        .with_for_update()
+    ).scalar_one_or_none()
+
+
+def _sum_items(db: Session, user_id: int, diet_name: str, layout: Layout) -> tuple:
+    foods = layout.foods
+    rows = db.execute(
+        select(Diet.quantity, foods.c["Serving Size"], *layout.values)
+        .join(foods, (foods.c.user_id == Diet.user_id) & (foods.c.fdc_id == Diet.fdc_id))
+        .where(Diet.user_id == user_id, Diet.diet_name == diet_name)
+    ).all()
+    totals = _zeros(len(layout.columns))
+    for row in rows:
+        quantity = float(row[0])
+        for i, value in enumerate(_per_unit(row[1], row[2:])):
+            totals[i] += value * quantity
+    return len(rows), totals
+
+
+def recompute(db: Session, user_id: int, diet_name: str) -> DietTotal | None:
+    ''' Rebuild one diet's row from its items (or remove it when the diet is empty) '''
+    layout = current_layout()
+    items, totals = _sum_items(db, user_id, diet_name, layout)
+    row = _locked_row(db, user_id, diet_name)
+    if items == 0:
+        if row is not None:
+            db.delete(row)
+        return None
+    if row is None:
+        row = DietTotal(user_id=user_id, diet_name=diet_name)
+        db.add(row)
+    row.layout = layout.key
+    row.items = items
+    row.totals = pack(totals)
+    return row
+
+
+def changed_totals(before: array | None, after: array | None) -> dict:
+    ''' Rounded totals that differ between two vectors, all of them when `before` is unknown '''
+    columns = current_layout().columns
+    if after is None:
+        after = _zeros(len(columns))
+    if before is None or len(before) != len(after):
+        return {name: round(value, 2) for name, value in zip(columns, after)}
+    return {
+        name: round(new, 2)
+        for name, old, new in zip(columns, before, after)
+        if round(new, 2) != round(old, 2)
+    }
+
+
+def recompute_user(db: Session, user_id: int) -> int:
+    diet_names = db.execute(
+        select(Diet.diet_name).where(Diet.user_id == user_id).distinct()
+    ).scalars().all()
+    for diet_name in diet_names:
+        recompute(db, user_id, diet_name)
+    return len(diet_names)
+
+
+def apply_changes(db: Session, user_id: int, diet_name: str, changes: list, vectors: dict | None = None) -> dict:
+    ''' Call after the diets rows were changed, in the same transaction. Returns changed_totals()
+        changes: [(fdc_id, quantity added (negative when removed), items added)]
+        vectors: per_unit_vectors() taken beforehand, needed when the foods are gone already
+    '''
+    row = _locked_row(db, user_id, diet_name)
+    if row is None or row.layout != current_layout().key:
+        row = recompute(db, user_id, diet_name)
+        return changed_totals(None, unpack(row.totals) if row is not None else None)
+    if vectors is None:
+        vectors = per_unit_vectors(db, user_id, [fdc_id for fdc_id, _, _ in changes])
+    before = unpack(row.totals)
+    totals = unpack(row.totals)
+    items = row.items
+    for fdc_id, quantity, count in changes:
+        items += count
+        per_unit = vectors.get(fdc_id)
+        if per_unit is None:
+            continue
+        for i, value in enumerate(per_unit):
+            totals[i] += value * quantity
+    if items <= 0:
+        db.delete(row)
+        return changed_totals(before, None)
+    row.items = items
+    row.totals = pack(totals)
+    return changed_totals(before, totals)
+
+
+def drop(db: Session, user_id: int, diet_name: str):
+    row = _locked_row(db, user_id, diet_name)
+    if row is not None:
+        db.delete(row)
+
+
+def rename(db: Session, user_id: int, old_name: str, new_name: str):
+    ''' update_diet_name_only: move (or merge) the old diet's totals onto the new name '''
+    if old_name == new_name:
+        return
+    key = current_layout().key
+    source = _locked_row(db, user_id, old_name)
+    target = _locked_row(db, user_id, new_name)
+    if source is None or source.layout != key or (target is not None and target.layout != key):
+        if source is not None:
+            db.delete(source)
+            db.flush()
+        recompute(db, user_id, new_name)
+        return
+    if target is None:
+        source.diet_name = new_name
+        return
+    merged = unpack(target.totals)
+    for i, value in enumerate(unpack(source.totals)):
+        merged[i] += value
+    target.items += source.items
+    target.totals = pack(merged)
+    db.delete(source)
+
+
+def _diets_using(db: Session, user_id: int, fdc_id: int) -> list:
+    return db.execute(
+        select(Diet.diet_name, func.sum(Diet.quantity), func.count())
+        .where(Diet.user_id == user_id, Diet.fdc_id == fdc_id)
+        .group_by(Diet.diet_name)
+    ).all()
+
+
+def food_changed(db: Session, user_id: int, fdc_id: int, before: array | None) -> dict:
+    ''' Fan a food's new values out to every diet using it. `before` is its per-unit vector from before the edit,
+        read with per_unit_vectors(lock=True) in the same transaction.
+        Returns {diet name: changed_totals()} of the diets that changed.
+    '''
+    after = per_unit_vectors(db, user_id, [fdc_id]).get(fdc_id)
+    if after is None:
+        return {}
+    delta = None
+    if before is not None and len(before) == len(after):
+        delta = array("d", (a - b for a, b in zip(after, before)))
+    if delta is not None and not any(delta):
+        return {}
+    key = current_layout().key
+    changed = {}
+    for diet_name, _quantity, _count in _diets_using(db, user_id, fdc_id):
+        row = _locked_row(db, user_id, diet_name)
+        if row is None or row.layout != key or delta is None:
+            old = unpack(row.totals) if row is not None and row.layout == key else None
+            row = recompute(db, user_id, diet_name)
+            changed[diet_name] = changed_totals(old, unpack(row.totals) if row is not None else None)
+            continue
+        # The quantities again, now that the totals row is locked: an item edit that
+        # committed meanwhile (update_diet doesn't lock the food) is in the totals already
+        quantity = db.execute(
+            select(func.sum(Diet.quantity))
+            .where(Diet.user_id == user_id, Diet.diet_name == diet_name, Diet.fdc_id == fdc_id)
+        ).scalar()
+        if quantity is None:
+            continue
+        old = unpack(row.totals)
+        totals = unpack(row.totals)
+        quantity = float(quantity)
+        for i, value in enumerate(delta):
+            totals[i] += value * quantity
+        row.totals = pack(totals)
+        changed[diet_name] = changed_totals(old, totals)
+    return changed
+
+
+def food_removed(db: Session, user_id: int, fdc_id: int) -> list:
+    ''' Call before deleting a food, then pass the result to food_deleted() '''
+    vectors = per_unit_vectors(db, user_id, [fdc_id])
+    return [(diet_name, float(quantity), count, vectors) for diet_name, quantity, count in _diets_using(db, user_id, fdc_id)]
+
+
+def food_deleted(db: Session, user_id: int, fdc_id: int, plan: list) -> list:
+    ''' After the food (and by cascade its diet items) is deleted. Returns the names of the diets that changed '''
+    for diet_name, quantity, count, vectors in plan:
+        apply_changes(db, user_id, diet_name, [(fdc_id, -quantity, -count)], vectors=vectors)
+    return [diet_name for diet_name, _, _, _ in plan]
+
+
+def as_dict(diet_name: str, items: int, totals: array, layout: Layout) -> dict:
+    return {
+        "diet_name": diet_name,
+        "items": items,
+        "totals": {name: round(value, 2) for name, value in zip(layout.columns, totals)},
+    }
+
+
+def vector(db: Session, user_id: int, diet_name: str) -> tuple:
+    ''' (items, totals vector in current_layout() order) of one diet, read-only '''
+    layout = current_layout()
+    row = db.execute(
+        select(DietTotal).where(DietTotal.user_id == user_id, DietTotal.diet_name == diet_name)
+    ).scalar_one_or_none()
+    if row is not None and row.layout == layout.key:
+        return row.items, unpack(row.totals)
+    return _sum_items(db, user_id, diet_name, layout)
+
+
+def vectors(db: Session, user_id: int, diet_names: list) -> dict:
+    ''' {diet_name: (items, totals vector)} of several diets, read-only. Diets without items are left out.
+        Materialized rows come in one query; the others are summed together in one more.
+    '''
+    layout = current_layout()
+    result = {}
+    for row in db.execute(
+        select(DietTotal).where(DietTotal.user_id == user_id, DietTotal.diet_name.in_(diet_names))
+    ).scalars().all():
+        if row.layout == layout.key:
+            result[row.diet_name] = (row.items, unpack(row.totals))
+    missing = [name for name in diet_names if name not in result]
+    if missing:
+        foods = layout.foods
+        rows = db.execute(
+            select(Diet.diet_name, Diet.quantity, foods.c["Serving Size"], *layout.values)
+            .join(foods, (foods.c.user_id == Diet.user_id) & (foods.c.fdc_id == Diet.fdc_id))
+            .where(Diet.user_id == user_id, Diet.diet_name.in_(missing))
+        ).all()
+        size = len(layout.columns)
+        for row in rows:
+            items, totals = result.get(row[0]) or (0, _zeros(size))
+            quantity = float(row[1])
+            for i, value in enumerate(_per_unit(row[2], row[3:])):
+                totals[i] += value * quantity
+            result[row[0]] = (items + 1, totals)
+    return result
+
+
+def read(db: Session, user_id: int, diet_name: str | None = None) -> list:
+    ''' Totals of one diet, or all of the user's diets when diet_name is None.
+        Read-only (works on the replica). A diet not materialized yet is summed on the fly.
+    '''
+    query = select(DietTotal).where(DietTotal.user_id == user_id)
+    if diet_name is not None:
+        query = query.where(DietTotal.diet_name == diet_name)
+    layout = current_layout()
+    result = []
+    for row in db.execute(query.order_by(DietTotal.diet_name.asc())).scalars().all():
+        if row.layout == layout.key:
+            result.append(as_dict(row.diet_name, row.items, unpack(row.totals), layout))
+        else:
+            result.append(as_dict(row.diet_name, *_sum_items(db, user_id, row.diet_name, layout), layout))
+    if diet_name is not None and not result:
+        items, totals = _sum_items(db, user_id, diet_name, layout)
+        if items:
+            result.append(as_dict(diet_name, items, totals, layout))
+    return result
+
+
+if __name__ == "__main__":
+    # Backfill / repair: rebuild every diet's totals from its items
+    logging.basicConfig(level=logging.INFO)
+    from app.db.models import Base, User
+    from app.db.session import SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine, tables=[DietTotal.__table__])
+    with SessionLocal() as db:
+        user_ids = db.execute(select(User.id)).scalars().all()
+        diets = 0
+        for user_id in user_ids:
+            diets += recompute_user(db, user_id)
+            db.commit()
+    logger.info("rebuilt totals of %d diets for %d users", diets, len(user_ids))
@@ -0,0 +1,18 @@
+import re
+
+# -------------------------------------------------------------------
+# FoodData Central naming conventions
+# Shared by the per-food API importer and the offline bulk loader
+# -------------------------------------------------------------------
+
+# I don't have those PUFA MUFA TFA SFA data
+FDC_UNWANTED_NUTRIENT_RE = re.compile("^PUFA|^MUFA|^TFA|^SFA|^Water|^Ash")
+
+
+def fdc_nutrient_column_name(name: str, unit_name: str) -> str:
+    ''' foods table column for an FDC nutrient, e.g. "Protein" + "g" -> "Protein g" '''
+    return name + " " + unit_name
+
+
+def is_unwanted_nutrient(name: str) -> bool:
+    return FDC_UNWANTED_NUTRIENT_RE.search(name) is not None
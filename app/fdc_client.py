@@ -0,0 +1,243 @@
+import importlib.util
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# FoodData Central API client
+#
+# One pooled keep-alive httpx.Client (HTTP/2 when `h2` is installed)
+# shared by all requests, with:
+#   - a deadline per lookup (FDC_DEADLINE_SECS), retries included, so a
+#     slow USDA can't hold a worker thread longer than that
+#   - bounded retries with full-jitter backoff on timeouts, connection
+#     errors, 429 and 5xx
+#   - a circuit breaker: after FDC_BREAKER_FAILURES failed lookups in a
+#     row, fail fast for FDC_BREAKER_RESET_SECS, then let one lookup try
+#   - at most FDC_MAX_IN_FLIGHT upstream lookups at once
+#   - single-flight: concurrent lookups of the same fdc_id share one call
+# Errors are FdcError with the HTTP status to answer with; the upstream
+# URL (it carries the API key) never ends up in them.
+# -------------------------------------------------------------------
+
+FDC_API_KEY = os.getenv("FDC_API_KEY")
+FDC_API_BASE_URL = os.getenv("FDC_API_BASE_URL", "https://api.nal.usda.gov/fdc/v1")
+FDC_CONNECT_TIMEOUT_SECS = float(os.getenv("FDC_CONNECT_TIMEOUT_SECS", "2"))
+FDC_READ_TIMEOUT_SECS = float(os.getenv("FDC_READ_TIMEOUT_SECS", "4"))
+FDC_DEADLINE_SECS = float(os.getenv("FDC_DEADLINE_SECS", "8"))
+FDC_RETRIES = int(os.getenv("FDC_RETRIES", "2"))
+FDC_BACKOFF_SECS = float(os.getenv("FDC_BACKOFF_SECS", "0.25"))
+FDC_BREAKER_FAILURES = int(os.getenv("FDC_BREAKER_FAILURES", "5"))
+FDC_BREAKER_RESET_SECS = float(os.getenv("FDC_BREAKER_RESET_SECS", "30"))
+FDC_MAX_IN_FLIGHT = int(os.getenv("FDC_MAX_IN_FLIGHT", "8"))
+
+HTTP2 = importlib.util.find_spec("h2") is not None  # optional: `uv add h2`
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class FdcError(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float | None = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict | None:
+        if self.retry_after is None:
+            return None
+        return {"Retry-After": str(max(1, int(self.retry_after + 0.999)))}
+
+
+class CircuitBreaker:
+    ''' closed -> open after `failures` failures in a row -> one trial call after `reset_secs` '''
+
+    def __init__(self, failures: int, reset_secs: float):
+        self.failures = failures
+        self.reset_secs = reset_secs
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def before_call(self) -> bool:
+        ''' Raises FdcError(503) while open. True: this call is the half-open trial '''
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self._opened_at + self.reset_secs - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                metrics.FDC_SHORT_CIRCUITED.inc(reason="circuit_open")
+                raise FdcError(503, "FoodData Central is unavailable, try again later", retry_after=max(remaining, 1.0))
+            self._trial_running = True  # half open: this call decides
+            return True
+
+    def release_trial(self):
+        ''' The trial call never reached upstream: let the next call be the trial, state unchanged '''
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                if self._opened_at is not None:
+                    logger.info("FDC circuit breaker closed")
+                self._consecutive = 0
+                self._opened_at = None
+                metrics.FDC_CIRCUIT_OPEN.set(0)
+                return
+            self._consecutive += 1
+            if self._opened_at is not None or self._consecutive >= self.failures:
+                if self._opened_at is None:
+                    logger.warning("FDC circuit breaker open after %d failures", self._consecutive)
+                self._opened_at = time.monotonic()
+                metrics.FDC_CIRCUIT_OPEN.set(1)
+
+
+class FdcClient:
+    def __init__(self):
+        self.breaker = CircuitBreaker(FDC_BREAKER_FAILURES, FDC_BREAKER_RESET_SECS)
+        self._slots = threading.BoundedSemaphore(FDC_MAX_IN_FLIGHT)
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._inflight = {}  # fdc_id -> Future
+        self._inflight_lock = threading.Lock()
+
+    def http(self):
+        ''' The pooled client, created on first use: httpx and its SSL context are only needed by the importer '''
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import httpx
+                    self._client = httpx.Client(
+                        http2=HTTP2,
+                        timeout=httpx.Timeout(FDC_READ_TIMEOUT_SECS, connect=FDC_CONNECT_TIMEOUT_SECS),
+                        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60),
+                    )
+        return self._client
+
+    def close(self):
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def prewarm(self):
+        # Any response will do, this is only to get DNS + TLS done before the first import
+        self.http().get(FDC_API_BASE_URL + "/")
+
+    def get_food(self, fdc_id: int) -> dict:
+        ''' /food/{fdc_id} as a dict, raises FdcError '''
+        with self._inflight_lock:
+            future = self._inflight.get(fdc_id)
+            leader = future is None
+            if leader:
+                future = self._inflight[fdc_id] = Future()
+        if not leader:
+            metrics.FDC_COALESCED.inc()
+            try:
+                return future.result(timeout=FDC_DEADLINE_SECS)
+            except TimeoutError:
+                raise FdcError(504, "FoodData Central did not answer in time")
+        try:
+            food = self._fetch(fdc_id)
+            future.set_result(food)
+            return food
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(fdc_id, None)
+
+    def _fetch(self, fdc_id: int) -> dict:
+        if not FDC_API_KEY:
+            raise FdcError(500, "FDC_API_KEY is not configured. Set it in .env file.")
+        trial = self.breaker.before_call()
+        if not self._slots.acquire(timeout=0.5):
+            if trial:
+                self.breaker.release_trial()  # says nothing about upstream, don't leave the trial hanging
+            metrics.FDC_SHORT_CIRCUITED.inc(reason="in_flight")
+            raise FdcError(503, "Too many FoodData Central lookups in progress, try again shortly", retry_after=1.0)
+        try:
+            food = self._fetch_with_retries(fdc_id)
+        except FdcError as exc:
+            # 404 and friends mean USDA is up
+            self.breaker.record(exc.status_code < 500)
+            raise
+        except Exception as exc:
+            # anything else still settles the call, or a half-open trial would never end
+            self.breaker.record(False)
+            logger.exception("FDC lookup of %s failed", fdc_id)
+            raise FdcError(502, f"FoodData Central lookup failed ({type(exc).__name__})") from exc
+        finally:
+            self._slots.release()
+        self.breaker.record(True)
+        return food
+
+    def _fetch_with_retries(self, fdc_id: int) -> dict:
+        import httpx
+
+        deadline = time.monotonic() + FDC_DEADLINE_SECS
+        url = f"{FDC_API_BASE_URL}/food/{fdc_id}"
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            started = time.perf_counter()
+            status = "error"
+            retry_after = None
+            try:
+                resp = self.http().get(
+                    url, params={"api_key": FDC_API_KEY},
+                    timeout=httpx.Timeout(min(FDC_READ_TIMEOUT_SECS, remaining), connect=min(FDC_CONNECT_TIMEOUT_SECS, remaining)),
+                )
+                status = str(resp.status_code)
+                if resp.status_code == 200:
+                    return resp.json()
+                if resp.status_code == 404:
+                    raise FdcError(404, f"FoodData Central has no food {fdc_id}")
+                if resp.status_code not in RETRY_STATUSES:
+                    raise FdcError(502, f"FoodData Central answered {resp.status_code}")
+                failure = FdcError(503, f"FoodData Central answered {resp.status_code}, try again later")
+                retry_after = _retry_after(resp.headers.get("Retry-After"))
+            except httpx.TimeoutException:
+                status = "timeout"
+                failure = FdcError(504, "FoodData Central did not answer in time")
+            except httpx.TransportError as exc:
+                failure = FdcError(503, f"Could not reach FoodData Central ({type(exc).__name__})")
+            except httpx.HTTPError as exc:
+                # DecodingError, TooManyRedirects, ...: retrying won't help
+                raise FdcError(502, f"FoodData Central sent an invalid response ({type(exc).__name__})")
+            except ValueError:
+                failure = FdcError(502, "FoodData Central sent an invalid response")
+            finally:
+                metrics.FDC_UPSTREAM_REQUESTS.inc(status=status)
+                metrics.FDC_UPSTREAM_SECONDS.observe(time.perf_counter() - started, status=status)
+
+            # full jitter, but never past the deadline
+            delay = retry_after if retry_after is not None else random.uniform(0, FDC_BACKOFF_SECS * (2 ** attempt))
+            if attempt >= FDC_RETRIES or time.monotonic() + delay >= deadline - 0.05:
+                failure.retry_after = FDC_BREAKER_RESET_SECS if failure.status_code == 503 else None
+                raise failure
+            attempt += 1
+            metrics.FDC_RETRIES.inc()
+            time.sleep(delay)
+
+
+def _retry_after(value: str | None) -> float | None:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None  # HTTP-date form, use our own backoff
+
+
+client = FdcClient()
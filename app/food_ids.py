@@ -0,0 +1,75 @@
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app.db.models import Food, FoodIdCounter
+
+# -------------------------------------------------------------------
+# fdc_id allocation for custom foods
+#
+# Custom foods get fdc_ids below CUSTOM_FDC_ID_LIMIT (real FoodData
+# Central ids are far above). Each user has a counter row with the next
+# id to hand out; allocate() moves it forward by the number of ids
+# wanted in one UPDATE, which also locks the row until commit, so two
+# concurrent creates can't get the same id. Ids a counter passes over
+# that are taken anyway (seeded foods, fdc_id edits) are skipped.
+# Once the counter reaches the limit, ids freed by deleted foods are
+# reused (a scan, but only then).
+# -------------------------------------------------------------------
+
+CUSTOM_FDC_ID_LIMIT = 1000
+
+
+class FoodIdsExhausted(Exception):
+    pass
+
+
+def _ensure_counter(db: Session, user_id: int):
+    ''' First allocation of a user: start after their highest custom id '''
+    start = (
+        select(func.coalesce(func.max(Food.fdc_id), 0) + 1)
+        .where(Food.user_id == user_id, Food.fdc_id < CUSTOM_FDC_ID_LIMIT)
+        .scalar_subquery()
+    )
+    insert = sqlite_insert if db.get_bind().dialect.name == "sqlite" else pg_insert
+    db.execute(
+        insert(FoodIdCounter).values(user_id=user_id, next_id=start).on_conflict_do_nothing(index_elements=["user_id"])
+    )
+
+
+def _taken(db: Session, user_id: int, start: int, end: int) -> set:
+    return set(db.execute(
+        select(Food.fdc_id).where(Food.user_id == user_id, Food.fdc_id >= start, Food.fdc_id < end)
+    ).scalars())
+
+
+def _reuse(db: Session, user_id: int, count: int, exclude: list) -> list:
+    used = _taken(db, user_id, 1, CUSTOM_FDC_ID_LIMIT).union(exclude)
+    free = [fdc_id for fdc_id in range(1, CUSTOM_FDC_ID_LIMIT) if fdc_id not in used][:count]
+    if len(free) < count:
+        raise FoodIdsExhausted(f"No custom food ids left (at most {CUSTOM_FDC_ID_LIMIT - 1} custom foods)")
+    return free
+
+
+def allocate(db: Session, user_id: int, count: int = 1) -> list:
+    ''' `count` unused custom fdc_ids, ascending. Call in the transaction that inserts the foods '''
+    _ensure_counter(db, user_id)
+    counter = FoodIdCounter.__table__.c
+    ids = []
+    while len(ids) < count:
+        wanted = count - len(ids)
+        db.execute(
+            update(FoodIdCounter).where(counter.user_id == user_id).values(next_id=counter.next_id + wanted)
+        )
+        end = db.execute(select(counter.next_id).where(counter.user_id == user_id)).scalar_one()
+        start = end - wanted
+        if end > CUSTOM_FDC_ID_LIMIT:
+            db.execute(
+                update(FoodIdCounter).where(counter.user_id == user_id).values(next_id=CUSTOM_FDC_ID_LIMIT)
+            )
+            ids += _reuse(db, user_id, wanted, ids)
+            break
+        taken = _taken(db, user_id, start, end)
+        ids += [fdc_id for fdc_id in range(start, end) if fdc_id not in taken]
+    return sorted(ids)
@@ -0,0 +1,180 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from app.db.models import User
+from app import diet_totals
+
+# -------------------------------------------------------------------
+# Per-user food ranking index
+#
+# "Which of my foods has the most protein per dollar / per kcal / per
+# 100 g?" For each (nutrient, basis) asked for, the user's foods are
+# sorted by score once and kept as two parallel arrays (scores
+# ascending, fdc_ids), so a top-k is a slice off either end.
+#
+# Indexes are cached per worker and keyed by users.foods_version, which
+# every food write bumps (bump()). The worker that made the write
+# re-scores just the written foods in the arrays it has (apply());
+# other workers see the new version and rebuild on their next query.
+# -------------------------------------------------------------------
+
+FOOD_RANKING_CACHE_SIZE = int(os.getenv("FOOD_RANKING_CACHE_SIZE", "1000"))
+TOP_K_MAX = 100
+
+# basis: (column, scale), score = nutrient / column * scale
+BASES = {
+    "price": ("Price", 1.0),
+    "kcal": ("Energy kcal", 100.0),
+    "serving": ("Serving Size", 100.0),
+}
+
+
+class FoodRanking:
+    ''' One user's foods and the sorted (nutrient, basis) arrays built so far '''
+
+    def __init__(self, user_id: int, version: int, layout: diet_totals.Layout, rows):
+        self.user_id = user_id
+        self.version = version
+        self.layout = layout
+        self.position = {name: i for i, name in enumerate(layout.columns)}
+        self.foods = {}  # fdc_id -> (name, serving size, values in layout order)
+        for row in rows:
+            self._store(row)
+        self._sorted = {}  # (nutrient, basis) -> (scores ascending, fdc_ids)
+        self._lock = Lock()
+
+    def _store(self, row):
+        fdc_id, name, serving_size = row[0], row[1], row[2]
+        self.foods[fdc_id] = (name, float(serving_size or 0), array("d", (float(v or 0) for v in row[3:])))
+
+    def _score(self, fdc_id: int, nutrient: int, basis: str) -> float | None:
+        food = self.foods.get(fdc_id)
+        if food is None:
+            return None
+        column, scale = BASES[basis]
+        denominator = food[1] if column == "Serving Size" else food[2][self.position[column]]
+        if denominator <= 0:
+            return None
+        return food[2][nutrient] / denominator * scale
+
+    def _arrays(self, nutrient: str, basis: str) -> tuple:
+        key = (nutrient, basis)
+        arrays = self._sorted.get(key)
+        if arrays is None:
+            i = self.position[nutrient]
+            scored = sorted(
+                (score, fdc_id) for fdc_id in self.foods
+                if (score := self._score(fdc_id, i, basis)) is not None
+            )
+            arrays = self._sorted[key] = (array("d", (s for s, _ in scored)), array("q", (f for _, f in scored)))
+        return arrays
+
+    def top(self, nutrient: str, basis: str, k: int, descending: bool = True) -> tuple:
+        ''' ([(fdc_id, score, (name, serving size, values))] best first, foods ranked) '''
+        with self._lock:
+            scores, ids = self._arrays(nutrient, basis)
+            if descending:
+                picked = range(len(ids) - 1, max(len(ids) - k, 0) - 1, -1)
+            else:
+                picked = range(min(k, len(ids)))
+            return [(ids[i], scores[i], self.foods[ids[i]]) for i in picked], len(ids)
+
+    def snapshot(self) -> dict:
+        ''' {fdc_id: (name, serving size, values)} as of now, safe to read while writes are applied '''
+        with self._lock:
+            return dict(self.foods)
+
+    def update(self, version: int, fdc_ids, rows):
+        ''' Re-score `fdc_ids` (rows: their current foods rows, missing ones were deleted) '''
+        with self._lock:
+            old = {}
+            for key in self._sorted:
+                i, basis = self.position[key[0]], key[1]
+                old[key] = {fdc_id: self._score(fdc_id, i, basis) for fdc_id in fdc_ids}
+            for fdc_id in fdc_ids:
+                self.foods.pop(fdc_id, None)
+            for row in rows:
+                self._store(row)
+            for key, (scores, ids) in self._sorted.items():
+                i, basis = self.position[key[0]], key[1]
+                for fdc_id in fdc_ids:
+                    before = old[key][fdc_id]
+                    if before is not None:
+                        at = bisect_left(scores, before)
+                        while ids[at] != fdc_id:
+                            at += 1
+                        del scores[at]
+                        del ids[at]
+                    after = self._score(fdc_id, i, basis)
+                    if after is not None:
+                        at = bisect_right(scores, after)
+                        scores.insert(at, after)
+                        ids.insert(at, fdc_id)
+            self.version = version
+
+
+_cache = OrderedDict()  # user_id -> FoodRanking, least recently used first
+_cache_lock = Lock()
+
+
+def _rows(db: Session, user_id: int, layout: diet_totals.Layout, fdc_ids=None) -> list:
+    foods = layout.foods
+    query = (
+        select(foods.c.fdc_id, foods.c["Name"], foods.c["Serving Size"], *layout.values)
+        .where(foods.c.user_id == user_id)
+    )
+    if fdc_ids is not None:
+        query = query.where(foods.c.fdc_id.in_(fdc_ids))
+    return db.execute(query).all()
+
+
+def get(db: Session, user_id: int, version: int) -> FoodRanking:
+    ''' Ranking index of a user at `version` (users.foods_version as just read) '''
+    layout = diet_totals.current_layout()
+    with _cache_lock:
+        entry = _cache.get(user_id)
+        if entry is not None and entry.version == version and entry.layout is layout:
+            _cache.move_to_end(user_id)
+            return entry
+    entry = FoodRanking(user_id, version, layout, _rows(db, user_id, layout))
+    with _cache_lock:
+        current = _cache.get(user_id)
+        # a concurrent request may have loaded a newer version already
+        if current is None or current.version <= version:
+            _cache[user_id] = entry
+            _cache.move_to_end(user_id)
+        while len(_cache) > FOOD_RANKING_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
+
+
+def bump(db: Session, user_id: int, fdc_ids) -> tuple:
+    ''' Call in the transaction that writes foods; pass the result to apply() after the commit '''
+    db.execute(update(User).where(User.id == user_id).values(foods_version=User.foods_version + 1))
+    version = db.execute(select(User.foods_version).where(User.id == user_id)).scalar_one()
+    return user_id, version, set(fdc_ids)
+
+
+def apply(db: Session, change: tuple):
+    ''' Bring this worker's index up to the committed write, or drop it if it missed another one '''
+    user_id, version, fdc_ids = change
+    with _cache_lock:
+        entry = _cache.get(user_id)
+    if entry is None:
+        return
+    layout = diet_totals.current_layout()
+    if entry.version != version - 1 or entry.layout is not layout:
+        invalidate(user_id)
+        return
+    entry.update(version, fdc_ids, _rows(db, user_id, layout, fdc_ids))
+
+
+def invalidate(user_id: int):
+    with _cache_lock:
+        _cache.pop(user_id, None)
@@ -0,0 +1,313 @@
+import heapq
+import logging
+import math
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from operator import mul
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy import table as sa_table, column as sa_column
+from sqlalchemy.orm import Session
+
+from app.db.models import FdcLoadState
+from app.db.session import engine
+from app import diet_totals, food_ranking
+
+try:
+    import numpy as np  # optional: `uv add numpy`, needed for the catalog index
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# "Foods like this one": nearest neighbors by nutrient profile
+#
+# A food's profile is its nutrients per 100 g of serving size, each
+# divided by that nutrient's RMS over the searched set (so mg and g
+# nutrients weigh alike), as a unit vector; similarity is the cosine.
+# Price is a filter, not a dimension.
+#
+# Your foods: brute force over a matrix cached per user and rebuilt when
+# users.foods_version moves (the ranking index's food snapshot is the
+# source, so no extra query).
+# food_catalog: approximate (IVF). Profiles are clustered with spherical
+# k-means and a search only scores the CATALOG_IVF_PROBES clusters whose
+# centroids are nearest to the query. Built in the background on first
+# use and rebuilt after fdc_bulk_load runs. Needs numpy.
+# -------------------------------------------------------------------
+
+SIMILARITY_CACHE_SIZE = int(os.getenv("SIMILARITY_CACHE_SIZE", "1000"))
+CATALOG_IVF_LISTS = int(os.getenv("CATALOG_IVF_LISTS", "0"))  # 0: about sqrt(catalog size)
+CATALOG_IVF_PROBES = int(os.getenv("CATALOG_IVF_PROBES", "8"))
+SIMILAR_K_MAX = 100
+
+NOT_PROFILE = ("Price", "Energy kJ")  # kJ is kcal again
+MACROS = ("Protein g", "Carbohydrate, by difference g", "Total lipid (fat) g")
+DOMINANCE = ("protein", "carb", "fat")
+
+
+class CatalogNotReady(Exception):
+    def __init__(self, detail: str, status_code: int = 503):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+def dominance(protein: float, carb: float, fat: float) -> str:
+    ''' Macro a food is colored by on the foods page: strictly the largest, else "" '''
+    if protein > carb and protein > fat:
+        return "protein"
+    if carb > protein and carb > fat:
+        return "carb"
+    if fat > protein and fat > carb:
+        return "fat"
+    return ""
+
+
+def profile_columns(columns) -> tuple:
+    return tuple(name for name in columns if name not in NOT_PROFILE)
+
+
+def _per_100(values, serving_size: float):
+    factor = 100.0 / serving_size if serving_size > 0 else 0.0
+    return [value * factor for value in values]
+
+
+def _rms_scales(vectors: list, size: int) -> list:
+    sums = [0.0] * size
+    for vector in vectors:
+        for i, value in enumerate(vector):
+            sums[i] += value * value
+    count = max(len(vectors), 1)
+    return [math.sqrt(total / count) or 1.0 for total in sums]
+
+
+def _unit(vector, scales) -> array | None:
+    scaled = array("d", (value / scale for value, scale in zip(vector, scales)))
+    norm = math.sqrt(sum(map(mul, scaled, scaled)))
+    if norm == 0:
+        return None
+    for i in range(len(scaled)):
+        scaled[i] /= norm
+    return scaled
+
+
+# -------------------------------------------------------------------
+# Your foods (brute force)
+# -------------------------------------------------------------------
+
+class LibraryIndex:
+    def __init__(self, version: int, layout: diet_totals.Layout, foods: dict):
+        self.version = version
+        self.layout = layout
+        self.columns = profile_columns(layout.columns)
+        position = {name: i for i, name in enumerate(layout.columns)}
+        picks = [position[name] for name in self.columns]
+        macros = [position.get(name) for name in MACROS]
+        price = position.get("Price")
+
+        raw = {}
+        for fdc_id, (name, serving_size, values) in foods.items():
+            raw[fdc_id] = (name, serving_size, _per_100([values[i] for i in picks], serving_size), values)
+        self.scales = _rms_scales([vector for _, _, vector, _ in raw.values()], len(self.columns))
+
+        self.ids, self.names, self.dominance, self.price_per_100, rows = [], [], [], [], []
+        self.row_of = {}
+        for fdc_id, (name, serving_size, vector, values) in raw.items():
+            unit = _unit(vector, self.scales)
+            if unit is None:
+                continue  # no nutrients entered, nothing to compare
+            self.row_of[fdc_id] = len(self.ids)
+            self.ids.append(fdc_id)
+            self.names.append(name)
+            self.dominance.append(dominance(*(values[i] if i is not None else 0.0 for i in macros)))
+            self.price_per_100.append(
+                values[price] * 100.0 / serving_size if price is not None and serving_size > 0 and values[price] > 0 else None
+            )
+            rows.append(unit)
+        self.matrix = np.array(rows, dtype=np.float64).reshape(len(rows), len(self.columns)) if np is not None else rows
+
+    def scores(self, query) -> list:
+        if np is not None:
+            return (self.matrix @ np.asarray(query, dtype=np.float64)).tolist()
+        return [sum(map(mul, row, query)) for row in self.matrix]
+
+    def search(self, fdc_id: int, k: int, dominant: str | None, max_price: float | None) -> list:
+        ''' [(similarity, row)] best first, without the food itself '''
+        me = self.row_of[fdc_id]
+        hits = (
+            (score, row) for row, score in enumerate(self.scores(self.matrix[me]))
+            if row != me
+            and (dominant is None or self.dominance[row] == dominant)
+            and (max_price is None or (self.price_per_100[row] is not None and self.price_per_100[row] <= max_price))
+        )
+        return heapq.nlargest(k, hits)
+
+
+_libraries = OrderedDict()  # user_id -> LibraryIndex, least recently used first
+_libraries_lock = threading.Lock()
+
+
+def library(db: Session, user_id: int, version: int) -> LibraryIndex:
+    ''' Similarity index of a user's foods at `version` (users.foods_version as just read) '''
+    ranking = food_ranking.get(db, user_id, version)
+    with _libraries_lock:
+        entry = _libraries.get(user_id)
+        if entry is not None and entry.version == ranking.version and entry.layout is ranking.layout:
+            _libraries.move_to_end(user_id)
+            return entry
+    snapshot_version = ranking.version
+    entry = LibraryIndex(snapshot_version, ranking.layout, ranking.snapshot())
+    with _libraries_lock:
+        current = _libraries.get(user_id)
+        if current is None or current.version <= snapshot_version:
+            _libraries[user_id] = entry
+            _libraries.move_to_end(user_id)
+        while len(_libraries) > SIMILARITY_CACHE_SIZE:
+            _libraries.popitem(last=False)
+    return entry
+
+
+# -------------------------------------------------------------------
+# food_catalog (approximate, IVF)
+# -------------------------------------------------------------------
+
+class CatalogIndex:
+    ''' Spherical k-means lists over the catalog's unit profiles (numpy arrays) '''
+
+    def __init__(self, stamp, columns: tuple, ids, names: list, dominance: list, matrix, scales):
+        self.stamp = stamp
+        self.columns = columns
+        self.ids = ids
+        self.names = names
+        self.dominance = np.array([DOMINANCE.index(d) if d else -1 for d in dominance], dtype=np.int8)
+        self.scales = scales
+        n = len(ids)
+        lists = min(CATALOG_IVF_LISTS or max(1, int(math.sqrt(n))), n)
+        self.centroids = _kmeans(matrix, lists) if n else np.zeros((0, len(columns)))
+        assignment = _nearest(matrix, self.centroids)
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(lists + 1))
+        self.matrix = matrix[self.order].astype(np.float32)
+        self.ids = ids[self.order]
+        self.names = [names[i] for i in self.order]
+        self.dominance = self.dominance[self.order]
+        self.row_of = {int(fdc_id): row for row, fdc_id in enumerate(self.ids)}
+
+    def query_vector(self, per_100: dict):
+        ''' Unit profile of nutrients per 100 g given as {column: amount}, or None '''
+        vector = [float(per_100.get(name) or 0) for name in self.columns]
+        unit = _unit(vector, self.scales)
+        return None if unit is None else np.asarray(unit, dtype=np.float32)
+
+    def search(self, query, k: int, dominant: str | None, exclude: int | None, probes: int) -> list:
+        ''' [(similarity, row)] best first among the `probes` nearest lists '''
+        if not len(self.centroids):
+            return []
+        nearest = np.argsort(-(self.centroids @ query))[:probes]
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in nearest])
+        if dominant is not None:
+            rows = rows[self.dominance[rows] == (DOMINANCE.index(dominant) if dominant else -1)]
+        if exclude is not None:
+            rows = rows[self.ids[rows] != exclude]
+        if rows.size == 0:
+            return []
+        scores = self.matrix[rows] @ query
+        top = np.argpartition(-scores, min(k, rows.size) - 1)[:k] if rows.size > k else np.arange(rows.size)
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(rows[i])) for i in top]
+
+
+def _nearest(matrix, centroids, chunk: int = 65536):
+    out = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk):
+        out[start:start + chunk] = np.argmax(matrix[start:start + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def _kmeans(matrix, lists: int, iterations: int = 10, sample: int = 64):
+    ''' Spherical k-means on a sample of up to `sample` points per list '''
+    rng = np.random.default_rng(0)
+    points = matrix if len(matrix) <= lists * sample else matrix[rng.choice(len(matrix), lists * sample, replace=False)]
+    centroids = points[rng.choice(len(points), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(points, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        centroids = np.where(empty[:, None], centroids, sums / np.where(norms == 0, 1, norms))
+    return centroids
+
+
+def _catalog_stamp(db: Session) -> tuple:
+    ''' Changes whenever fdc_bulk_load writes (it checkpoints every batch) '''
+    return tuple(db.execute(select(func.max(FdcLoadState.updated_at), func.count())).one())
+
+
+def _load_catalog(stamp) -> CatalogIndex:
+    columns = [col["name"] for col in inspect(engine).get_columns("food_catalog")]
+    layout_columns = set(diet_totals.current_layout().columns)
+    profile = profile_columns(name for name in columns if name in layout_columns)
+    catalog = sa_table("food_catalog", *[sa_column(name) for name in ("fdc_id", "Name", "Serving Size", *profile)])
+    macros = [profile.index(name) if name in profile else None for name in MACROS]
+
+    ids, names, dominance_of, vectors = array("q"), [], [], []
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=5000).execute(select(*catalog.c))
+        for row in result:
+            serving_size = float(row[2] or 0)
+            vector = _per_100([float(v or 0) for v in row[3:]], serving_size)
+            if not any(vector):
+                continue
+            ids.append(row[0])
+            names.append(row[1])
+            dominance_of.append(dominance(*(vector[i] if i is not None else 0.0 for i in macros)))
+            vectors.append(vector)
+    raw = np.array(vectors, dtype=np.float64).reshape(len(vectors), len(profile))
+    del vectors
+    scales = np.sqrt((raw ** 2).mean(axis=0)) if len(raw) else np.ones(len(profile))
+    scales[scales == 0] = 1.0
+    unit = raw / scales
+    unit /= np.linalg.norm(unit, axis=1, keepdims=True)
+    return CatalogIndex(stamp, profile, np.asarray(ids, dtype=np.int64), names, dominance_of, unit, scales.tolist())
+
+
+_catalog = None
+_catalog_building = None  # stamp being built
+_catalog_lock = threading.Lock()
+
+
+def _build_catalog(stamp):
+    global _catalog, _catalog_building
+    try:
+        index = _load_catalog(stamp)
+        logger.info("catalog similarity index: %d foods in %d lists", len(index.ids), len(index.centroids))
+        with _catalog_lock:
+            _catalog = index
+    except Exception:
+        logger.exception("catalog similarity index build failed")
+    finally:
+        with _catalog_lock:
+            _catalog_building = None
+
+
+def catalog(db: Session) -> CatalogIndex:
+    ''' The catalog index, started in the background when missing or stale. Raises CatalogNotReady meanwhile '''
+    global _catalog_building
+    if np is None:
+        raise CatalogNotReady("Catalog similarity search needs numpy (uv add numpy)", status_code=501)
+    stamp = _catalog_stamp(db)
+    with _catalog_lock:
+        index = _catalog
+        if index is not None and index.stamp == stamp:
+            return index
+        if _catalog_building is None:
+            _catalog_building = stamp
+            threading.Thread(target=_build_catalog, args=(stamp,), name="catalog-similarity", daemon=True).start()
+    if index is not None:
+        return index  # the previous load answers until the new one is ready
+    raise CatalogNotReady("Catalog similarity index is being built, try again shortly")
@@ -0,0 +1,345 @@
+import calendar
+import logging
+from array import array
+from datetime import date, timedelta
+from threading import Lock
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from app.db.models import IntakeEntry, IntakeRollup
+from app import diet_totals
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Intake log + rollups
+#
+# Entries are dated diet items (fdc_id, quantity) with their scaled
+# nutrients frozen at logging time. Every add/remove also adds/subtracts
+# the entry's vector on its day, ISO week and month rows in
+# intake_rollups, in the same transaction, so a 90 day summary reads a
+# few month/week/day rows (cover()) instead of every entry.
+#
+# Rollups use the diet_totals vector layout. A row written with an
+# older layout is rebuilt from its entries when next touched.
+# Rollup rows are created empty (no layout) with INSERT .. ON CONFLICT
+# DO NOTHING before they are locked, so a missing row can be locked
+# too: two transactions never both find it missing and insert it.
+# -------------------------------------------------------------------
+
+PERIODS = ("day", "week", "month")
+MAX_RANGE_DAYS = 3660
+
+
+def period_start(period: str, day: date) -> date:
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def period_end(period: str, start: date) -> date:
+    ''' First day after the period '''
+    if period == "week":
+        return start + timedelta(days=7)
+    if period == "month":
+        return start + timedelta(days=calendar.monthrange(start.year, start.month)[1])
+    return start + timedelta(days=1)
+
+
+# -------------------------------------------------------------------
+# Postgres partitions (one per month), created on first use
+# -------------------------------------------------------------------
+
+_partitions = set()
+_partitions_lock = Lock()
+
+
+def ensure_partition(db: Session, day: date):
+    bind = db.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+    start = period_start("month", day)
+    if start in _partitions:
+        return
+    with _partitions_lock:
+        if start in _partitions:
+            return
+        name = f"intake_log_{start:%Y_%m}"
+        end = period_end("month", start)
+        # Own autocommit connection: the DDL must not wait on (or roll back with) the request's transaction
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            try:
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF intake_log "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                ))
+            except DBAPIError:
+                # another worker created it at the same moment
+                if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is None:
+                    raise
+        _partitions.add(start)
+
+
+# -------------------------------------------------------------------
+# Entries
+# -------------------------------------------------------------------
+
+def scaled_nutrients(db: Session, user_id: int, fdc_id: int, quantity: float) -> dict | None:
+    ''' {column: amount} of `quantity` of a food, or None when there's no such food '''
+    per_unit = diet_totals.per_unit_vectors(db, user_id, [fdc_id]).get(fdc_id)
+    if per_unit is None:
+        return None
+    columns = diet_totals.current_layout().columns
+    return {name: value * quantity for name, value in zip(columns, per_unit) if value}
+
+
+def _vector(nutrients: dict, layout: diet_totals.Layout) -> array:
+    return array("d", (float(nutrients.get(name) or 0) for name in layout.columns))
+
+
+def next_entry_no(db: Session, user_id: int, day: date) -> int:
+    return (db.execute(
+        select(func.max(IntakeEntry.entry_no))
+        .where(IntakeEntry.user_id == user_id, IntakeEntry.eaten_on == day)
+    ).scalar() or 0) + 1
+
+
+def add(db: Session, user_id: int, day: date, fdc_id: int, name: str, quantity: float, nutrients: dict) -> IntakeEntry:
+    ''' Log an entry and update its rollups. Caller commits '''
+    ensure_partition(db, day)
+    _insert_rollups(db, user_id, [(period, period_start(period, day)) for period in PERIODS])
+    # Lock the day's rollup first (it exists now, even for the day's first entry):
+    # serializes entry_no allocation for the day
+    _locked_rollup(db, user_id, "day", day)
+    entry = IntakeEntry(
+        user_id=user_id, eaten_on=day, entry_no=next_entry_no(db, user_id, day),
+        fdc_id=fdc_id, name=name, quantity=quantity, nutrients=nutrients,
+    )
+    db.add(entry)
+    db.flush()
+    _apply(db, user_id, day, nutrients, 1)
+    return entry
+
+
+def change_quantity(db: Session, entry: IntakeEntry, quantity: float, nutrients: dict):
+    ''' Caller commits '''
+    delta = {name: nutrients.get(name, 0) - entry.nutrients.get(name, 0) for name in set(nutrients).union(entry.nutrients)}
+    entry.quantity = quantity
+    entry.nutrients = nutrients
+    db.flush()
+    _apply(db, entry.user_id, entry.eaten_on, delta, 0)
+
+
+def remove(db: Session, entry: IntakeEntry):
+    ''' Delete an entry and update its rollups. Caller commits '''
+    user_id, day = entry.user_id, entry.eaten_on
+    delta = {name: -value for name, value in entry.nutrients.items()}
+    db.delete(entry)
+    db.flush()
+    _apply(db, user_id, day, delta, -1)
+
+
+def entries(db: Session, user_id: int, start: date, end: date) -> list:
+    ''' Entries with start <= eaten_on < end '''
+    return db.execute(
+        select(IntakeEntry)
+        .where(IntakeEntry.user_id == user_id, IntakeEntry.eaten_on >= start, IntakeEntry.eaten_on < end)
+        .order_by(IntakeEntry.eaten_on.asc(), IntakeEntry.entry_no.asc())
+    ).scalars().all()
+
+
+# -------------------------------------------------------------------
+# Rollups
+# -------------------------------------------------------------------
+
+def _insert_rollups(db: Session, user_id: int, keys: list):
+    ''' Create the missing rollup rows of `keys` [(period, period_start)], empty: the next _apply() rebuilds them '''
+    insert = sqlite_insert if db.get_bind().dialect.name == "sqlite" else pg_insert
+    db.execute(
+        insert(IntakeRollup)
+        .values([
+            {"user_id": user_id, "period": period, "period_start": start, "layout": "", "items": 0, "days": 0, "totals": b""}
+            for period, start in keys
+        ])
+        .on_conflict_do_nothing(index_elements=["user_id", "period", "period_start"])
+    )
+
+
+def _locked_rollup(db: Session, user_id: int, period: str, start: date) -> IntakeRollup | None:
+    return db.execute(
+        select(IntakeRollup)
+        .where(IntakeRollup.user_id == user_id, IntakeRollup.period == period, IntakeRollup.period_start == start)
+        .with_for_update()
+    ).scalar_one_or_none()
+
+
+def _sum_entries(db: Session, user_id: int, start: date, end: date, layout: diet_totals.Layout) -> tuple:
+    ''' (items, logged days, totals) straight from intake_log '''
+    totals = array("d", bytes(8 * len(layout.columns)))
+    items, days = 0, set()
+    rows = db.execute(
+        select(IntakeEntry.eaten_on, IntakeEntry.nutrients)
+        .where(IntakeEntry.user_id == user_id, IntakeEntry.eaten_on >= start, IntakeEntry.eaten_on < end)
+    ).all()
+    for eaten_on, nutrients in rows:
+        items += 1
+        days.add(eaten_on)
+        for i, value in enumerate(_vector(nutrients, layout)):
+            totals[i] += value
+    return items, len(days), totals
+
+
+def rebuild(db: Session, user_id: int, period: str, start: date) -> IntakeRollup | None:
+    layout = diet_totals.current_layout()
+    items, days, totals = _sum_entries(db, user_id, start, period_end(period, start), layout)
+    row = _locked_rollup(db, user_id, period, start)
+    if items == 0:
+        if row is not None:
+            db.delete(row)
+        return None
+    if row is None:
+        _insert_rollups(db, user_id, [(period, start)])
+        row = _locked_rollup(db, user_id, period, start)
+    row.layout = layout.key
+    row.items = items
+    row.days = days
+    row.totals = diet_totals.pack(totals)
+    return row
+
+
+def _apply(db: Session, user_id: int, day: date, delta: dict, items: int):
+    ''' Add a change already written to intake_log to the day's rollups.
+        delta: {column: amount added (negative when removed)}, items: entries added (or -1)
+    '''
+    layout = diet_totals.current_layout()
+    vector = _vector(delta, layout)
+    day_delta = 0  # +1 when the day got its first entry, -1 when it lost its last
+    for period in PERIODS:
+        start = period_start(period, day)
+        row = _locked_rollup(db, user_id, period, start)
+        if row is None or row.layout != layout.key:
+            had_day = period == "day" and row is not None and row.items > 0
+            row = rebuild(db, user_id, period, start)
+            if period == "day":
+                day_delta = int(row is not None) - int(had_day)
+            continue
+        totals = diet_totals.unpack(row.totals)
+        for i, value in enumerate(vector):
+            totals[i] += value
+        row.items += items
+        if period == "day":
+            row.days = 1 if row.items > 0 else 0
+            day_delta = -1 if row.items <= 0 else 0
+        else:
+            row.days += day_delta
+        if row.items <= 0:
+            db.delete(row)
+            continue
+        row.totals = diet_totals.pack(totals)
+
+
+def cover(start: date, end: date) -> list:
+    ''' Fewest (period, period_start) rollups that exactly cover [start, end) '''
+    n = (end - start).days
+    # best[i]: (rollups needed for [start + i, end), first period to take)
+    best = [(0, None)] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        day = start + timedelta(days=i)
+        options = []
+        for period in PERIODS:
+            if period_start(period, day) == day:
+                length = (period_end(period, day) - day).days
+                if i + length <= n:
+                    options.append((best[i + length][0] + 1, period))
+        best[i] = min(options, key=lambda option: option[0])
+    parts = []
+    i = 0
+    while i < n:
+        day = start + timedelta(days=i)
+        period = best[i][1]
+        parts.append((period, day))
+        i += (period_end(period, day) - day).days
+    return parts
+
+
+def rollups(db: Session, user_id: int, period: str, start: date, end: date) -> list:
+    ''' Rollup rows of one period kind starting in [start, end), as dicts. Read-only '''
+    layout = diet_totals.current_layout()
+    result = []
+    rows = db.execute(
+        select(IntakeRollup)
+        .where(
+            IntakeRollup.user_id == user_id, IntakeRollup.period == period,
+            IntakeRollup.period_start >= start, IntakeRollup.period_start < end,
+        )
+        .order_by(IntakeRollup.period_start.asc())
+    ).scalars().all()
+    for row in rows:
+        if row.layout == layout.key:
+            items, days, totals = row.items, row.days, diet_totals.unpack(row.totals)
+        else:
+            items, days, totals = _sum_entries(db, user_id, row.period_start, period_end(period, row.period_start), layout)
+        result.append({
+            "period": period,
+            "period_start": row.period_start.isoformat(),
+            "items": items,
+            "days": days,
+            "totals": {name: round(value, 2) for name, value in zip(layout.columns, totals)},
+        })
+    return result
+
+
+def summary(db: Session, user_id: int, start: date, end: date) -> tuple:
+    ''' (items, logged days, totals vector, rollup rows read) for [start, end). Read-only '''
+    layout = diet_totals.current_layout()
+    parts = cover(start, end)
+    totals = array("d", bytes(8 * len(layout.columns)))
+    items = days = 0
+    by_period = {}
+    for period, part_start in parts:
+        by_period.setdefault(period, []).append(part_start)
+    for period, starts in by_period.items():
+        rows = db.execute(
+            select(IntakeRollup).where(
+                IntakeRollup.user_id == user_id, IntakeRollup.period == period,
+                IntakeRollup.period_start.in_(starts),
+            )
+        ).scalars().all()
+        for row in rows:
+            if row.layout == layout.key:
+                row_items, row_days, row_totals = row.items, row.days, diet_totals.unpack(row.totals)
+            else:
+                row_items, row_days, row_totals = _sum_entries(
+                    db, user_id, row.period_start, period_end(period, row.period_start), layout
+                )
+            items += row_items
+            days += row_days
+            for i, value in enumerate(row_totals):
+                totals[i] += value
+    return items, days, totals, len(parts)
+
+
+if __name__ == "__main__":
+    # Repair: rebuild every rollup from intake_log
+    logging.basicConfig(level=logging.INFO)
+    from app.db.session import SessionLocal
+
+    with SessionLocal() as db:
+        keys = set()
+        for user_id, eaten_on in db.execute(select(IntakeEntry.user_id, IntakeEntry.eaten_on).distinct()).all():
+            for period in PERIODS:
+                keys.add((user_id, period, period_start(period, eaten_on)))
+        for user_id, period, start in db.execute(
+            select(IntakeRollup.user_id, IntakeRollup.period, IntakeRollup.period_start)
+        ).all():
+            keys.add((user_id, period, start))
+        for user_id, period, start in sorted(keys):
+            rebuild(db, user_id, period, start)
+        db.commit()
+    logger.info("rebuilt %d intake rollups", len(keys))
@@ -1,7 +1,7 @@
+from app import startup  # first, so startup.IMPORT_STARTED is before the heavy imports
 from contextlib import asynccontextmanager
 from random import random
 import string
-import traceback
 import logging
 import os
 import base64
@@ -11,35 +11,42 @@ import time
 from collections import deque
 from threading import Lock
 import json
+import asyncio
+import csv
+import io
+from datetime import date, timedelta
 
-import httpx
 from dotenv import load_dotenv
 import signal
 import random
 
-from fastapi import FastAPI, HTTPException, Request, Depends, Response, requests, Form
+from fastapi import FastAPI, HTTPException, Request, Depends, Response, requests, Form, Query
 from fastapi.encoders import jsonable_encoder
 from fastapi.params import Body
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 
-from fastapi.staticfiles import StaticFiles
 from app.models import *
 import app.db_routes as db_routes
-from app.db.session import SessionLocal, engine
-from app.db.models import User, Food, Diet, RDA, UL, DEFAULT_SETTINGS
+from app.db.session import SessionLocal, ReadSessionLocal, engine, engines, settings, log_pool_stats
+from app.db import query_stats, read_routing, food_schema
+from app.db.models import User, Food, Diet, RDA, UL, IntakeEntry, DEFAULT_SETTINGS
+from app.fdc import is_unwanted_nutrient, fdc_nutrient_column_name
+from app import metrics, diet_totals, diet_changes, derived_nutrients, user_settings, intake_log, fdc_client, admission, food_ranking, food_similarity, food_ids, diet_order, diet_events, diet_nutrition
+from app.assets import AssetManifest, StaticAssets
 from sqlalchemy import select, update, delete, func, text
 from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 import re
 
 load_dotenv()  # loads .env from current working directory
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-FDC_API_KEY = os.getenv("FDC_API_KEY")
-
-FDC_RATE_LIMIT_WINDOW_SECS = 60
-FDC_RATE_LIMIT_MAX_CALLS = 1
+FDC_RATE_LIMIT_WINDOW_SECS = int(os.getenv("FDC_RATE_LIMIT_WINDOW_SECS", 60))
+FDC_RATE_LIMIT_MAX_CALLS = int(os.getenv("FDC_RATE_LIMIT_MAX_CALLS", 1))
+BUNDLE_MAX_CONNECTIONS = int(os.getenv("BUNDLE_MAX_CONNECTIONS", 3)) #pooled connections one bundle request uses at once
 _fdc_calls_by_ip = {}
 _fdc_calls_lock = Lock()
 
@@ -50,29 +57,63 @@ def enforce_fdc_rate_limit(ip: str):
         while q and (now - q[0]) > FDC_RATE_LIMIT_WINDOW_SECS:
             q.popleft()
         if len(q) >= FDC_RATE_LIMIT_MAX_CALLS:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded. Only 1 request per minute is allowed. Try later.")
+            metrics.RATE_LIMIT_REJECTIONS.inc(limiter="fdc")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded. Only {FDC_RATE_LIMIT_MAX_CALLS} request(s) per {FDC_RATE_LIMIT_WINDOW_SECS} seconds is allowed. Try later.",
+            )
         q.append(now)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     ''' Run at startup
-        Initialize the Client and add it to app.state
+        Warm templates and the DB pool so the first request doesn't pay for them
     '''
-    # One client + one connection pool for the whole app lifetime
-    app.state.httpx_client = httpx.Client(
-        timeout=10.0,
-        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
-    )
+    with startup.timings.phase("lifespan"):
+        metrics.start_multiprocess_sync()
+        static_assets.compress_in_background()
+        food_schema.start_listener()
+        diet_events.start_listener()
+        if startup.STARTUP_WARMUP:
+            pool_warms = [startup.warm_pool_in_background(eng, settings.DB_POOL_WARM_CONNECTIONS) for eng in engines]
+            with startup.timings.phase("templates"):
+                startup.precompile_templates(templates.env)
+            with startup.timings.phase("food_schema"):
+                try:
+                    food_schema.refresh()
+                except Exception as exc:
+                    logger.warning("startup: food schema reflection failed: %s", exc)
+            with startup.timings.phase("db_pool"):
+                for pool_warm in pool_warms:
+                    try:
+                        pool_warm.result(timeout=30)
+                    except Exception as exc:
+                        logger.warning("startup: DB pool warm-up failed: %s", exc)
+    if startup.FDC_PREWARM:
+        startup.start_background("fdc_prewarm", fdc_client.client.prewarm)
+    startup.timings.report()
     yield
 
     ''' Run on shutdown
         Close the connections
     '''
-    app.state.httpx_client.close()
-    engine.dispose()
+    fdc_client.client.close()
+    metrics.stop_multiprocess_sync()
+    food_schema.stop_listener()
+    diet_events.stop_listener()
+    for eng in engines:
+        log_pool_stats(eng)
+        eng.dispose()
     # os.kill(os.getpid(), signal.SIGINT)  
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(admission.AdmissionMiddleware)  # innermost: shed 503s still reach the metrics
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(query_stats.QueryStatsMiddleware)
+app.add_middleware(startup.FirstResponseTimer)
+app.add_middleware(read_routing.ReadYourWritesMiddleware)
+for eng in engines:
+    query_stats.instrument_engine(eng)
 
 def random_alphanumeric(length: int = 6) -> str:
     chars = string.ascii_uppercase + string.digits
@@ -121,16 +162,21 @@ def get_db():
     finally:
         db.close()
 
+# Everything but the settings JSON, which comes from user_settings' cache
+_AUTH_COLUMNS = [col for col in User.__table__.columns if col.name != "settings"]
+
 def verify_auth_token_get_user(request: Request, db: Session = Depends(get_db)) -> dict:
     auth_token = request.cookies.get("auth_token")
 
     if auth_token:
         try:
-            user = db.execute(
-                select(User).where(User.hashed_password == auth_token).limit(1)
-            ).scalar_one_or_none()
-            if user is not None:
-                return model_to_dict(user)
+            row = db.execute(
+                select(*_AUTH_COLUMNS).where(User.hashed_password == auth_token).limit(1)
+            ).first()
+            if row is not None:
+                values = jsonable_encoder(row._asdict())
+                values["settings"] = user_settings.get(db, values["id"], values["settings_version"]).settings
+                return {col.name: values[col.name] for col in User.__table__.columns}
         except Exception:
             pass
 
@@ -140,12 +186,36 @@ def verify_auth_token_get_user(request: Request, db: Session = Depends(get_db))
         headers={"Location": "/ui/login"},
     )
 
+def read_session_factory(request: Request):
+    return SessionLocal if read_routing.prefers_primary(request) else ReadSessionLocal
+
+def get_read_db(request: Request):
+    ''' Session on the read replica (DATABASE_READ_URL), or the primary right after this browser wrote '''
+    db = read_session_factory(request)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def verify_auth_token_get_user_read(request: Request, db: Session = Depends(get_read_db)) -> dict:
+    try:
+        return verify_auth_token_get_user(request, db)
+    except HTTPException:
+        if not read_routing.replica_enabled():
+            raise
+        # A token that was just changed may not have reached the replica yet
+        with SessionLocal() as primary_db:
+            return verify_auth_token_get_user(request, primary_db)
+
 app.include_router(db_routes.router)
 
-# serve /static/...
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
+# serve /static/... (fingerprinted URLs via static_url() in templates)
+static_assets = AssetManifest("app/static")
+app.mount("/static", StaticAssets(static_assets), name="static")
 templates = Jinja2Templates(directory="app/templates")
+startup.configure_template_cache(templates.env)
 templates.env.globals["rand_id"] = random_alphanumeric
+templates.env.globals["static_url"] = static_assets.url
 
 @app.get("/")
 def root(request: Request, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
@@ -166,6 +236,10 @@ def root(request: Request, user: dict = Depends(verify_auth_token_get_user), db:
         return RedirectResponse(url=f"/ui/diets?diet_name={diet_name}")
     return RedirectResponse(url="/ui/foods")
 
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/ui/test")
 def test(request: Request):
     return templates.TemplateResponse("test.html", {"request": request})
@@ -210,6 +284,33 @@ def test_hash(password: str):
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
+SEED_FILES = ("init_foods_data.sql", "init_diets_data.sql", "init_rdas_data.sql", "init_ul_data.sql")
+_seed_statements = {}
+
+def seed_statements(filename: str) -> list:
+    ''' Statements of an app/db seed file, parsed once, with the xx user id placeholder as a :user_id parameter '''
+    statements = _seed_statements.get(filename)
+    if statements is None:
+        path = os.path.join("app", "db", filename)
+        statements = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as handle:
+                sql_blob = handle.read()
+            for stmt in sql_blob.split(";"):
+                stmt = stmt.strip()
+                if stmt:
+                    statements.append(text(re.sub(r"(\(\s*)xx(\s*,)", r"\g<1>:user_id\g<2>", stmt)))
+        _seed_statements[filename] = statements
+    return statements
+
+def seed_user_data(db: Session, user_id: int):
+    ''' Starter foods, diets, RDA and UL for a new account. Plain INSERTs, so they run on Postgres and SQLite '''
+    for filename in SEED_FILES:
+        for stmt in seed_statements(filename):
+            db.execute(stmt, {"user_id": user_id})
+    #seed diets number their items 1, 2, 3, ...: space them out, or the first drag respaces the diet
+    diet_order.space_user(db, user_id)
+
 @app.post("/api/register")
 def register_submit(
     request: Request,
@@ -235,41 +336,8 @@ def register_submit(
         db.flush()  # assign PK without committing so entire registration can roll back
         user_id = new_user.id
 
-        init_foods_path = os.path.join("app", "db", "init_foods_data.sql")
-        if os.path.exists(init_foods_path):
-            with open(init_foods_path, "r", encoding="utf-8") as handle:
-                sql_blob = handle.read()
-            statements = [stmt.strip() for stmt in sql_blob.split(";") if stmt.strip()]
-            for stmt in statements:
-                stmt = re.sub(r"(\(\s*)xx(\s*,)", rf"\g<1>{user_id}\g<2>", stmt)
-                db.execute(text(stmt))
-
-        init_diets_path = os.path.join("app", "db", "init_diets_data.sql")
-        if os.path.exists(init_diets_path):
-            with open(init_diets_path, "r", encoding="utf-8") as handle:
-                sql_blob = handle.read()
-            statements = [stmt.strip() for stmt in sql_blob.split(";") if stmt.strip()]
-            for stmt in statements:
-                stmt = re.sub(r"(VALUES\s*\(\s*)xx(\s*,)", rf"\g<1>{user_id}\g<2>", stmt)
-                db.execute(text(stmt))
-
-        init_rdas_path = os.path.join("app", "db", "init_rdas_data.sql")
-        if os.path.exists(init_rdas_path):
-            with open(init_rdas_path, "r", encoding="utf-8") as handle:
-                sql_blob = handle.read()
-            statements = [stmt.strip() for stmt in sql_blob.split(";") if stmt.strip()]
-            for stmt in statements:
-                stmt = re.sub(r"(VALUES\s*\(\s*)xx(\s*,)", rf"\g<1>{user_id}\g<2>", stmt)
-                db.execute(text(stmt))
-
-        init_ul_path = os.path.join("app", "db", "init_ul_data.sql")
-        if os.path.exists(init_ul_path):
-            with open(init_ul_path, "r", encoding="utf-8") as handle:
-                sql_blob = handle.read()
-            statements = [stmt.strip() for stmt in sql_blob.split(";") if stmt.strip()]
-            for stmt in statements:
-                stmt = re.sub(r"(VALUES\s*\(\s*)xx(\s*,)", rf"\g<1>{user_id}\g<2>", stmt)
-                db.execute(text(stmt))
+        seed_user_data(db, user_id)
+        diet_totals.recompute_user(db, user_id)
 
         db.commit()
     except HTTPException:
@@ -359,19 +427,10 @@ def update_profile_page(request: Request, user: dict = Depends(verify_auth_token
 
 
 @app.get("/api/users/me")
-def get_me(user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
-    try:
-        db_user = db.execute(
-            select(User).where(User.id == user["id"]).limit(1)
-        ).scalar_one_or_none()
-        if db_user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-        user_dict = model_to_dict(db_user)
-        user_dict.pop("hashed_password", None)
-    except HTTPException:
-        raise
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=str(exc))
+def get_me(user: dict = Depends(verify_auth_token_get_user_read)):
+    # the auth dependency just read the row, settings come from the cache
+    user_dict = dict(user)
+    user_dict.pop("hashed_password", None)
     return JSONResponse(user_dict)
 
 
@@ -438,8 +497,10 @@ def update_me(payload: dict = Body(...), user: dict = Depends(verify_auth_token_
             db_user.hashed_password = updates["hashed_password"]
         if "settings" in updates:
             db_user.settings = updates["settings"]
+            user_settings.bump(db, user_id)
 
         db.commit()
+        user_settings.invalidate(user_id)
     except HTTPException:
         raise
     except Exception as exc:
@@ -470,7 +531,9 @@ def reset_user_settings(user: dict = Depends(verify_auth_token_get_user), db: Se
         if db_user is None:
             raise HTTPException(status_code=404, detail="User not found")
         db_user.settings = default_settings
+        user_settings.bump(db, user_id)
         db.commit()
+        user_settings.invalidate(user_id)
         return JSONResponse({"settings": default_settings}, status_code=200)
     except HTTPException:
         raise
@@ -479,22 +542,138 @@ def reset_user_settings(user: dict = Depends(verify_auth_token_get_user), db: Se
 
 @app.get("/api/foods")
 @app.get("/api/foods/{fdc_id}")
-def get_foods(fdc_id: int | None = None, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def get_foods(fdc_id: int | None = None, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
     user_id = user["id"]
     try:
+        schema = food_schema.current()
+        foods = schema.table
         if fdc_id is None:
             rows = db.execute(
-                select(Food)
-                .where(Food.user_id == user_id)
-                .order_by(Food.fdc_id.asc())
-            ).scalars().all()
-            return strip_user_id([model_to_dict(row) for row in rows])
+                schema.select()
+                .where(foods.c.user_id == user_id)
+                .order_by(foods.c.fdc_id.asc())
+            ).all()
+            return schema.to_dicts(rows)
         row = db.execute(
-            select(Food).where(Food.fdc_id == fdc_id, Food.user_id == user_id)
-        ).scalar_one_or_none()
+            schema.select().where(foods.c.fdc_id == fdc_id, foods.c.user_id == user_id)
+        ).one_or_none()
         if row is None:
             raise HTTPException(status_code=404, detail="Food not found")
-        return strip_user_id(model_to_dict(row))
+        return schema.to_dict(row)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.get("/api/food_ranking")
+def rank_foods(
+    nutrient: str,
+    per: str = "price",
+    k: int = 10,
+    order: str = "desc",
+    user: dict = Depends(verify_auth_token_get_user_read),
+    db: Session = Depends(get_read_db),
+):
+    ''' Top-k foods by nutrient per Price (1), per 100 Energy kcal or per 100 of Serving Size '''
+    if per not in food_ranking.BASES:
+        raise HTTPException(status_code=400, detail=f"per must be one of: {', '.join(food_ranking.BASES)}")
+    if order not in ("desc", "asc"):
+        raise HTTPException(status_code=400, detail="order must be desc or asc")
+    if not 1 <= k <= food_ranking.TOP_K_MAX:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {food_ranking.TOP_K_MAX}")
+    try:
+        ranking = food_ranking.get(db, user["id"], user["foods_version"])
+        if nutrient not in ranking.position:
+            raise HTTPException(status_code=400, detail=f"Unknown nutrient: {nutrient}")
+        top, ranked = ranking.top(nutrient, per, k, descending=order == "desc")
+        column = food_ranking.BASES[per][0]
+        foods = []
+        for fdc_id, score, (name, serving_size, values) in top:
+            foods.append({
+                "fdc_id": fdc_id,
+                "name": name,
+                "score": round(score, 4),
+                nutrient: round(values[ranking.position[nutrient]], 3),
+                column: serving_size if column == "Serving Size" else round(values[ranking.position[column]], 3),
+            })
+        return {"nutrient": nutrient, "per": per, "order": order, "ranked": ranked, "foods": foods}
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.get("/api/foods/{fdc_id}/similar")
+def similar_foods(
+    fdc_id: int,
+    k: int = 10,
+    source: str = "library",
+    dominant: str | None = None,
+    cheaper: bool = False,
+    max_price: float | None = None,
+    user: dict = Depends(verify_auth_token_get_user_read),
+    db: Session = Depends(get_read_db),
+):
+    ''' Foods with the nutrient profile closest to fdc_id, from your foods (source=library) or food_catalog.
+        dominant: protein|carb|fat|same, cheaper / max_price: Price per 100 of Serving Size (your foods only)
+    '''
+    if source not in ("library", "catalog"):
+        raise HTTPException(status_code=400, detail="source must be library or catalog")
+    if dominant is not None and dominant not in (*food_similarity.DOMINANCE, "same"):
+        raise HTTPException(status_code=400, detail="dominant must be protein, carb, fat or same")
+    if not 1 <= k <= food_similarity.SIMILAR_K_MAX:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {food_similarity.SIMILAR_K_MAX}")
+    if source == "catalog" and (cheaper or max_price is not None):
+        raise HTTPException(status_code=400, detail="food_catalog has no prices")
+    try:
+        index = food_similarity.library(db, user["id"], user["foods_version"])
+        row = index.row_of.get(fdc_id)
+        if row is None:
+            if fdc_id not in food_ranking.get(db, user["id"], user["foods_version"]).foods:
+                raise HTTPException(status_code=404, detail="Food not found")
+            raise HTTPException(status_code=400, detail="Food has no nutrients to compare")
+        mine = index.dominance[row]
+        if dominant == "same":
+            dominant = mine
+        if cheaper:
+            price = index.price_per_100[row]
+            if price is None:
+                raise HTTPException(status_code=400, detail="Food has no Price to compare")
+            max_price = price if max_price is None else min(max_price, price)
+
+        result = {"fdc_id": fdc_id, "name": index.names[row], "dominant": mine, "source": source}
+        if source == "library":
+            hits = index.search(fdc_id, k, dominant, max_price)
+            result["foods"] = [
+                {
+                    "fdc_id": index.ids[i],
+                    "name": index.names[i],
+                    "similarity": round(score, 4),
+                    "dominant": index.dominance[i],
+                    "price_per_100": round(index.price_per_100[i], 2) if index.price_per_100[i] is not None else None,
+                }
+                for score, i in hits
+            ]
+            return result
+
+        catalog = food_similarity.catalog(db)
+        query = catalog.query_vector(
+            dict(zip(index.columns, (value * scale for value, scale in zip(index.matrix[row], index.scales))))
+        )
+        hits = [] if query is None else catalog.search(query, k, dominant, fdc_id, food_similarity.CATALOG_IVF_PROBES)
+        result["approximate"] = True
+        result["foods"] = [
+            {
+                "fdc_id": int(catalog.ids[i]),
+                "name": catalog.names[i],
+                "similarity": round(score, 4),
+                "dominant": food_similarity.DOMINANCE[catalog.dominance[i]] if catalog.dominance[i] >= 0 else "",
+            }
+            for score, i in hits
+        ]
+        return result
+    except food_similarity.CatalogNotReady as exc:
+        headers = {"Retry-After": "10"} if exc.status_code == 503 else None
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail, headers=headers)
     except HTTPException:
         raise
     except Exception as exc:
@@ -511,23 +690,60 @@ def create_food(payload: FoodCreate, user: dict = Depends(verify_auth_token_get_
         if exists is not None:
             raise HTTPException(status_code=400, detail="Food Name already exists")
 
-        next_fdc_id = db.execute(
-            select(func.coalesce(func.max(Food.fdc_id), 0) + 1)
-            .where(Food.user_id == user_id, Food.fdc_id < 1000)
-        ).scalar_one()
+        next_fdc_id = food_ids.allocate(db, user_id)[0]
         db.add(Food(user_id=user_id, fdc_id=next_fdc_id, name=name))
+        ranking_change = food_ranking.bump(db, user_id, [next_fdc_id])
         db.commit()
+        food_ranking.apply(db, ranking_change)
         return {"message": f"Created{next_fdc_id} : {name}", "fdc_id": next_fdc_id}
     except HTTPException:
         raise
+    except food_ids.FoodIdsExhausted as exc:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(exc))
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
+
+FOOD_BULK_CREATE_MAX = 500
+
+@app.post("/api/foods/bulk")
+def create_foods(payload: FoodBulkCreate, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+    ''' Create several custom foods at once, with one block of fdc_ids '''
+    user_id = user["id"]
+    names = [str(name).strip() for name in payload.names]
+    if not names or len(names) > FOOD_BULK_CREATE_MAX:
+        raise HTTPException(status_code=400, detail=f"Give 1 to {FOOD_BULK_CREATE_MAX} names")
+    if not all(names) or len(set(names)) != len(names):
+        raise HTTPException(status_code=400, detail="Names must be non-empty and distinct")
+    try:
+        exists = db.execute(
+            select(Food.name).where(Food.user_id == user_id, Food.name.in_(names))
+        ).scalars().all()
+        if exists:
+            raise HTTPException(status_code=400, detail=f"Food Name already exists: {', '.join(exists)}")
+
+        fdc_ids = food_ids.allocate(db, user_id, len(names))
+        db.add_all([Food(user_id=user_id, fdc_id=fdc_id, name=name) for fdc_id, name in zip(fdc_ids, names)])
+        ranking_change = food_ranking.bump(db, user_id, fdc_ids)
+        db.commit()
+        food_ranking.apply(db, ranking_change)
+        return {"created": [{"fdc_id": fdc_id, "name": name} for fdc_id, name in zip(fdc_ids, names)]}
+    except HTTPException:
+        db.rollback()
+        raise
+    except food_ids.FoodIdsExhausted as exc:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=str(exc))
+    except Exception as exc:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(exc))
     
 @app.put("/api/foods/{fdcid}")
 def update_food(fdcid: int, payload: dict = Body(...), user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
     user_id = user["id"]
     try:
-        valid_cols = {col.name for col in Food.__table__.columns}
+        schema = food_schema.current()
+        valid_cols = set(schema.names)
 
         new_fdc_id = None
         if payload and "fdc_id" in payload:
@@ -556,24 +772,35 @@ def update_food(fdcid: int, payload: dict = Body(...), user: dict = Depends(veri
         if not updates:
             raise HTTPException(status_code=400, detail="No valid fields to update")
 
-        values = {Food.__table__.c[key]: value for key, value in updates.items()}
+        foods = schema.table
+        values = {
+            foods.c[key]: value
+            for key, value in derived_nutrients.with_derived(foods, updates).items()
+        }
+        before = diet_totals.per_unit_vectors(db, user_id, [fdcid], lock=True).get(fdcid)
         result = db.execute(
-            update(Food)
-            .where(Food.fdc_id == fdcid, Food.user_id == user_id)
+            update(foods)
+            .where(foods.c.fdc_id == fdcid, foods.c.user_id == user_id)
             .values(values)
         )
-        db.commit()
         foodRowsUpdated = result.rowcount
         if foodRowsUpdated == 0:
+            db.rollback()
             raise HTTPException(status_code=404, detail="Food not found")
-        
-        db.execute(
-            text(
-                'UPDATE foods SET "Vitamin K, total µg" = "Vitamin K (phylloquinone) µg" + "Vitamin K (Menaquinone-4) µg" + "Vitamin K (Menaquinone-7) µg" WHERE user_id = :user_id'
-            ),
-            {"user_id": user_id},
-        )
+
+        changed_diets = diet_totals.food_changed(db, user_id, updates.get("fdc_id", fdcid), before)
+        if "fdc_id" in updates:
+            for diet_name in changed_diets:
+                diet_changes.record(db, user_id, diet_name, "reset")
+        elif changed_diets:
+            food = schema.to_dict(db.execute(
+                schema.select().where(foods.c.fdc_id == fdcid, foods.c.user_id == user_id)
+            ).one())
+            for diet_name, totals in changed_diets.items():
+                diet_changes.record(db, user_id, diet_name, "food", row=food, totals=totals)
+        ranking_change = food_ranking.bump(db, user_id, {fdcid, updates.get("fdc_id", fdcid)})
         db.commit()
+        food_ranking.apply(db, ranking_change)
         return {"updated": foodRowsUpdated}
 
     except HTTPException:
@@ -585,10 +812,15 @@ def update_food(fdcid: int, payload: dict = Body(...), user: dict = Depends(veri
 def delete_food(fdc_id: int, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
     user_id = user["id"]
     try:
+        totals_plan = diet_totals.food_removed(db, user_id, fdc_id)
         result = db.execute(
             delete(Food).where(Food.fdc_id == fdc_id, Food.user_id == user_id)
         )
+        for diet_name in diet_totals.food_deleted(db, user_id, fdc_id, totals_plan):
+            diet_changes.record(db, user_id, diet_name, "reset")
+        ranking_change = food_ranking.bump(db, user_id, [fdc_id])
         db.commit()
+        food_ranking.apply(db, ranking_change)
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Food not found")
         return {"deleted": result.rowcount}
@@ -604,18 +836,14 @@ def create_update_food_from_fdcid(fdcid: int, request: Request, user: dict = Dep
     client_ip = request.client.host if request.client else "unknown"
     enforce_fdc_rate_limit(client_ip)
     #API Call to FDC to get food nutrition details
-    httpx_client =  request.app.state.httpx_client
-    if not FDC_API_KEY:
-        raise HTTPException(status_code=500, detail="FDC_API_KEY is not configured. Set it in .env file.")
-    url = "https://api.nal.usda.gov/fdc/v1/food/" + str(fdcid) + "?api_key=" + FDC_API_KEY
     try:
-        resp = httpx_client.get(url)
-        resp.raise_for_status()
-        food = resp.json()
-        foodname = food['description']
-
-    except Exception as e:
-        handle_httpx_exception(e)
+        food = fdc_client.client.get_food(fdcid)
+    except fdc_client.FdcError as exc:
+        logger.warning("FDC lookup of %s failed: %s", fdcid, exc.detail)
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail, headers=exc.headers)
+    foodname = food.get('description') if isinstance(food, dict) else None
+    if not foodname:
+        raise HTTPException(status_code=502, detail="FoodData Central sent a food without a description")
 
     try:
         record = db.execute(
@@ -623,52 +851,69 @@ def create_update_food_from_fdcid(fdcid: int, request: Request, user: dict = Dep
         ).scalar_one_or_none()
 
         #Create new record for the food if food doesn't exist in local DB
-        if record is None:
-            created = True
+        created = record is None
+        if created:
             db.add(Food(user_id=user_id, fdc_id=fdcid, name=foodname, serving_size=100, unit="grams"))
             db.commit()
             print("New food inserted: " + foodname)
-        else:
-            created = False
 
         #Get all cols of food table
-        table_cols = {col.name for col in Food.__table__.columns}
+        table_cols = set(food_schema.current().names)
+        sqlite = db.get_bind().dialect.name == "sqlite"
+        amounts = {}
 
         for nutrient in food['foodNutrients']:
 
-            unwanted = re.search("^PUFA|^MUFA|^TFA|^SFA|^Water|^Ash", nutrient['nutrient']['name']) #I don't have those PUFA MUFA TFA SFA data
+            unwanted = is_unwanted_nutrient(nutrient['nutrient']['name'])
 
             #if nutrient entry has amount and not in unwanted list
             #Some of them don't have amount, so useless we skip
             if "amount" in nutrient and not unwanted:
-                matching_table_col_name = nutrient['nutrient']['name'] + " " + nutrient['nutrient']['unitName']
+                matching_table_col_name = fdc_nutrient_column_name(nutrient['nutrient']['name'], nutrient['nutrient']['unitName'])
 
                 #create relevant nutrient column if the column doesn't exist
+                if matching_table_col_name not in table_cols and sqlite:
+                    # SQLite has no ADD COLUMN IF NOT EXISTS (nor NOTIFY): re-read the columns, it's a local PRAGMA
+                    table_cols = set(food_schema.refresh().names)
                 if matching_table_col_name not in table_cols:
                     safe_col = matching_table_col_name.replace('"', '""')
                     logger.info("Starting ALTER TABLE foods ADD column: %s. Postgres is Locked", safe_col)
+                    if_not_exists = "" if sqlite else "IF NOT EXISTS "
                     db.execute(
-                        text(f'ALTER TABLE foods ADD "{safe_col}" NUMERIC(10, 3) NOT NULL DEFAULT 0.000')
+                        text(f'ALTER TABLE foods ADD COLUMN {if_not_exists}"{safe_col}" NUMERIC(10, 3) NOT NULL DEFAULT 0.000')
                     )
+                    food_schema.announce_change(db)
                     db.commit()
                     logger.info("Completed ALTER TABLE foods ADD column: %s. Postgres Lock Released", safe_col)
+                    table_cols = set(food_schema.refresh().names)
+
+                amounts[matching_table_col_name] = nutrient["amount"]
+
+        #Columns are all there now: lock the food, then write every value in one transaction,
+        #so no other edit lands between `before` and the diet totals update
+        before = None
+        if not created:
+            before = diet_totals.per_unit_vectors(db, user_id, [fdcid], lock=True).get(fdcid)
+        for matching_table_col_name, amount in amounts.items():
+            #Update all the "nutrient" column values in DB for the food
+            safe_col = matching_table_col_name.replace('"', '""')
+            db.execute(
+                text(f'UPDATE foods SET "{safe_col}" = :amount WHERE fdc_id = :fdc_id AND user_id = :user_id'),
+                {"amount": amount, "fdc_id": fdcid, "user_id": user_id},
+            )
+        imported_cols = set(amounts)
 
-                #Update all the "nutrient" column values in DB for the food
-                safe_col = matching_table_col_name.replace('"', '""')
-                db.execute(
-                    text(f'UPDATE foods SET "{safe_col}" = :amount WHERE fdc_id = :fdc_id AND user_id = :user_id'),
-                    {"amount": nutrient["amount"], "fdc_id": fdcid, "user_id": user_id},
-                )
-                db.commit()
-        
-        #do the total vitamin K calculation
-        db.execute(
-            text(
-                'UPDATE foods SET "Vitamin K, total µg" = "Vitamin K (phylloquinone) µg" + "Vitamin K (Menaquinone-4) µg" + "Vitamin K (Menaquinone-7) µg" WHERE fdc_id = :fdc_id'
-            ),
-            {"fdc_id": fdcid},
+        #derived nutrients (Vitamin K total, ...) of this food only
+        foods = food_schema.current().table
+        derived_nutrients.apply(
+            db, foods, foods.c.fdc_id == fdcid, foods.c.user_id == user_id, changed=imported_cols
         )
+        if not created:
+            for diet_name in diet_totals.food_changed(db, user_id, fdcid, before):
+                diet_changes.record(db, user_id, diet_name, "reset")
+        ranking_change = food_ranking.bump(db, user_id, [fdcid])
         db.commit()
+        food_ranking.apply(db, ranking_change)
     except HTTPException:
         db.rollback()
         raise
@@ -681,7 +926,7 @@ def create_update_food_from_fdcid(fdcid: int, request: Request, user: dict = Dep
 
 
 @app.get("/api/diets/{diet_name}")
-def get_diets(diet_name: str = "*", user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def get_diets(diet_name: str = "*", user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
     try:
         if diet_name == "*":
             rows = db.execute(
@@ -699,7 +944,7 @@ def get_diets(diet_name: str = "*", user: dict = Depends(verify_auth_token_get_u
         raise HTTPException(status_code=500, detail=str(exc))
 
 @app.get("/api/diets/{diet_name}/nutrition")
-def diets_nutrition(diet_name: str, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def diets_nutrition(diet_name: str, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
     try:
         diet_items = strip_user_id([
             model_to_dict(row)
@@ -708,53 +953,232 @@ def diets_nutrition(diet_name: str, user: dict = Depends(verify_auth_token_get_u
             ).scalars().all()
         ])
 
-        foods = strip_user_id([
-            model_to_dict(row)
-            for row in db.execute(
-                select(Food).where(Food.user_id == user["id"])
-            ).scalars().all()
-        ])
+        foods = diet_nutrition.load_foods(db, user["id"], [item["fdc_id"] for item in diet_items])
+        return Response(content=diet_nutrition.scale(diet_items, foods).json(), media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-        foods_by_id = {}
-        for food in foods:
-            foods_by_id[food.get("fdc_id")] = food
+@app.get("/api/diets/{diet_name}/totals")
+def get_diet_totals(diet_name: str = "*", user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    try:
+        return diet_totals.read(db, user["id"], None if diet_name == "*" else diet_name)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-        diet_calculated = []
-        for diet_entry in diet_items:
-            food = foods_by_id.get(diet_entry.get("fdc_id"))
-            if not food:
-                continue
+DIET_COMPARISON_MAX = 50
 
-            serving_size = food.get("Serving Size")
-            try:
-                serving_size = float(serving_size)
-            except (TypeError, ValueError):
-                serving_size = 0.0
+@app.get("/api/diet_comparison")
+def compare_diets(
+    diet_name: list[str] = Query(...),
+    all_nutrients: bool = False,
+    user: dict = Depends(verify_auth_token_get_user_read),
+    db: Session = Depends(get_read_db),
+):
+    ''' diets x nutrients matrix of totals, RDA/UL coverage (%) and cost for ?diet_name=A&diet_name=B...
+        Nutrients are the user's diet_columns ones, or every column with all_nutrients=true.
+    '''
+    names = list(dict.fromkeys(diet_name))
+    if len(names) > DIET_COMPARISON_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {DIET_COMPARISON_MAX} diets")
+    try:
+        by_name = diet_totals.vectors(db, user["id"], names)
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Diet not found: {', '.join(missing)}")
+
+        layout = diet_totals.current_layout()
+        plan = user_settings.get(db, user["id"], user["settings_version"]).plan(db)
+        # Price is reported as cost
+        position = {name: i for i, name in enumerate(layout.columns)}
+        nutrients = tuple(name for name in (layout.columns if all_nutrients else plan.nutrients) if name != "Price")
+        indices = tuple(position[name] for name in nutrients)
+        rda = [plan.rda_by_name.get(name) for name in nutrients]
+        ul = [plan.ul_by_name.get(name) for name in nutrients]
+        price_index = position.get("Price")
+
+        totals, rda_pct, ul_pct, cost, items = [], [], [], [], []
+        for name in names:
+            count, vector = by_name[name]
+            row = [vector[i] for i in indices]
+            totals.append([round(value, 2) for value in row])
+            rda_pct.append([round(value / limit * 100, 1) if limit else None for value, limit in zip(row, rda)])
+            ul_pct.append([round(value / limit * 100, 1) if limit else None for value, limit in zip(row, ul)])
+            cost.append(round(vector[price_index], 2) if price_index is not None else None)
+            items.append(count)
+
+        return {
+            "diets": names,
+            "nutrients": list(nutrients),
+            "items": items,
+            "cost": cost,
+            "totals": totals,
+            "rda": rda,
+            "ul": ul,
+            "rda_pct": rda_pct,
+            "ul_pct": ul_pct,
+        }
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-            adjusted_food = dict(food)
-            adjusted_food.pop("Serving Size", None)
-            for key, value in food.items():
-                if key in ("fdc_id", "Serving Size"):
-                    continue
-                if isinstance(value, (int, float)):
-                    if serving_size > 0:
-                        adjusted_value = round((float(value) / serving_size) * float(diet_entry.get("quantity", 0)), 2)
-                    else:
-                        adjusted_value = 0.00
-                    adjusted_food[key] = adjusted_value
+@app.get("/api/diets/{diet_name}/changes")
+def get_diet_changes(diet_name: str, since: int = 0, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    try:
+        return diet_changes.since(db, user["id"], diet_name, since)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-            merged = dict(diet_entry)
-            merged.update(adjusted_food)
-            diet_calculated.append(merged)
+def _stream_user(request: Request) -> dict:
+    # a short session of its own: a Depends() one would stay open as long as the stream
+    with SessionLocal() as db:
+        return verify_auth_token_get_user(request, db)
+
+@app.get("/api/diets/{diet_name}/events")
+async def diet_event_stream(diet_name: str, request: Request, since: int | None = None):
+    ''' Server-Sent Events: the diet's changes pushed as they commit, from `since` (or Last-Event-ID) on '''
+    user = await run_in_threadpool(_stream_user, request)
+    try:
+        last_event_id = request.headers.get("last-event-id")
+        if last_event_id and last_event_id.isdigit():
+            since = int(last_event_id)  # EventSource reconnecting
+        if since is None:
+            since = await run_in_threadpool(_bundle_version, SessionLocal, user["id"], diet_name)
+        stream = diet_events.Stream(user["id"], diet_name, since)
+    except diet_events.TooManyStreams:
+        raise HTTPException(status_code=503, detail="Too many open streams, try again shortly", headers={"Retry-After": "30"})
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+    return StreamingResponse(
+        stream.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        return diet_calculated
+def _bundle_query(session_factory, statement) -> list:
+    with session_factory() as db:
+        return strip_user_id([model_to_dict(row) for row in db.execute(statement).scalars().all()])
+
+def _bundle_foods(session_factory, user_id: int) -> diet_nutrition.FoodRecords:
+    with session_factory() as db:
+        return diet_nutrition.load_foods(db, user_id)
+
+def _bundle_plan(session_factory, user: dict) -> dict:
+    with session_factory() as db:
+        return user_settings.get(db, user["id"], user["settings_version"]).plan(db).as_dict()
+
+def _bundle_version(session_factory, user_id: int, diet_name: str) -> int:
+    with session_factory() as db:
+        return diet_changes.latest_version(db, user_id, diet_name)
+
+async def _bundle_run(slots: asyncio.Semaphore, fn, *args):
+    async with slots:
+        return await run_in_threadpool(fn, *args)
+
+@app.get("/api/diets/{diet_name}/bundle")
+async def diet_bundle(diet_name: str, request: Request, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    ''' Everything diets.html needs on load, in one response
+        The independent queries run concurrently, each on its own pooled connection,
+        at most BUNDLE_MAX_CONNECTIONS at a time.
+        Answers 304 when If-None-Match has the current ETag.
+    '''
+    user_id = user["id"]
+    session_factory = read_session_factory(request)
+    # db is the auth query's session: give its connection back before taking more
+    await run_in_threadpool(db.close)
+    slots = asyncio.Semaphore(BUNDLE_MAX_CONNECTIONS)
+    try:
+        # Read before the items: replaying a change the items already contain is harmless, missing one is not
+        version = await run_in_threadpool(_bundle_version, session_factory, user_id, diet_name)
+        foods, diet_items, rda, ul, column_plan = await asyncio.gather(
+            # foods first: the biggest query
+            _bundle_run(slots, _bundle_foods, session_factory, user_id),
+            _bundle_run(
+                slots, _bundle_query, session_factory,
+                select(Diet).where(Diet.diet_name == diet_name, Diet.user_id == user_id).order_by(Diet.sort_order.asc()),
+            ),
+            _bundle_run(slots, _bundle_query, session_factory, select(RDA).where(RDA.user_id == user_id)),
+            _bundle_run(slots, _bundle_query, session_factory, select(UL).where(UL.user_id == user_id)),
+            _bundle_run(slots, _bundle_plan, session_factory, user),
+        )
+        me = dict(user)
+        me.pop("hashed_password", None)
+        bundle = {
+            "diet_name": diet_name,
+            "version": version,
+            "sort_gap": diet_order.SORT_GAP,
+            "diet_items": diet_items,
+            "user": me,
+            "rda": rda,
+            "ul": ul,
+            "column_plan": column_plan,
+        }
+        # the two big arrays are written straight from their compact rows
+        body = b"".join((
+            json.dumps(bundle, separators=(",", ":"))[:-1].encode("utf-8"),
+            b',"nutrition":', diet_nutrition.scale(diet_items, foods).json(),
+            b',"foods":', foods.json(),
+            b"}",
+        ))
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/diets/{diet_name}/export")
+def export_diet(diet_name: str, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    ''' The diet as CSV, in the user's diet_columns order, with Total, RDA and UL rows '''
+    try:
+        plan = user_settings.get(db, user["id"], user["settings_version"]).plan(db)
+        diet_items = strip_user_id([
+            model_to_dict(row)
+            for row in db.execute(
+                select(Diet).where(Diet.diet_name == diet_name, Diet.user_id == user["id"]).order_by(Diet.sort_order.asc())
+            ).scalars().all()
+        ])
+        if not diet_items:
+            raise HTTPException(status_code=404, detail="Diet not found")
+        foods = diet_nutrition.load_foods(db, user["id"], [item["fdc_id"] for item in diet_items])
+        _items, totals = diet_totals.vector(db, user["id"], diet_name)
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(plan.columns)
+        for item in diet_nutrition.scale(diet_items, foods):
+            writer.writerow(plan.row(item))
+        first = plan.columns[0] if plan.columns else None
+        for label, values in (("Total", [round(v, 2) for v in plan.pick(totals)]), ("RDA", plan.rda), ("UL", plan.ul)):
+            by_name = dict(zip(plan.nutrients, values))
+            writer.writerow([
+                by_name[name] if name in by_name else (label if name == first else "")
+                for name in plan.columns
+            ])
     except HTTPException:
         raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
+    filename = re.sub(r"[^A-Za-z0-9_.-]+", "_", diet_name) or "diet"
+    return Response(
+        content=out.getvalue(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'},
+    )
+
 @app.get("/api/rda")
-def get_rda(user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def get_rda(user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
     try:
         rows = db.execute(
             select(RDA).where(RDA.user_id == user["id"])
@@ -779,7 +1203,9 @@ def update_rda(id: int, payload: RDAUpdate, user: dict = Depends(verify_auth_tok
         nutrient_name = str(row.nutrient or "").strip()
 
         row.value = value
+        user_settings.bump(db, user_id)
         db.commit()
+        user_settings.invalidate(user_id)
         return JSONResponse({"detail": f"Updated RDA {nutrient_name}"}, status_code=200)
     except HTTPException:
         db.rollback()
@@ -789,7 +1215,7 @@ def update_rda(id: int, payload: RDAUpdate, user: dict = Depends(verify_auth_tok
         raise HTTPException(status_code=500, detail=str(exc))
 
 @app.get("/api/ul")
-def get_ul(user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def get_ul(user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
     try:
         rows = db.execute(
             select(UL).where(UL.user_id == user["id"])
@@ -814,7 +1240,9 @@ def update_ul(id: int, payload: ULUpdate, user: dict = Depends(verify_auth_token
         nutrient_name = str(row.nutrient or "").strip()
 
         row.value = value
+        user_settings.bump(db, user_id)
         db.commit()
+        user_settings.invalidate(user_id)
         return JSONResponse({"detail": f"Updated UL {nutrient_name}"}, status_code=200)
     except HTTPException:
         db.rollback()
@@ -823,8 +1251,20 @@ def update_ul(id: int, payload: ULUpdate, user: dict = Depends(verify_auth_token
         db.rollback()
         raise HTTPException(status_code=500, detail=str(exc))
 
+def record_diet_change(db: Session, user_id: int, diet_name: str, op: str, old: dict | None = None, item: dict | None = None, totals: dict | None = None) -> dict:
+    ''' Log a diet edit for GET /api/diets/{name}/changes. `item` is sent back scaled, like diets_nutrition rows '''
+    row = None
+    if item is not None:
+        foods = diet_nutrition.load_foods(db, user_id, [item["fdc_id"]])
+        rows = diet_nutrition.scale([item], foods).dicts()
+        row = rows[0] if rows else None
+    return diet_changes.record(db, user_id, diet_name, op, old=old, row=row, totals=totals)
+
+def diet_item_key(fdc_id, quantity, sort_order) -> dict:
+    return {"fdc_id": fdc_id, "quantity": quantity, "sort_order": sort_order}
+
 @app.post("/api/diet")
-def create_diet(payload: DietCreate, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def create_diet(payload: DietCreate, delta: bool = False, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
     try:
         db.add(
             Diet(
@@ -836,7 +1276,12 @@ def create_diet(payload: DietCreate, user: dict = Depends(verify_auth_token_get_
                 color=payload.color,
             )
         )
+        db.flush()
+        totals = diet_totals.apply_changes(db, user["id"], payload.diet_name, [(payload.fdc_id, payload.quantity, 1)])
+        change = record_diet_change(db, user["id"], payload.diet_name, "create", item=payload.model_dump(), totals=totals)
         db.commit()
+        if delta:
+            return {"created": 1, "delta": change}
         return {"created": 1}
     except HTTPException:
         raise
@@ -844,7 +1289,7 @@ def create_diet(payload: DietCreate, user: dict = Depends(verify_auth_token_get_
         raise HTTPException(status_code=500, detail=str(exc))
 
 @app.put("/api/diet")
-def update_diet(payload: DietUpdate, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def update_diet(payload: DietUpdate, delta: bool = False, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
     try:
         original_fdc_id = payload.original_fdc_id if payload.original_fdc_id is not None else payload.fdc_id
         original_quantity = payload.original_quantity if payload.original_quantity is not None else payload.quantity
@@ -866,17 +1311,62 @@ def update_diet(payload: DietUpdate, user: dict = Depends(verify_auth_token_get_
                 color=payload.color,
             )
         )
+        change = None
+        if result.rowcount:
+            totals = diet_totals.apply_changes(db, user["id"], payload.diet_name, [
+                (original_fdc_id, -original_quantity, -result.rowcount),
+                (payload.fdc_id, payload.quantity * result.rowcount, result.rowcount),
+            ])
+            item = payload.model_dump(include={"diet_name", "fdc_id", "quantity", "sort_order", "color"})
+            old = diet_item_key(original_fdc_id, original_quantity, original_sort_order)
+            change = record_diet_change(db, user["id"], payload.diet_name, "update", old=old, item=item, totals=totals)
         db.commit()
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Diet not found")
+        if delta:
+            return {"updated": result.rowcount, "delta": change}
         return {"updated": result.rowcount}
     except HTTPException:
         raise
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
+@app.put("/api/diet/move")
+def move_diet_item(payload: DietMove, delta: bool = False, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+    ''' Drag and drop: one row gets a key between its new neighbours. respaced=True means every key changed, refetch '''
+    try:
+        moved = diet_order.move(db, user["id"], payload.diet_name, payload.fdc_id, payload.quantity, payload.sort_order, payload.to_index)
+        if moved is None:
+            raise HTTPException(status_code=404, detail="Diet item not found")
+        change = None
+        if moved["respaced"]:
+            change = diet_changes.record(db, user["id"], payload.diet_name, "reset")
+        elif moved["sort_order"] != payload.sort_order:
+            item = {
+                "diet_name": payload.diet_name,
+                "fdc_id": payload.fdc_id,
+                "quantity": payload.quantity,
+                "sort_order": moved["sort_order"],
+                "color": moved["color"],
+            }
+            old = diet_item_key(payload.fdc_id, payload.quantity, payload.sort_order)
+            change = record_diet_change(db, user["id"], payload.diet_name, "update", old=old, item=item)
+        db.commit()
+        if moved["crowded"]:
+            diet_order.schedule_respace(user["id"], payload.diet_name)
+        body = {"sort_order": moved["sort_order"], "respaced": moved["respaced"]}
+        if delta:
+            body["delta"] = change
+        return body
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as exc:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(exc))
+
 @app.delete("/api/diet")
-def delete_diet(payload: DietDelete, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+def delete_diet(payload: DietDelete, delta: bool = False, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
     try:
         if payload.delete_all:
             result = db.execute(
@@ -892,9 +1382,22 @@ def delete_diet(payload: DietDelete, user: dict = Depends(verify_auth_token_get_
                     Diet.sort_order == payload.sort_order,
                 )
             )
+        change = None
+        if payload.delete_all:
+            diet_totals.drop(db, user["id"], payload.diet_name)
+            if result.rowcount:
+                change = diet_changes.record(db, user["id"], payload.diet_name, "reset")
+        elif result.rowcount:
+            totals = diet_totals.apply_changes(db, user["id"], payload.diet_name, [
+                (payload.fdc_id, -payload.quantity * result.rowcount, -result.rowcount),
+            ])
+            old = diet_item_key(payload.fdc_id, payload.quantity, payload.sort_order)
+            change = diet_changes.record(db, user["id"], payload.diet_name, "delete", old=old, totals=totals)
         db.commit()
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Diet item not found")
+        if delta:
+            return {"deleted": result.rowcount, "delta": change}
         return {"deleted": result.rowcount}
     except HTTPException:
         raise
@@ -909,6 +1412,10 @@ def update_diet_name_only(payload: DietNameUpdate, user: dict = Depends(verify_a
             .where(Diet.diet_name == payload.diet_name_old, Diet.user_id == user["id"])
             .values(diet_name=payload.diet_name_new)
         )
+        if result.rowcount:
+            diet_totals.rename(db, user["id"], payload.diet_name_old, payload.diet_name_new)
+            diet_changes.record(db, user["id"], payload.diet_name_old, "reset")
+            diet_changes.record(db, user["id"], payload.diet_name_new, "reset")
         db.commit()
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Diet not found")
@@ -918,23 +1425,152 @@ def update_diet_name_only(payload: DietNameUpdate, user: dict = Depends(verify_a
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
-def handle_httpx_exception(e: Exception):
-    if isinstance(e, httpx.HTTPStatusError):
-        # Pass upstream status code through, but keep a helpful message when the body is empty
-        detail = e.response.text
-        if not detail:
-            reason = e.response.reason_phrase or "Error"
-            detail = f"Upstream {e.response.status_code} {reason}"
-        raise HTTPException(
-            status_code=e.response.status_code,
-            detail=detail,
-        )
+def intake_range(start: date | None, end: date | None, days: int = 7) -> tuple:
+    ''' [start, end) from inclusive query dates; default: the `days` days up to today '''
+    last = end or date.today()
+    first = start or (last - timedelta(days=days - 1))
+    if first > last:
+        raise HTTPException(status_code=400, detail="start is after end")
+    if (last - first).days >= intake_log.MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {intake_log.MAX_RANGE_DAYS} days")
+    return first, last + timedelta(days=1)
+
+def intake_entry_dict(entry: IntakeEntry) -> dict:
+    return {
+        "eaten_on": entry.eaten_on.isoformat(),
+        "entry_no": entry.entry_no,
+        "fdc_id": entry.fdc_id,
+        "Name": entry.name,
+        "quantity": float(entry.quantity),
+        "nutrients": {name: round(value, 2) for name, value in entry.nutrients.items()},
+    }
+
+def _intake_entry(db: Session, user_id: int, eaten_on: date, entry_no: int) -> IntakeEntry:
+    entry = db.execute(
+        select(IntakeEntry)
+        .where(IntakeEntry.user_id == user_id, IntakeEntry.eaten_on == eaten_on, IntakeEntry.entry_no == entry_no)
+        .with_for_update()
+    ).scalar_one_or_none()
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Intake entry not found")
+    return entry
+
+@app.get("/api/intake")
+def get_intake(start: date | None = None, end: date | None = None, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    try:
+        first, after = intake_range(start, end)
+        return [intake_entry_dict(entry) for entry in intake_log.entries(db, user["id"], first, after)]
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
 
-    raise HTTPException(
-        status_code=500,
-        detail={
-            "type": type(e).__name__,
-            "message": str(e),
-            "traceback": traceback.format_exc(),
-        },
-    )
+@app.post("/api/intake")
+def create_intake(payload: IntakeCreate, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+    user_id = user["id"]
+    eaten_on = payload.eaten_on or date.today()
+    try:
+        name = db.execute(
+            select(Food.name).where(Food.user_id == user_id, Food.fdc_id == payload.fdc_id)
+        ).scalar_one_or_none()
+        nutrients = intake_log.scaled_nutrients(db, user_id, payload.fdc_id, payload.quantity)
+        if name is None or nutrients is None:
+            raise HTTPException(status_code=404, detail="Food not found")
+        entry = intake_log.add(db, user_id, eaten_on, payload.fdc_id, name, payload.quantity, nutrients)
+        result = intake_entry_dict(entry)
+        db.commit()
+        return result
+    except HTTPException:
+        db.rollback()
+        raise
+    except IntegrityError:
+        # another entry for the same day got the same entry_no first
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Concurrent intake edit, try again")
+    except Exception as exc:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.put("/api/intake/{eaten_on}/{entry_no}")
+def update_intake(eaten_on: date, entry_no: int, payload: IntakeUpdate, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+    user_id = user["id"]
+    try:
+        entry = _intake_entry(db, user_id, eaten_on, entry_no)
+        nutrients = intake_log.scaled_nutrients(db, user_id, entry.fdc_id, payload.quantity)
+        if nutrients is None:
+            # the food is gone: scale the logged amounts instead
+            ratio = payload.quantity / float(entry.quantity) if float(entry.quantity) else 0.0
+            nutrients = {name: value * ratio for name, value in entry.nutrients.items()}
+        intake_log.change_quantity(db, entry, payload.quantity, nutrients)
+        result = intake_entry_dict(entry)
+        db.commit()
+        return result
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as exc:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.delete("/api/intake/{eaten_on}/{entry_no}")
+def delete_intake(eaten_on: date, entry_no: int, user: dict = Depends(verify_auth_token_get_user), db: Session = Depends(get_db)):
+    try:
+        intake_log.remove(db, _intake_entry(db, user["id"], eaten_on, entry_no))
+        db.commit()
+        return {"deleted": 1}
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as exc:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.get("/api/intake/rollups")
+def get_intake_rollups(period: str = "day", start: date | None = None, end: date | None = None, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    ''' Per day, week or month totals. start/end select the periods that begin in that range '''
+    if period not in intake_log.PERIODS:
+        raise HTTPException(status_code=400, detail="period must be day, week or month")
+    try:
+        first, after = intake_range(start, end, days={"day": 7, "week": 56, "month": 365}[period])
+        return intake_log.rollups(db, user["id"], period, first, after)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+@app.get("/api/intake/summary")
+def get_intake_summary(days: int = 90, end: date | None = None, user: dict = Depends(verify_auth_token_get_user_read), db: Session = Depends(get_read_db)):
+    ''' Average daily intake over the last `days` days (up to `end`) of the diet_columns nutrients, against RDA and UL.
+        Averages are per logged day: days without entries are treated as not logged, not as fasting.
+    '''
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be at least 1")
+    try:
+        first, after = intake_range(None, end, days=days)
+        items, logged_days, totals, rollup_rows = intake_log.summary(db, user["id"], first, after)
+        # the nutrients of the user's diet_columns, like the diet page
+        plan = user_settings.get(db, user["id"], user["settings_version"]).plan(db)
+        nutrients = {}
+        for name, value, rda, ul in zip(plan.nutrients, plan.pick(totals), plan.rda, plan.ul):
+            average = round(value / logged_days, 2) if logged_days else 0.0
+            entry = {"average": average}
+            if rda:
+                entry["rda_pct"] = round(average / rda * 100, 1)
+            if ul:
+                entry["ul_pct"] = round(average / ul * 100, 1)
+            nutrients[name] = entry
+        return {
+            "start": first.isoformat(),
+            "end": (after - timedelta(days=1)).isoformat(),
+            "days": (after - first).days,
+            "logged_days": logged_days,
+            "items": items,
+            "rollup_rows": rollup_rows,
+            "nutrients": nutrients,
+        }
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+startup.mark_imported()
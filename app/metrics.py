@@ -0,0 +1,346 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# In-process metrics, Prometheus text format on /metrics
+#
+# Every metric keeps its own small dict behind a Lock, so handlers running
+# in the anyio threadpool can record without contention on a global lock.
+#
+# With several uvicorn workers set METRICS_MULTIPROC_DIR to a directory
+# shared by them: each worker writes its snapshot there every
+# METRICS_SYNC_SECS and /metrics (whichever worker serves it) sums them.
+# -------------------------------------------------------------------
+
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_SYNC_SECS = float(os.getenv("METRICS_SYNC_SECS", "5"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_collectors = []
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = [[list(key), _copy_value(value)] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "samples": samples}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per-bucket counts (last one is +Inf), sum, count]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self) -> dict:
+        snap = super().snapshot()
+        snap["buckets"] = list(self.buckets)
+        return snap
+
+
+def _copy_value(value):
+    if isinstance(value, list):
+        return [list(value[0]), value[1], value[2]]
+    return value
+
+
+def register_collector(fn):
+    ''' fn() is called right before every snapshot, to refresh gauges (e.g. DB pool size) '''
+    _collectors.append(fn)
+    return fn
+
+
+# -------------------------------------------------------------------
+# Metric definitions
+# -------------------------------------------------------------------
+
+HTTP_REQUESTS = Counter(
+    "evaldiet_http_requests_total", "HTTP requests by route template", ("method", "route", "status")
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "evaldiet_http_request_duration_seconds", "HTTP request latency by route template", ("method", "route")
+)
+HTTP_IN_FLIGHT = Gauge("evaldiet_http_requests_in_flight", "HTTP requests currently being served")
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "evaldiet_db_pool_checkout_wait_seconds", "Time spent waiting for a DB pool connection", ("engine",),
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 30.0),
+)
+DB_POOL_CONNECTIONS = Gauge("evaldiet_db_pool_connections", "DB pool connections by state", ("engine", "state"))
+
+FDC_UPSTREAM_REQUESTS = Counter(
+    "evaldiet_fdc_upstream_requests_total", "FoodData Central API calls by status", ("status",)
+)
+FDC_UPSTREAM_SECONDS = Histogram(
+    "evaldiet_fdc_upstream_duration_seconds", "FoodData Central API call latency", ("status",)
+)
+FDC_RETRIES = Counter("evaldiet_fdc_retries_total", "FoodData Central API calls retried")
+FDC_SHORT_CIRCUITED = Counter(
+    "evaldiet_fdc_short_circuited_total", "FoodData Central lookups failed fast (breaker open or too many in flight)", ("reason",)
+)
+FDC_COALESCED = Counter("evaldiet_fdc_coalesced_total", "FoodData Central lookups that joined an identical one in flight")
+FDC_CIRCUIT_OPEN = Gauge("evaldiet_fdc_circuit_open", "1 while the FoodData Central circuit breaker is open")
+
+RATE_LIMIT_REJECTIONS = Counter(
+    "evaldiet_rate_limit_rejections_total", "Requests rejected by a rate limiter", ("limiter",)
+)
+
+ADMISSION_IN_FLIGHT = Gauge("evaldiet_admission_in_flight", "Admitted requests being served by route class", ("route_class",))
+ADMISSION_QUEUE_DEPTH = Gauge("evaldiet_admission_queue_depth", "Requests waiting for admission by route class", ("route_class",))
+ADMISSION_SHED = Counter(
+    "evaldiet_admission_shed_total", "Requests answered 503 by admission control", ("route_class", "reason")
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "evaldiet_admission_wait_seconds", "Time queued before admission", ("route_class",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+
+DIET_EVENT_STREAMS = Gauge("evaldiet_diet_event_streams", "Open diet Server-Sent Events streams")
+
+
+# -------------------------------------------------------------------
+# ASGI middleware (per route template, so /api/diets/{diet_name} is one series)
+# -------------------------------------------------------------------
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "<unmatched>"
+            method = scope.get("method", "")
+            HTTP_REQUESTS.inc(method=method, route=route_path, status=status["code"])
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, route=route_path)
+
+
+# -------------------------------------------------------------------
+# Snapshots, multi worker sync, exposition
+# -------------------------------------------------------------------
+
+def snapshot() -> dict:
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception:
+            logger.exception("metrics collector failed")
+    return {m.name: m.snapshot() for m in _registry}
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_MULTIPROC_DIR, f"worker_{pid}.json")
+
+
+def write_snapshot():
+    if not METRICS_MULTIPROC_DIR:
+        return
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    pid = os.getpid()
+    path = _snapshot_path(pid)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as handle:
+        json.dump({"pid": pid, "time": time.time(), "metrics": snapshot()}, handle)
+    os.replace(tmp, path)
+
+
+def _read_snapshots() -> list:
+    own = {"pid": os.getpid(), "time": time.time(), "metrics": snapshot()}
+    if not METRICS_MULTIPROC_DIR or not os.path.isdir(METRICS_MULTIPROC_DIR):
+        return [own]
+    snapshots = [own]
+    for filename in os.listdir(METRICS_MULTIPROC_DIR):
+        if not filename.endswith(".json") or filename == os.path.basename(_snapshot_path(own["pid"])):
+            continue
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, filename), encoding="utf-8") as handle:
+                snapshots.append(json.load(handle))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots: list) -> dict:
+    ''' Counters and histograms are summed across workers (including exited ones, so totals
+        don't go backwards). Gauges only make sense per live worker, so they get a pid label.
+    '''
+    stale_after = METRICS_SYNC_SECS * 3
+    now = time.time()
+    merged = {}
+    for snap in snapshots:
+        fresh = (now - snap.get("time", 0)) <= stale_after
+        for name, metric in snap.get("metrics", {}).items():
+            out = merged.setdefault(name, {
+                "type": metric["type"],
+                "help": metric["help"],
+                "labelnames": list(metric["labelnames"]),
+                "buckets": metric.get("buckets"),
+                "samples": {},
+            })
+            if metric["type"] == "gauge":
+                if not fresh:
+                    continue
+                if len(snapshots) > 1:
+                    if "pid" not in out["labelnames"]:
+                        out["labelnames"].append("pid")
+                for key, value in metric["samples"]:
+                    key = tuple(key) + ((str(snap["pid"]),) if len(snapshots) > 1 else ())
+                    out["samples"][key] = value
+                continue
+            for key, value in metric["samples"]:
+                key = tuple(key)
+                current = out["samples"].get(key)
+                if metric["type"] == "histogram":
+                    if current is None:
+                        out["samples"][key] = [list(value[0]), value[1], value[2]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                        current[2] += value[2]
+                else:
+                    out["samples"][key] = (current or 0.0) + value
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    return repr(float(value))
+
+
+def render() -> str:
+    lines = []
+    for name, metric in sorted(_merge(_read_snapshots()).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for key, value in sorted(metric["samples"].items()):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value[0]):
+                    cumulative += count
+                    le = 'le="' + (bound if bound == "+Inf" else _fmt(bound)) + '"'
+                    lines.append(f"{name}_bucket{_labels(labelnames, key, le)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labelnames, key)} {_fmt(value[1])}")
+                lines.append(f"{name}_count{_labels(labelnames, key)} {value[2]}")
+            else:
+                lines.append(f"{name}{_labels(labelnames, key)} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class _SyncThread(threading.Thread):
+    def __init__(self):
+        super().__init__(name="metrics-sync", daemon=True)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(METRICS_SYNC_SECS):
+            try:
+                write_snapshot()
+            except Exception:
+                logger.exception("metrics snapshot write failed")
+
+
+_sync_thread = None
+
+
+def start_multiprocess_sync():
+    global _sync_thread
+    if not METRICS_MULTIPROC_DIR or _sync_thread is not None:
+        return
+    _sync_thread = _SyncThread()
+    _sync_thread.start()
+
+
+def stop_multiprocess_sync():
+    global _sync_thread
+    if _sync_thread is None:
+        return
+    _sync_thread.stopped.set()
+    _sync_thread = None
+    write_snapshot()
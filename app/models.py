@@ -1,3 +1,5 @@
+from datetime import date
+
 from pydantic import BaseModel
 
 
@@ -22,6 +24,13 @@ class DietCreate(BaseModel):
     sort_order: int
     color: str | None = None
 
+class DietMove(BaseModel):
+    diet_name: str
+    fdc_id: int
+    quantity: float
+    sort_order: int
+    to_index: int
+
 class DietDelete(BaseModel):
     diet_name: str
     fdc_id: int | None = None
@@ -42,3 +51,17 @@ class FoodCreate(BaseModel):
 
     class Config:
         extra = "forbid"
+
+class FoodBulkCreate(BaseModel):
+    names: list[str]
+
+    class Config:
+        extra = "forbid"
+
+class IntakeCreate(BaseModel):
+    fdc_id: int
+    quantity: float
+    eaten_on: date | None = None  # default: today (server date)
+
+class IntakeUpdate(BaseModel):
+    quantity: float
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from app import metrics
+
+# Imported first thing by app.main, so this is roughly when the app started importing
+IMPORT_STARTED = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# -------------------------------------------------------------------
+# Cold start helpers for scale-to-zero hosting
+#
+# STARTUP_WARMUP (default on): compile every template and open
+#   DB_POOL_WARM_CONNECTIONS pool connections in lifespan, before the
+#   first request is accepted.
+# JINJA_BYTECODE_CACHE_DIR: keep compiled templates on disk. Fill it at
+#   build time with `python -m app.startup` so boots only load bytecode.
+# FDC_PREWARM: create the FDC http client and open its TLS connection in
+#   the background after startup (otherwise done on the first import).
+# -------------------------------------------------------------------
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1").lower() not in ("0", "false", "no")
+JINJA_BYTECODE_CACHE_DIR = os.getenv("JINJA_BYTECODE_CACHE_DIR")
+FDC_PREWARM = os.getenv("FDC_PREWARM", "0").lower() in ("1", "true", "yes")
+
+STARTUP_SECONDS = metrics.Gauge("evaldiet_startup_seconds", "Time spent per startup phase", ("phase",))
+
+
+class StartupTimings:
+    def __init__(self):
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = seconds
+        STARTUP_SECONDS.set(seconds, phase=phase)
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self):
+        with self._lock:
+            parts = ", ".join(f"{name} {secs * 1000:.0f} ms" for name, secs in self.phases.items())
+        logger.info("startup: %s", parts)
+
+
+timings = StartupTimings()
+
+
+def mark_imported():
+    timings.record("import", time.perf_counter() - IMPORT_STARTED)
+
+
+def configure_template_cache(env):
+    if JINJA_BYTECODE_CACHE_DIR:
+        from jinja2 import FileSystemBytecodeCache
+        os.makedirs(JINJA_BYTECODE_CACHE_DIR, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR)
+
+
+def precompile_templates(env) -> int:
+    ''' Load every template into the Environment cache (and the bytecode cache, if configured) '''
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+def _open_connections(engine, count: int) -> int:
+    conns = []
+    try:
+        # Held open together, so the pool really grows to `count`
+        for _ in range(count):
+            conns.append(engine.connect())
+    finally:
+        for conn in conns:
+            conn.close()
+    return len(conns)
+
+
+def warm_pool_in_background(engine, count: int) -> Future:
+    future = Future()
+    if count <= 0:
+        future.set_result(0)
+        return future
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pool-warm")
+    future = executor.submit(_open_connections, engine, count)
+    executor.shutdown(wait=False)
+    return future
+
+
+def start_background(name: str, fn, *args):
+    def run():
+        started = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception as exc:
+            logger.warning("startup: %s failed: %s", name, exc)
+        else:
+            timings.record(name, time.perf_counter() - started)
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+
+class FirstResponseTimer:
+    ''' Records boot-to-first-response once, then stays out of the way '''
+
+    def __init__(self, app):
+        self.app = app
+        self.done = False
+
+    async def __call__(self, scope, receive, send):
+        if self.done or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if not self.done:
+                self.done = True
+                timings.record("first_response", time.perf_counter() - IMPORT_STARTED)
+                timings.report()
+
+
+if __name__ == "__main__":
+    # Build step: compile all templates into JINJA_BYTECODE_CACHE_DIR
+    logging.basicConfig(level=logging.INFO)
+    if not JINJA_BYTECODE_CACHE_DIR:
+        raise SystemExit("Set JINJA_BYTECODE_CACHE_DIR")
+    from fastapi.templating import Jinja2Templates
+    env = Jinja2Templates(directory="app/templates").env  # same options (autoescape) as the app
+    configure_template_cache(env)
+    logger.info("compiled %d templates into %s", precompile_templates(env), JINJA_BYTECODE_CACHE_DIR)
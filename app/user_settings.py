@@ -0,0 +1,136 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from app.db import food_schema
+from app.db.models import RDA, UL, User
+from app import diet_totals
+
+# -------------------------------------------------------------------
+# Per-user settings cache
+#
+# users.settings (diet_columns, thresholds, colors) used to be parsed on
+# every authenticated request. The auth query now only reads
+# users.settings_version; the parsed settings come from this per-process
+# cache, keyed by that version, and are reloaded when it moves.
+# update_me, reset_user_settings and the RDA/UL edits bump it (bump()),
+# so every worker notices on its next request.
+#
+# Each entry also holds a ColumnPlan: the user's diet_columns resolved
+# once against the live foods columns, with their positions in the
+# nutrient vector (diet_totals) and their RDA/UL values.
+# -------------------------------------------------------------------
+
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+
+# diets columns the diet page can show next to the food's
+DIET_FIELDS = ("diet_name", "fdc_id", "quantity", "sort_order", "color")
+
+
+class ColumnPlan:
+    ''' diet_columns resolved for one settings version and foods schema '''
+
+    def __init__(self, diet_columns: list, schema: food_schema.FoodSchema, rda: dict, ul: dict):
+        self.schema_version = schema.version
+        known = set(schema.output_names).union(DIET_FIELDS)
+        known.discard("Serving Size")  # scaled away in diets_nutrition rows
+        seen = set()
+        columns = []
+        for name in diet_columns if isinstance(diet_columns, list) else []:
+            if isinstance(name, str) and name in known and name not in seen:
+                seen.add(name)
+                columns.append(name)
+        self.columns = tuple(columns)
+        # positions of the selected nutrients in diet_totals vectors (and schema.scaled)
+        layout = diet_totals.current_layout()
+        position = {name: i for i, name in enumerate(layout.columns)}
+        self.nutrients = tuple(name for name in self.columns if name in position)
+        self.indices = tuple(position[name] for name in self.nutrients)
+        self.rda = tuple(rda.get(name) for name in self.nutrients)
+        self.ul = tuple(ul.get(name) for name in self.nutrients)
+        # every nutrient's limits, for views beyond diet_columns
+        self.rda_by_name = rda
+        self.ul_by_name = ul
+
+    def row(self, item: dict) -> list:
+        ''' A diets_nutrition row as a list in column order '''
+        return [item.get(name) for name in self.columns]
+
+    def pick(self, vector) -> list:
+        ''' The selected nutrients out of a diet_totals vector '''
+        return [vector[i] for i in self.indices]
+
+    def as_dict(self) -> dict:
+        return {
+            "columns": list(self.columns),
+            "nutrients": list(self.nutrients),
+            "rda": list(self.rda),
+            "ul": list(self.ul),
+        }
+
+
+class CachedSettings:
+    __slots__ = ("user_id", "version", "settings", "_plan", "_lock")
+
+    def __init__(self, user_id: int, version: int, settings: dict):
+        self.user_id = user_id
+        self.version = version
+        self.settings = settings  # shared between requests, don't modify
+        self._plan = None
+        self._lock = Lock()
+
+    def plan(self, db: Session) -> ColumnPlan:
+        schema = food_schema.current()
+        plan = self._plan
+        if plan is None or plan.schema_version != schema.version:
+            with self._lock:
+                plan = self._plan
+                if plan is None or plan.schema_version != schema.version:
+                    plan = self._plan = ColumnPlan(
+                        self.settings.get("diet_columns"), schema, _limits(db, RDA, self.user_id), _limits(db, UL, self.user_id)
+                    )
+        return plan
+
+
+_cache = OrderedDict()  # user_id -> CachedSettings, least recently used first
+_cache_lock = Lock()
+
+
+def _limits(db: Session, model, user_id: int) -> dict:
+    return dict(db.execute(select(model.nutrient, model.value).where(model.user_id == user_id)).all())
+
+
+def get(db: Session, user_id: int, version: int) -> CachedSettings:
+    ''' Settings of a user at `version` (users.settings_version as just read) '''
+    with _cache_lock:
+        entry = _cache.get(user_id)
+        if entry is not None and entry.version == version:
+            _cache.move_to_end(user_id)
+            return entry
+    settings = db.execute(select(User.settings).where(User.id == user_id)).scalar_one_or_none()
+    entry = CachedSettings(user_id, version, settings if isinstance(settings, dict) else {})
+    with _cache_lock:
+        current = _cache.get(user_id)
+        # a concurrent request may have loaded a newer version already
+        if current is None or current.version <= version:
+            _cache[user_id] = entry
+            _cache.move_to_end(user_id)
+        while len(_cache) > SETTINGS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return entry
+
+
+def bump(db: Session, user_id: int):
+    ''' Call in the transaction that changes settings, RDA or UL '''
+    db.execute(
+        update(User).where(User.id == user_id).values(settings_version=User.settings_version + 1)
+    )
+
+
+def invalidate(user_id: int):
+    ''' Drop this worker's copy right away (others go by the version) '''
+    with _cache_lock:
+        _cache.pop(user_id, None)
@@ -0,0 +1,61 @@
+''' Same benchmark on PostgreSQL and on embedded SQLite, side by side
+
+    python -m bench.backends --foods 300 --requests 200
+    python -m bench.backends --postgres-url postgresql://user@db-host/evaldiet_bench --output backends.json
+
+    Each backend runs in its own `python -m bench.run` process (the app
+    binds DATABASE_URL at import). Other arguments are passed through.
+    Without --postgres-url Postgres is a temporary local cluster, so the
+    network round trip to a remote server (the usual setup) isn't in its
+    numbers; point --postgres-url at your real server to include it.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench.run import PROJECT_ROOT
+
+
+def run_backend(backend: str, database_url: str | None, passthrough: list) -> dict:
+    with tempfile.TemporaryDirectory(prefix="evaldiet-bench-") as workdir:
+        output = os.path.join(workdir, f"{backend}.json")
+        cmd = [sys.executable, "-m", "bench.run", "--backend", backend, "--output", output, *passthrough]
+        if database_url:
+            cmd += ["--database-url", database_url]
+        subprocess.run(cmd, cwd=PROJECT_ROOT, check=True)
+        with open(output, encoding="utf-8") as handle:
+            return json.load(handle)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EvalDiet benchmark, PostgreSQL vs SQLite")
+    parser.add_argument("--postgres-url", help="empty Postgres database, default: start a temporary one")
+    parser.add_argument("--output", help="write both JSON reports here")
+    args, passthrough = parser.parse_known_args(argv)
+
+    reports = {
+        "postgres": run_backend("postgres", args.postgres_url, passthrough),
+        "sqlite": run_backend("sqlite", None, passthrough),
+    }
+
+    print(f"{'scenario':12s} {'pg p50':>9s} {'lite p50':>9s} {'pg p95':>9s} {'lite p95':>9s} {'p95 ratio':>9s}")
+    for scenario, pg in reports["postgres"]["scenarios"].items():
+        lite = reports["sqlite"]["scenarios"].get(scenario)
+        if lite is None:
+            continue
+        ratio = lite["p95_ms"] / pg["p95_ms"] if pg["p95_ms"] else 0.0
+        print(
+            f"{scenario:12s} {pg['p50_ms']:9.2f} {lite['p50_ms']:9.2f} "
+            f"{pg['p95_ms']:9.2f} {lite['p95_ms']:9.2f} {ratio:9.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(json.dumps(reports, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# -------------------------------------------------------------------
+# Local stand-in for https://api.nal.usda.gov/fdc/v1, enough for
+# create_update_food_from_fdcid. Point the app at it with FDC_API_BASE_URL.
+# -------------------------------------------------------------------
+
+FOOD_PATH_RE = re.compile(r"^/fdc/v1/food/(\d+)")
+
+
+def fake_food(fdc_id: int, nutrient_columns: list) -> dict:
+    ''' Same shape as the real /food/{fdcId} response (the parts the importer reads) '''
+    rnd = random.Random(fdc_id)
+    nutrients = []
+    for col in nutrient_columns:
+        name, unit_name = col.rsplit(" ", 1)
+        nutrients.append({
+            "nutrient": {"name": name, "unitName": unit_name},
+            "amount": round(rnd.uniform(0, 50), 3),
+        })
+    return {"fdcId": fdc_id, "description": f"Bench food {fdc_id}", "foodNutrients": nutrients}
+
+
+class FakeFdcServer:
+    def __init__(self, nutrient_columns: list, latency_ms: float = 0.0):
+        self.nutrient_columns = nutrient_columns
+        self.latency_ms = latency_ms
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if server.latency_ms:
+                    time.sleep(server.latency_ms / 1000.0)
+                match = FOOD_PATH_RE.match(self.path)
+                if not match:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = json.dumps(fake_food(int(match.group(1)), server.nutrient_columns)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-fdc", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/fdc/v1"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,210 @@
+''' Peak memory per request of the diet nutrition path, dict rows vs compact rows
+
+    python -m bench.memory --foods 500 --items 20 --requests 50
+    python -m bench.memory --database-url postgresql://... --output memory.json
+
+    Fills a temporary SQLite file (or --database-url) with synthetic data and
+    runs the work of GET /api/diets/{name}/nutrition in-process under
+    tracemalloc, alternating these implementations on the same diets:
+      - dicts:   the previous one, a dict per food of the user, copied twice
+                 per diet item, the list of dicts through jsonable_encoder
+      - compact: the endpoint as it is now (app.diet_nutrition)
+      - compact_all_foods: compact rows, but loading every food of the user
+                 like before, to tell the two savings apart
+    Reports the peak traced bytes above the baseline per request, garbage
+    collections per request, and checks they all send the same JSON.
+'''
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+from bench.run import PROJECT_ROOT, git_commit
+
+
+def legacy_scale(diet_items: list, foods: list) -> list:
+    ''' scale_diet_nutrition as it was before app.diet_nutrition '''
+    from app.db import food_schema
+
+    scaled_columns = food_schema.current().scaled
+    foods_by_id = {}
+    for food in foods:
+        foods_by_id[food.get("fdc_id")] = food
+
+    diet_calculated = []
+    for diet_entry in diet_items:
+        food = foods_by_id.get(diet_entry.get("fdc_id"))
+        if not food:
+            continue
+
+        serving_size = food.get("Serving Size")
+        try:
+            serving_size = float(serving_size)
+        except (TypeError, ValueError):
+            serving_size = 0.0
+
+        adjusted_food = dict(food)
+        adjusted_food.pop("Serving Size", None)
+        for key in scaled_columns:
+            value = food.get(key)
+            if isinstance(value, (int, float)):
+                if serving_size > 0:
+                    adjusted_value = round((float(value) / serving_size) * float(diet_entry.get("quantity", 0)), 2)
+                else:
+                    adjusted_value = 0.00
+                adjusted_food[key] = adjusted_value
+
+        merged = dict(diet_entry)
+        merged.update(adjusted_food)
+        diet_calculated.append(merged)
+
+    return diet_calculated
+
+
+def dicts_request(db, user_id: int, diet_name: str) -> bytes:
+    ''' The previous diets_nutrition, serialized the way FastAPI does a returned list '''
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from sqlalchemy import select
+    from app.db import food_schema
+    from app.db.models import Diet
+    from app.main import model_to_dict, strip_user_id
+
+    diet_items = strip_user_id([
+        model_to_dict(row)
+        for row in db.execute(
+            select(Diet).where(Diet.diet_name == diet_name, Diet.user_id == user_id)
+        ).scalars().all()
+    ])
+    schema = food_schema.current()
+    foods = schema.to_dicts(db.execute(
+        schema.select().where(schema.table.c.user_id == user_id)
+    ).all())
+    return JSONResponse(jsonable_encoder(legacy_scale(diet_items, foods))).body
+
+
+def compact_request(db, user_id: int, diet_name: str) -> bytes:
+    from app.main import diets_nutrition
+
+    return diets_nutrition(diet_name, user={"id": user_id}, db=db).body
+
+
+def compact_all_foods_request(db, user_id: int, diet_name: str) -> bytes:
+    from sqlalchemy import select
+    from app import diet_nutrition
+    from app.db.models import Diet
+    from app.main import model_to_dict, strip_user_id
+
+    diet_items = strip_user_id([
+        model_to_dict(row)
+        for row in db.execute(
+            select(Diet).where(Diet.diet_name == diet_name, Diet.user_id == user_id)
+        ).scalars().all()
+    ])
+    return diet_nutrition.scale(diet_items, diet_nutrition.load_foods(db, user_id)).json()
+
+
+def measure(fn, session_factory, user_id: int, diet_name: str) -> tuple:
+    ''' (peak bytes above the baseline, gen-0 collections, seconds, body) of one request '''
+    with session_factory() as db:
+        gc.collect()
+        collections = gc.get_stats()[0]["collections"]
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        body = fn(db, user_id, diet_name)
+        secs = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        collections = gc.get_stats()[0]["collections"] - collections
+    return peak, collections, secs, body
+
+
+def summarize(samples: list) -> dict:
+    peaks = sorted(sample[0] for sample in samples)
+    return {
+        "peak_kib_median": round(statistics.median(peaks) / 1024, 1),
+        "peak_kib_max": round(peaks[-1] / 1024, 1),
+        "gc_gen0_per_request": round(sum(sample[1] for sample in samples) / len(samples), 2),
+        "ms_median_traced": round(statistics.median(sample[2] for sample in samples) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EvalDiet diet nutrition memory benchmark")
+    parser.add_argument("--database-url", help="empty database to use, default: a temporary SQLite file")
+    parser.add_argument("--users", type=int, default=2)
+    parser.add_argument("--foods", type=int, default=500, help="foods per user")
+    parser.add_argument("--diets", type=int, default=2, help="diets per user")
+    parser.add_argument("--items", type=int, default=20, help="items per diet")
+    parser.add_argument("--requests", type=int, default=50, help="measured requests per implementation")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+
+    os.chdir(PROJECT_ROOT)
+    sys.path.insert(0, PROJECT_ROOT)
+
+    from bench.synthetic import create_dataset, local_sqlite
+
+    db_context = nullcontext(args.database_url) if args.database_url else local_sqlite()
+    with db_context as database_url:
+        os.environ["DATABASE_URL"] = database_url
+        from app.db.session import SessionLocal, engine
+        import app.main  # noqa: F401  imported after the environment is set
+        logging.getLogger().setLevel(logging.WARNING)
+
+        users = create_dataset(engine, args.users, args.foods, args.diets, args.items, seed=args.seed)
+        targets = [(user_id, diet_name) for user_id, _username, diet_names in users for diet_name in diet_names]
+        implementations = {
+            "dicts": dicts_request,
+            "compact": compact_request,
+            "compact_all_foods": compact_all_foods_request,
+        }
+
+        for user_id, diet_name in targets:  # warm-up: schema reflection, compiled statements
+            bodies = [json.loads(fn(SessionLocal(), user_id, diet_name)) for fn in implementations.values()]
+            if any(body != bodies[0] for body in bodies):
+                raise SystemExit(f"implementations disagree on {diet_name!r} of user {user_id}")
+
+        samples = {name: [] for name in implementations}
+        tracemalloc.start()
+        try:
+            for i in range(args.requests):
+                user_id, diet_name = targets[i % len(targets)]
+                for name, fn in implementations.items():
+                    samples[name].append(measure(fn, SessionLocal, user_id, diet_name)[:3])
+        finally:
+            tracemalloc.stop()
+        backend = engine.dialect.name
+        engine.dispose()
+
+    results = {name: summarize(rows) for name, rows in samples.items()}
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "backend": backend,
+        "params": {
+            "users": args.users, "foods": args.foods, "diets": args.diets, "items": args.items,
+            "requests": args.requests, "seed": args.seed,
+        },
+        "results": results,
+        "peak_ratio": round(results["compact"]["peak_kib_median"] / results["dicts"]["peak_kib_median"], 3),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+''' Load / latency benchmark for the EvalDiet API
+
+    Drives the real FastAPI app in-process through its ASGI interface against
+    a throwaway Postgres filled with synthetic data, and a local fake FDC server.
+
+    python -m bench.run --foods 500 --items 20 --requests 200 --output bench_output.json
+    python -m bench.run --database-url postgresql://... --compare baseline.json
+    python -m bench.run --backend sqlite
+
+    Run from the project root. Without --database-url a temporary cluster is
+    started with initdb/pg_ctl (PostgreSQL must be installed), or with
+    --backend sqlite a temporary SQLite file is used.
+    bench.backends runs both and prints them side by side.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import nullcontext
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ("login", "foods", "nutrition", "diet_edit", "register", "fdc_import")
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    ''' Nearest-rank percentile '''
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: list, errors: int, wall_secs: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "throughput_rps": round(len(values) / wall_secs, 2) if wall_secs > 0 else 0.0,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# -------------------------------------------------------------------
+# Scenarios. Each worker is one user with its own cookie jar,
+# so diet edits of concurrent workers never touch the same rows.
+# -------------------------------------------------------------------
+
+class Worker:
+    def __init__(self, client, user: tuple, password: str):
+        self.client = client
+        self.user_id, self.username, self.diet_names = user
+        self.password = password
+        self.edit_item = None
+        self.fdc_counter = 0
+
+    async def login(self):
+        return await self.client.post("/api/login", data={"username": self.username, "password": self.password})
+
+    async def foods(self):
+        return await self.client.get("/api/foods")
+
+    async def nutrition(self):
+        return await self.client.get(f"/api/diets/{self.diet_names[0]}/nutrition")
+
+    async def diet_edit(self):
+        if self.edit_item is None:
+            items = (await self.client.get(f"/api/diets/{self.diet_names[0]}")).json()
+            self.edit_item = items[0]
+        item = self.edit_item
+        new_quantity = float(item["quantity"]) + 1
+        resp = await self.client.put("/api/diet", json={
+            "diet_name": item["diet_name"],
+            "fdc_id": item["fdc_id"],
+            "quantity": new_quantity,
+            "sort_order": item["sort_order"],
+            "color": item.get("color"),
+            "original_fdc_id": item["fdc_id"],
+            "original_quantity": item["quantity"],
+            "original_sort_order": item["sort_order"],
+        })
+        if resp.status_code == 200:
+            item["quantity"] = new_quantity
+        return resp
+
+    async def register(self):
+        self.fdc_counter += 1
+        code = "BENCH1"
+        own_token = self.client.cookies.get("auth_token")
+        self.client.cookies.set("reg_code", code)
+        resp = await self.client.post("/api/register", data={
+            "username": f"{self.username}_signup_{self.fdc_counter}_{time.monotonic_ns()}",
+            "password": self.password,
+            "captcha_code": code,
+            "captcha_check": "on",
+        })
+        # registering logs the new account in, keep benchmarking as our own user
+        self.client.cookies.clear()
+        self.client.cookies.set("auth_token", own_token)
+        return resp
+
+    async def fdc_import(self):
+        self.fdc_counter += 1
+        fdc_id = 900000 + self.user_id * 10000 + self.fdc_counter
+        return await self.client.post(f"/api/foods/create_update_food_from_fdcid/{fdc_id}")
+
+
+async def run_scenario(app, users: list, password: str, scenario: str, requests: int, concurrency: int) -> dict:
+    import httpx
+
+    clients = [
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+        for _ in range(concurrency)
+    ]
+    workers = [Worker(clients[i], users[i % len(users)], password) for i in range(concurrency)]
+    for worker in workers:
+        await worker.login()
+
+    latencies, errors = [], 0
+    remaining = requests
+
+    async def loop(worker: Worker):
+        nonlocal remaining, errors
+        action = getattr(worker, scenario)
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                resp = await action()
+                ok = resp.status_code < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(loop(w) for w in workers))
+    wall = time.perf_counter() - started
+    for client in clients:
+        await client.aclose()
+    return summarize(latencies, errors, wall)
+
+
+async def run_all(args, users: list, password: str) -> dict:
+    import app.main
+
+    results = {}
+    async with app.main.app.router.lifespan_context(app.main.app):
+        for scenario in args.scenarios:
+            # warm up the DB pool and caches before measuring
+            await run_scenario(app.main.app, users, password, scenario, min(args.warmup, args.requests), args.concurrency)
+            results[scenario] = await run_scenario(app.main.app, users, password, scenario, args.requests, args.concurrency)
+            print(f"{scenario:12s} {json.dumps(results[scenario])}", file=sys.stderr)
+    return results
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, encoding="utf-8") as handle:
+        baseline = json.load(handle)["scenarios"]
+    regressions = []
+    for scenario, current in results.items():
+        before = baseline.get(scenario)
+        if not before or not before.get("p95_ms"):
+            continue
+        ratio = current["p95_ms"] / before["p95_ms"]
+        if ratio > 1 + tolerance:
+            regressions.append({"scenario": scenario, "baseline_p95_ms": before["p95_ms"], "p95_ms": current["p95_ms"], "ratio": round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EvalDiet API benchmark")
+    parser.add_argument("--database-url", help="empty database to use, default: start a temporary one")
+    parser.add_argument("--backend", choices=("postgres", "sqlite"), default="postgres", help="temporary database to start without --database-url")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--foods", type=int, default=300, help="foods per user")
+    parser.add_argument("--diets", type=int, default=2, help="diets per user")
+    parser.add_argument("--items", type=int, default=15, help="items per diet")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--fdc-latency-ms", type=float, default=50.0, help="simulated FDC API latency")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", help="previous JSON report; exit 1 if a p95 regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    os.chdir(PROJECT_ROOT)  # the app opens app/static, app/templates and app/db/*.sql relative to cwd
+    sys.path.insert(0, PROJECT_ROOT)
+
+    from bench.fake_fdc import FakeFdcServer
+    from bench.synthetic import BENCH_PASSWORD, create_dataset, local_postgres, local_sqlite, nutrient_columns
+
+    if args.database_url:
+        db_context = nullcontext(args.database_url)
+    else:
+        db_context = local_sqlite() if args.backend == "sqlite" else local_postgres()
+    with db_context as database_url:
+        os.environ["DATABASE_URL"] = database_url
+        os.environ.setdefault("FDC_API_KEY", "bench")
+        os.environ["FDC_RATE_LIMIT_MAX_CALLS"] = str(10**9)
+        os.environ.setdefault("SQL_SLOW_QUERY_MS", "0")
+
+        with FakeFdcServer(nutrient_columns(), latency_ms=args.fdc_latency_ms) as fdc:
+            os.environ["FDC_API_BASE_URL"] = fdc.base_url
+            from app.db.session import engine
+            backend = engine.dialect.name
+            import app.main  # noqa: F401  imported after the environment is set
+            logging.getLogger().setLevel(logging.WARNING)
+
+            started = time.perf_counter()
+            users = create_dataset(engine, args.users, args.foods, args.diets, args.items, seed=args.seed)
+            setup_secs = time.perf_counter() - started
+
+            results = asyncio.run(run_all(args, users, BENCH_PASSWORD))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "backend": backend,
+        "params": {
+            "users": args.users, "foods": args.foods, "diets": args.diets, "items": args.items,
+            "requests": args.requests, "concurrency": args.concurrency,
+            "fdc_latency_ms": args.fdc_latency_ms, "seed": args.seed,
+        },
+        "setup_secs": round(setup_secs, 3),
+        "scenarios": results,
+    }
+    regressions = []
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
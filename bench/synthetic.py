@@ -0,0 +1,121 @@
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from decimal import Decimal
+
+from sqlalchemy import Numeric, insert
+
+# -------------------------------------------------------------------
+# Throwaway Postgres (or SQLite file) + deterministic synthetic users,
+# foods and diets
+# -------------------------------------------------------------------
+
+BENCH_PASSWORD = "benchpass"
+NON_NUTRIENT_COLUMNS = {"user_id", "fdc_id", "Name", "Unit", "Serving Size", "Price"}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def local_postgres():
+    ''' Start a temporary Postgres cluster with initdb/pg_ctl, yield its DATABASE_URL, delete it after '''
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if not initdb or not pg_ctl:
+        raise SystemExit("initdb/pg_ctl not found on PATH. Install PostgreSQL or pass --database-url")
+
+    workdir = tempfile.mkdtemp(prefix="evaldiet-bench-")
+    datadir = os.path.join(workdir, "data")
+    port = _free_port()
+    subprocess.run(
+        [initdb, "-D", datadir, "-U", "postgres", "-A", "trust", "--encoding=UTF8", "--no-locale"],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    subprocess.run(
+        [pg_ctl, "-D", datadir, "-l", os.path.join(workdir, "postgres.log"), "-w",
+         "-o", f"-p {port} -k {workdir} -c listen_addresses=127.0.0.1 -c fsync=off", "start"],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([pg_ctl, "-D", datadir, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@contextmanager
+def local_sqlite():
+    ''' Yield the DATABASE_URL of a new SQLite file (embedded mode), delete it after '''
+    workdir = tempfile.mkdtemp(prefix="evaldiet-bench-")
+    try:
+        yield "sqlite:///" + os.path.join(workdir, "evaldiet.db")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def nutrient_columns() -> list:
+    from app.db.models import Food
+    return [
+        col.name for col in Food.__table__.columns
+        if col.name not in NON_NUTRIENT_COLUMNS and isinstance(col.type, Numeric)
+    ]
+
+
+def _food_row(rnd: random.Random, user_id: int, fdc_id: int, columns: list) -> dict:
+    row = {
+        "user_id": user_id,
+        "fdc_id": fdc_id,
+        "Name": f"Synthetic food {fdc_id}",
+        "Serving Size": 100,
+        "Unit": "grams",
+        "Price": Decimal(str(round(rnd.uniform(0.2, 20), 2))),
+    }
+    for col in columns:
+        row[col] = Decimal(str(round(rnd.uniform(0, 50), 3)))
+    return row
+
+
+def create_dataset(engine, users: int, foods_per_user: int, diets_per_user: int, items_per_diet: int, seed: int = 1) -> list:
+    ''' Creates the schema and the synthetic data. Returns [(user_id, username, [diet names])] '''
+    from app.db.models import Base, User, Food, Diet
+    from app.main import hash_password
+
+    Base.metadata.create_all(bind=engine)
+    rnd = random.Random(seed)
+    columns = nutrient_columns()
+    created = []
+
+    with engine.begin() as conn:
+        for u in range(users):
+            username = f"bench_user_{u}"
+            user_id = conn.execute(
+                insert(User.__table__).values(username=username, hashed_password=hash_password(BENCH_PASSWORD)).returning(User.__table__.c.id)
+            ).scalar_one()
+            conn.execute(
+                insert(Food.__table__),
+                [_food_row(rnd, user_id, fdc_id, columns) for fdc_id in range(1, foods_per_user + 1)],
+            )
+            diet_names = [f"Diet {d}" for d in range(diets_per_user)]
+            diet_rows = []
+            for diet_name in diet_names:
+                fdc_ids = rnd.sample(range(1, foods_per_user + 1), min(items_per_diet, foods_per_user))
+                for sort_order, fdc_id in enumerate(fdc_ids, start=1):
+                    diet_rows.append({
+                        "user_id": user_id,
+                        "diet_name": diet_name,
+                        "fdc_id": fdc_id,
+                        "quantity": Decimal(rnd.randint(10, 300)),
+                        "sort_order": sort_order,
+                        "color": None,
+                    })
+            if diet_rows:
+                conn.execute(insert(Diet.__table__), diet_rows)
+            created.append((user_id, username, diet_names))
+    return created